@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Micro-benchmark of caption rendering: timestamp formatting and output buffering of the vtt and srt writers.
+# Compares the current writers with the previous implementation (float division, str.format and a list of lines joined at the end),
+# rendering the cues of a synthetic 10 hour lecture. Also times read_zoom's toCueTime before and after.
+#
+# Example usage: python3 benchmarks/bench_timestamps.py --hours 10 --repeat 5
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'transcribe-cli'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ms_json_to_caption
+import read_zoom
+
+
+def synthetic_cues(hours, seed=1):
+    """Returns a list of Cues covering the given number of hours - most cues start where the previous one ended, like real captions"""
+    rng = random.Random(seed)
+    cues = []
+    t = 500
+    while t < hours * 3600 * 1000:
+        duration = rng.randint(800, 8000)
+        text = 'the quick brown fox jumps over\nthe lazy dog {}'.format(len(cues))
+        cues.append(ms_json_to_caption.Cue(t, t + duration, text))
+        t += duration + rng.choice([0, 0, 0, 0, 120, 1500])
+    return cues
+
+
+class LegacyVTTWriter:
+    """The vtt writer before the shared timestamp formatter and buffered output"""
+    def render_cues(self, cues):
+        note = 'NOTE ' + ms_json_to_caption.ACKNOWLEDGEMENT_TEXT1 + ' ' + ms_json_to_caption.ACKNOWLEDGEMENT_TEXT2
+        self.lines = ['WEBVTT', 'Kind: Subtitles', 'Language: en', note, '']
+        for start, end, content in cues:
+            self.lines.extend([self.write_start_end(start, end), content.replace('\n ', '\n'), ''])
+        return '\n'.join(self.lines)
+
+    def to_timestamp(self, t_ms):
+        if t_ms is None or t_ms < 0:
+            t_ms = 0
+        t = int(t_ms/1000)
+        hours = int(t / 3600)
+        minutes = int(t / 60) % 60
+        seconds = t % 60
+        milli = int(t_ms) % 1000
+        result = '{0:02d}:{1:02d}.{2:03d}'.format(minutes,seconds,milli)
+        if hours == 0:
+            return result
+        return '{0:03d}:'.format(hours) + result
+
+    def write_start_end(self, start_ms, end_ms):
+        return '{0} --> {1}'.format(self.to_timestamp(start_ms), self.to_timestamp(end_ms))
+
+
+class LegacySrtWriter(LegacyVTTWriter):
+    def render_cues(self, cues):
+        self.lines = []
+        for counter, (start, end, content) in enumerate(cues, start=1):
+            self.lines.extend([str(counter), self.write_start_end(start, end), content.replace('\n ', '\n'), ''])
+        return '\n'.join(self.lines)
+
+    def to_timestamp(self, t_ms):
+        if t_ms is None or t_ms < 0:
+            t_ms = 0
+        t = int(t_ms/1000)
+        hours = int(t / 3600)
+        minutes = int(t / 60) % 60
+        seconds = t % 60
+        milli = int(t_ms) % 1000
+        return '{0:02d}:{1:02d}:{2:02d},{3:03d}'.format(hours, minutes,seconds,milli)
+
+
+def legacy_toCueTime(t, sep=","):
+    s = int(t.seconds)
+    milli = int(1000 * (t.seconds - s))
+    return f"{s//3600:02}:{s//60%60:02}:{s%60:02}{sep}{milli:03}"
+
+
+def best_time(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def report(name, before, after, items):
+    print('{:<28} before {:8.1f} ms  after {:8.1f} ms  speedup {:5.2f}x  ({:.0f} cues/s)'.format(
+        name, before * 1000, after * 1000, before / after, items / after))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times caption timestamp formatting and rendering on a synthetic recording')
+    parser.add_argument('--hours', type=float, default=10, help='length of the synthetic recording (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='report the best of REPEAT runs (default: %(default)s)')
+    args = parser.parse_args()
+
+    cues = synthetic_cues(args.hours)
+    print('{} cues, {:g} hours'.format(len(cues), args.hours))
+
+    for name, legacy, current in [('vtt', LegacyVTTWriter(), ms_json_to_caption.VTTCaptionWriter()),
+                                  ('srt', LegacySrtWriter(), ms_json_to_caption.SrtCaptionWriter())]:
+        assert legacy.render_cues(cues) == current.render_cues(cues)
+        before = best_time(lambda: legacy.render_cues(cues), args.repeat)
+        after = best_time(lambda: current.render_cues(cues), args.repeat)
+        report('render_cues ' + name, before, after, len(cues))
+
+    # Zoom times are whole seconds. Like read_zoom.export, format the start and end of each cue
+    times = [datetime.timedelta(seconds=t // 1000) for cue in cues for t in (cue.start_ms, cue.end_ms)]
+    assert [legacy_toCueTime(t) for t in times] == [read_zoom.toCueTime(t) for t in times]
+    before = best_time(lambda: [legacy_toCueTime(t) for t in times], args.repeat)
+    after = best_time(lambda: [read_zoom.toCueTime(t) for t in times], args.repeat)
+    report('read_zoom toCueTime', before, after, len(cues))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Benchmark suite for the captioning pipeline. Synthetic inputs of each length are generated (see synthetic.py) and each case is
+# timed in its own process, so that its peak memory use (RSS) can be measured. Reports wall time (best of --repeat runs), words per second and peak RSS.
+# Results can be saved as a baseline and later runs compared with it; a case that became slower than the tolerance is reported as a regression.
+#
+# Example usage: python3 benchmarks/run_benchmarks.py --minutes 1 60 600 --save
+#                python3 benchmarks/run_benchmarks.py --minutes 1 60 600          (compares with the saved baseline)
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows; peak RSS is not reported
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'transcribe-cli'))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..'))
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic
+
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+DEFAULT_TOLERANCE = 0.2 # Slower than the baseline by more than this fraction is a regression
+
+
+# Each case returns the function to time, given the input file. Loading the input is not timed (except where loading is the benchmark)
+
+def case_caption(caption_format):
+    def setup(input_file):
+        import ms_json_to_caption
+        json_results = ms_json_to_caption.load_json_results(input_file)
+        writer = ms_json_to_caption.create_captioner('captions.' + caption_format)
+        return lambda: writer.process_ms_json(json_results)
+    return setup
+
+def case_zoom_parse(input_file):
+    import read_zoom
+    return lambda: read_zoom.parse(read_zoom.read_file_as_lines(input_file), None)
+
+def case_zoom_export(input_file):
+    import read_zoom
+    with quiet():
+        captions = read_zoom.parse(read_zoom.read_file_as_lines(input_file), None)
+    return lambda: read_zoom.export_all({'srt': io.StringIO(), 'vtt': io.StringIO()}, captions)
+
+def case_vtt_read(input_file):
+    import push_vtt_file
+    return lambda: push_vtt_file.read_caption_file(input_file)
+
+def case_vtt_send(input_file):
+    """Sends every cue, one at a time, to a local socket (standing in for the caption encoder) that is read by another thread"""
+    import push_vtt_file
+    cues = push_vtt_file.read_caption_file(input_file)
+    def run():
+        connection, encoder = socket.socketpair()
+        reader = threading.Thread(target=lambda: all(iter(lambda: encoder.recv(65536), b'')), daemon=True)
+        reader.start()
+        for cue in cues:
+            push_vtt_file.send_cues([cue], connection)
+        connection.close()
+        reader.join()
+        encoder.close()
+    return run
+
+# name -> (input kind, setup)
+CASES = {
+    'caption-vtt': ('ms-json', case_caption('vtt')),
+    'caption-srt': ('ms-json', case_caption('srt')),
+    'caption-txt': ('ms-json', case_caption('txt')),
+    'zoom-parse': ('zoom', case_zoom_parse),
+    'zoom-export': ('zoom', case_zoom_export),
+    'vtt-read': ('vtt', case_vtt_read),
+    'vtt-send': ('vtt', case_vtt_send),
+}
+
+
+@contextlib.contextmanager
+def quiet():
+    """The tools print progress (e.g. every cue sent); it is discarded rather than timing the terminal"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def run_case(name, input_file, repeat):
+    """Runs in the child process: times the case and returns the result dict"""
+    with quiet():
+        function = CASES[name][1](input_file)
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+
+def run_case_in_process(name, input_file, repeat):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', name, '--input', input_file, '--repeat', str(repeat)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+def run_suite(minutes_list, case_names, repeat, seed=1):
+    """Returns {'<case>/<minutes>m': {'seconds', 'words', 'words_per_s', 'peak_rss_mb'}}"""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='caption-benchmarks-') as temp_dir:
+        for minutes in minutes_list:
+            inputs = {}
+            for name in case_names:
+                kind = CASES[name][0]
+                if kind not in inputs:
+                    input_file = os.path.join(temp_dir, '{}-{:g}.{}'.format(kind, minutes, 'json' if kind == 'ms-json' else 'txt' if kind == 'zoom' else 'vtt'))
+                    inputs[kind] = input_file, synthetic.WRITERS[kind](input_file, minutes, seed)
+                input_file, words = inputs[kind]
+                result = run_case_in_process(name, input_file, repeat)
+                result['words'] = words
+                result['words_per_s'] = words / result['seconds'] if result['seconds'] else 0
+                key = '{}/{:g}m'.format(name, minutes)
+                results[key] = result
+                print_result(key, result)
+            for input_file, _ in inputs.values():
+                os.remove(input_file)
+    return results
+
+def print_result(key, result, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    rss = '{:8.1f} MB'.format(result['peak_rss_mb']) if result.get('peak_rss_mb') is not None else '       n/a'
+    line = '{:<24} {:10.4f} s {:12.0f} words/s {}'.format(key, result['seconds'], result['words_per_s'], rss)
+    if baseline:
+        change = result['seconds'] / baseline['seconds'] - 1 if baseline['seconds'] else 0
+        line += '  {:+6.1f}% vs baseline{}'.format(change * 100, '  REGRESSION' if change > tolerance else '')
+    print(line)
+
+def compare(results, baseline, tolerance):
+    """Prints the results against the baseline. Returns the list of regressed cases"""
+    print('\nCompared with the baseline:')
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        print_result(key, result, baseline[key], tolerance)
+        if baseline[key]['seconds'] and result['seconds'] / baseline[key]['seconds'] - 1 > tolerance:
+            regressions.append(key)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the captioning pipeline on synthetic lectures of different lengths')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 60, 600], help='lecture lengths to benchmark, in minutes (default: 1 60 600; 1440 is 24 hours)')
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=list(CASES), help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of REPEAT runs of each case (default: %(default)s)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline results file (default: benchmarks/baseline.json)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline instead of comparing with it')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='report a regression if a case is slower than the baseline by more than this fraction (default: %(default)s)')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS) # Used to run one case in a child process
+    parser.add_argument('--input', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.input, args.repeat)))
+        return 0
+
+    results = run_suite(args.minutes, args.cases, args.repeat)
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as in_file:
+                baseline = json.load(in_file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as out_file:
+            json.dump(baseline, out_file, indent=1, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as in_file:
+            regressions = compare(results, json.load(in_file), args.tolerance)
+        if regressions:
+            print('{} regression(s): {}'.format(len(regressions), ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
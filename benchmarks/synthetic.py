@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Synthetic inputs for benchmarking the caption tools: MS speech recognition json (as saved by ms_recognize_pcm),
+# Zoom transcripts (as read by read_zoom) and WebVTT captions (as read by push_vtt_file), of any length.
+# The content is random but repeatable (seeded), with the shape of a real lecture - about 150 words a minute in utterances
+# of a few seconds, pauses, a few long breaks (e.g. a paused recording) and some words that are masked as profanity.
+#
+# Example usage: python3 benchmarks/synthetic.py ms-json 600 lecture.json
+#                python3 benchmarks/synthetic.py zoom 90 zoom.txt
+#                python3 benchmarks/synthetic.py vtt 1440 day.vtt
+
+import argparse
+import json
+import random
+
+TICKS_PER_MS = 10000 # MS cognitive services times are in ticks of one hundred nanoseconds
+
+WORDS = ('the', 'a', 'of', 'and', 'to', 'in', 'is', 'that', 'we', 'this', 'so', 'it', 'for', 'you', 'are', 'on', 'with', 'have', 'can',
+    'OK', 'now', 'data', 'value', 'function', 'example', 'question', 'lecture', 'problem', 'memory', 'pointer', 'students', 'algorithm',
+    'university', 'important', 'information', 'performance', 'Illinois', 'complexity', 'recursion', 'damn', 'crap', 'café', 'naïve')
+
+SPEAKERS = ('INSTRUCTOR', 'STUDENT', 'TA')
+
+LONG_BREAK_CHANCE = 0.002 # Chance that an utterance is followed by a long break (longer than read_zoom's skip_long_gap_threshold)
+
+
+def utterances(minutes, seed=1):
+    """Yields (start_ms, [(word, offset_ms, duration_ms)...]) for each utterance of a synthetic lecture of the given length"""
+    rng = random.Random(seed)
+    end_ms = int(minutes * 60 * 1000)
+    t = rng.randint(200, 3000)
+    while t < end_ms:
+        start = t
+        words = []
+        for _ in range(rng.randint(3, 40)):
+            word = rng.choice(WORDS)
+            duration = rng.randint(120, 150 + 40 * len(word))
+            words.append((word, t, duration))
+            t += duration + rng.choice((0, 0, 0, 40, 80, 150, 400, 700))
+        yield start, words
+        t += rng.choice((300, 600, 900, 2000, 7000))
+        if rng.random() < LONG_BREAK_CHANCE:
+            t += rng.randint(6 * 60 * 1000, 20 * 60 * 1000)
+
+
+def ms_json_results(minutes, seed=1):
+    """Yields MS cognitive services detailed recognition results (NBest / Words) for a synthetic lecture"""
+    for start, words in utterances(minutes, seed):
+        lexical = ' '.join(word for word, _, _ in words)
+        display = lexical[0].upper() + lexical[1:] + '.'
+        end = words[-1][1] + words[-1][2]
+        yield {'Duration': (end - start) * TICKS_PER_MS,
+               'NBest': [{'Confidence': 0.9, 'Display': display, 'ITN': lexical, 'Lexical': lexical.lower(), 'MaskedITN': lexical,
+                          'Words': [{'Duration': duration * TICKS_PER_MS, 'Offset': offset * TICKS_PER_MS, 'Word': word} for word, offset, duration in words]}],
+               'Offset': start * TICKS_PER_MS,
+               'RecognitionStatus': 'Success'}
+
+
+def clock(t_ms):
+    seconds = t_ms // 1000
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def zoom_lines(minutes, seed=1, start_clock_ms=8 * 3600 * 1000):
+    """Yields the lines of a synthetic Zoom transcript - a clock time (and usually a speaker) per utterance, longer utterances continue on following lines"""
+    rng = random.Random(seed + 1)
+    for start, words in utterances(minutes, seed):
+        text = [word for word, _, _ in words]
+        first, rest = text[:12], text[12:]
+        if rng.random() < 0.7:
+            yield '{} >> {}: {}'.format(clock(start_clock_ms + start), rng.choice(SPEAKERS), ' '.join(first))
+        else:
+            yield '{} {}'.format(clock(start_clock_ms + start), ' '.join(first))
+        while rest:
+            yield ' '.join(rest[:12])
+            rest = rest[12:]
+        if rng.random() < 0.5:
+            yield ''
+
+
+def vtt_timestamp(t_ms):
+    return '%s.%03d' % (clock(t_ms), t_ms % 1000)
+
+
+def vtt_lines(minutes, seed=1):
+    """Yields the lines of a synthetic WebVTT caption file - one cue of up to two lines per few seconds of speech"""
+    yield 'WEBVTT'
+    yield 'Kind: captions'
+    yield 'Language: en'
+    yield ''
+    for _, words in utterances(minutes, seed):
+        for i in range(0, len(words), 10):
+            cue = words[i:i + 10]
+            text = [word for word, _, _ in cue]
+            yield '{} --> {}'.format(vtt_timestamp(cue[0][1]), vtt_timestamp(cue[-1][1] + cue[-1][2]))
+            yield ' '.join(text[:5])
+            if text[5:]:
+                yield ' '.join(text[5:])
+            yield ''
+
+
+def write_ms_json(filename, minutes, seed=1):
+    """Saves synthetic recognition results as a json array, like ms_recognize_pcm. Returns the number of words"""
+    words = 0
+    with open(filename, 'w') as out_file:
+        out_file.write('[')
+        for i, result in enumerate(ms_json_results(minutes, seed)):
+            out_file.write((',\n' if i else '\n') + json.dumps(result))
+            words += len(result['NBest'][0]['Words'])
+        out_file.write('\n]\n')
+    return words
+
+
+def count_words(minutes, seed=1):
+    """Returns the number of words spoken in the synthetic lecture (the same for every kind of input)"""
+    return sum(len(words) for _, words in utterances(minutes, seed))
+
+
+def write_lines(filename, lines, newline='\n'):
+    """Saves the lines as a utf-8 text file"""
+    with open(filename, 'w', encoding='utf-8', newline='') as out_file:
+        for line in lines:
+            out_file.write(line + newline)
+
+
+def write_zoom(filename, minutes, seed=1):
+    """Saves a synthetic Zoom transcript. Returns the number of words"""
+    # Zoom transcripts are downloaded with Windows line endings
+    write_lines(filename, zoom_lines(minutes, seed), '\r\n')
+    return count_words(minutes, seed)
+
+
+def write_vtt(filename, minutes, seed=1):
+    """Saves a synthetic WebVTT caption file. Returns the number of words"""
+    write_lines(filename, vtt_lines(minutes, seed))
+    return count_words(minutes, seed)
+
+
+WRITERS = {'ms-json': write_ms_json, 'zoom': write_zoom, 'vtt': write_vtt}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates synthetic lecture inputs for benchmarking')
+    parser.add_argument('kind', choices=sorted(WRITERS), help='ms-json (recognition results), zoom (Zoom transcript) or vtt (WebVTT captions)')
+    parser.add_argument('minutes', type=float, help='length of the lecture in minutes e.g. 1440 for 24 hours')
+    parser.add_argument('output_file')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    words = WRITERS[args.kind](args.output_file, args.minutes, args.seed)
+    print('{} words written to {}'.format(words, args.output_file))
+
+
+if __name__ == '__main__':
+    main()
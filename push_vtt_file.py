@@ -1,86 +1,208 @@
 import socket
 import datetime
 import re
-import time
+import mmap
+import os
+import sys
+import bisect
+import collections
+import asyncio
+import argparse
+import codecs
+import threading
+import unicodedata
+
+# Optional timers and counters (see transcribe-cli/instrumentation.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transcribe-cli'))
+import instrumentation
 
 #https://stackoverflow.com/questions/54371492/changing-the-format-of-timestamp-in-python-3-7
 
 def to_timedelta(t):
-    timept = re.split(r'[:.]+', t)
-    h, m, s, ss = list(map(int, timept))
+    """Parses a caption timestamp - HH:MM:SS.mmm, MM:SS.mmm (webvtt times less than 1 hour) or HHH:MM:SS.mmm. Srt uses a comma before the milliseconds"""
+    timept = list(map(int, re.split(r'[:.,]+', t)))
+    if len(timept) == 3:
+        timept.insert(0, 0)
+    h, m, s, ss = timept
     return datetime.timedelta(hours=h, minutes=m, seconds=s, milliseconds=ss)
 
-def select(cues,currenttime,prevtime):
-    return  [ c for c in cues if c['start'] >  prevtime and c['start'] <=  currenttime ]
-
 def unescape(s):
     return s.replace('&lt;','<').replace('&gt;','>').replace('&quot','"').replace('&apos',"'").replace('&amp;','&')
 
 
+class Cue:
+    """One caption: start and end (timedeltas), any cue settings after the end time (e.g. alignment), the text
+    and the frame - the text wrapped and encoded, ready to send (see compile_cue)"""
+    __slots__ = ('start', 'end', 'extra', 'text', 'frame')
+
+    def __init__(self, start, end, extra, text):
+        self.start = start
+        self.end = end
+        self.extra = extra
+        self.text = text
+        self.frame = None
+
+    def __repr__(self):
+        return 'Cue({}, {}, {!r})'.format(self.start, self.end, self.text)
+
+
+TIMING_LINE = re.compile(r'((?:[0-9]+:)?[0-9]{2}:[0-9]{2}[.,][0-9]{3})[ \t]+-->[ \t]+((?:[0-9]+:)?[0-9]{2}:[0-9]{2}[.,][0-9]{3})(.*)')
+
+def iter_lines(vttfile):
+    """Yields the lines of a utf-8 text file without their line endings. The file is memory mapped rather than read into memory"""
+    with open(vttfile, 'rb') as in_file:
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            first = True
+            for line in iter(mapped.readline, b''):
+                yield line.decode('utf-8-sig' if first else 'utf-8').rstrip('\r\n')
+                first = False
+
+def iter_caption_file(vttfile):
+    """Yields the (compiled) cues of a webvtt or srt file one at a time, as they are read. Cue identifiers, headers and notes are skipped"""
+    cue = None
+    text = []
+    for line in iter_lines(vttfile):
+        if cue is not None:
+            if line.strip():
+                text.append(line)
+                continue
+            cue.text = unescape('\n'.join(text).rstrip())
+            yield compile_cue(cue)
+            cue = None
+        match = TIMING_LINE.match(line)
+        if match:
+            tc_in, tc_out, vtt_extra_info = match.groups()
+            cue = Cue(to_timedelta(tc_in), to_timedelta(tc_out), vtt_extra_info, '')
+            text = []
+    if cue is not None:
+        cue.text = unescape('\n'.join(text).rstrip())
+        yield compile_cue(cue)
+
+@instrumentation.timed('push.read_caption_file')
 def read_caption_file(vttfile):
-    #https://stackoverflow.com/questions/48640490/python-2-7-matching-a-subtitle-events-in-vtt-subtitles-using-a-regular-expressi
-    regex = re.compile(r"""(^[0-9]{2}[:][0-9]{2}[:][0-9]{2}[.,][0-9]{3})   # match TC-IN in group1
-                             [ ]-->[ ]                                     # VTT/SRT style TC-IN--TC-OUT separator
-                             ([0-9]{2}[:][0-9]{2}[:][0-9]{2}[.,][0-9]{3})  # match TC-OUT n group2
-                             (.*)\r?\n([\s\S]*?)\s*(?:(?:\r?\n){2}|\Z) # additional VTT info (like) alignment
-                                                             
-                                                            # subtitle_content """, re.MULTILINE|re.VERBOSE)
-    
-    with open(vttfile, 'r', encoding = 'utf-8') as webvttFileObject:
-        vttcontent = webvttFileObject.read()
-    cues = []
-    for match in regex.finditer(vttcontent):
-        group1, group2, group3, group4 = match.groups()
-        tc_in = to_timedelta( group1.strip())
-        tc_out = to_timedelta( group2.strip())
-        vtt_extra_info = group3
-        text = group4
-        cue = dict()
-        cue = {'start': tc_in, 'end':tc_out,'extra':vtt_extra_info,'text': unescape(text)}
-        cues.append(cue)
-    return cues
+    """Returns a list of all of the cues of a webvtt or srt file"""
+    return list(iter_caption_file(vttfile))
 
 def select(cues, elapsed, cutoff):
-    result = [ c for c in cues if elapsed >= c['start'] and cutoff <  c['start'] ]
+    """Returns the cues that start after cutoff, up to and including elapsed. Scans every cue; use a CueSchedule for repeated selections"""
+    result = [ c for c in cues if elapsed >= c.start and cutoff <  c.start ]
     return result
-    
+
+class CueStream:
+    """Like a CueSchedule, for cues that are read as they are needed (e.g. from iter_caption_file), so that a long caption file is sent without
+    first reading all of it. The cues must be in start time order, as they are in a webvtt file; a cue that starts before the one before it is sent straight away.
+    Only seeks forwards"""
+    def __init__(self, cues):
+        self.cues = iter(cues)
+        self.next_cue = next(self.cues, None)
+        self.count = 0 # Cues taken from the stream so far, including any skipped by seek()
+
+    def advance(self):
+        cue = self.next_cue
+        self.next_cue = next(self.cues, None)
+        self.count += 1
+        return cue
+
+    def due(self, elapsed):
+        """Returns the cues not yet returned that start at or before elapsed"""
+        cues = []
+        while self.next_cue is not None and self.next_cue.start <= elapsed:
+            cues.append(self.advance())
+        return cues
+
+    def seek(self, t):
+        """Skips the cues that start before t"""
+        while self.next_cue is not None and self.next_cue.start < t:
+            self.advance()
+
+    def next_start(self):
+        """Returns the start time of the next cue, or None at the end of the stream"""
+        return self.next_cue.start if self.next_cue is not None else None
+
+class CueSchedule:
+    """The cues in start time order, with a cursor at the next cue to send.
+    due() returns the cues whose start time has been reached and moves the cursor past them, so each call costs only the cues it returns (plus a binary search).
+    seek() moves the cursor to any time, forwards or backwards, e.g. to jump to a different part of the broadcast"""
+    def __init__(self, cues):
+        self.cues = sorted(cues, key=lambda c: c.start)
+        self.starts = [c.start for c in self.cues]
+        self.position = 0
+
+    def due(self, elapsed):
+        """Returns the cues not yet returned that start at or before elapsed"""
+        end = bisect.bisect_right(self.starts, elapsed, self.position)
+        cues = self.cues[self.position:end]
+        self.position = end
+        return cues
+
+    def seek(self, t):
+        """Moves the cursor so that the next cue returned is the first cue starting at or after t"""
+        self.position = bisect.bisect_left(self.starts, t)
+
+    def next_start(self):
+        """Returns the start time of the next cue, or None if every cue has been returned"""
+        return self.starts[self.position] if self.position < len(self.starts) else None
+
+    def __len__(self):
+        return len(self.cues)
+
 def cue_start_end(cues):
     if len(cues) == 0:
-        return datetime.timedelta()
-    return cues[0]['start'], cues[-1]['end']
+        return datetime.timedelta(), datetime.timedelta()
+    return cues[0].start, max(c.end for c in cues)
+
+GREETING = "Captions by CT-Cast\n" # Sent once, when first connected to an encoder
+
+ROLLUP_CODE = b"\x14\x2D\x14\x70" # Carriage return, then move to the bottom row
+ROLLUP4_CODE = b"\x14\x27" # Roll-up captions, 4 rows
+
+def encoder_setup_codes(channel, greeting=''):
+    """Returns the control codes that select the caption field (channel 1 or 2) and 4 row roll-up captions, followed by the greeting text (if any)"""
+    fieldinsertmode = {'1' : b"\x01\x33\x0D" * 2, '2': b"\x01\x34\x0D" * 2 } [ str(channel)]
+    return fieldinsertmode + ROLLUP_CODE + fieldinsertmode + ROLLUP4_CODE + bytes(greeting, "iso-8859-1")
 
 def connect_encoder(host, port,channel):
-    if host and port and channel in '12':
+    if host and port and str(channel) in ('1', '2'):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((host, int(port))) # connect to link encoder using the specified credentials
-        fieldinsertmode = {'1' : b"\x01\x33\x0D" * 2, '2': b"\x01\x34\x0D" * 2 } [ str(channel)]
-        rollupcode = b"\x14\x2D\x14\x70"
-        s.sendall(fieldinsertmode + rollupcode)
-        text = bytes("Captions by CT-Cast\n", "iso-8859-1")
-        s.sendall(fieldinsertmode + rollupcode4 + text)
+        s.sendall(encoder_setup_codes(channel, GREETING))
         return s
     else:
         print("Dry run; host, port and channel must be specified")
         return None
 
+@instrumentation.timed('push.send_cues')
 def send_cues(cues, connection):
+    raw_text = cue_frames(cues)
+ 
+    if connection:
+        started = instrumentation.clock()
+        connection.sendall(raw_text)
+        if started is not None:
+            instrumentation.stop('push.socket_send', started)
+            instrumentation.count('push.bytes_sent', len(raw_text))
+    instrumentation.count('push.cues', len(cues))
+
+MAX_LEN = 32 # The width of a caption line, in characters
+
+def format_cue_text(text):
+    """Returns the text of a cue split into lines of at most 32 characters (the width of a caption line), each ending with a newline. Longer words are hyphenated.
+    Characters the encoder shows as several characters (e.g. '…' as '...') are replaced first, so that the lines fit as displayed"""
+    text = displayed_text(text)
     shortwords = []
-    for c in cues:
-        lines = c['text'].split('\n')
-        for line in lines:
-            words = line.split(' ')
-            print(c['start'], words)
-            # Cheap split
-            MAX_LEN = 32
-            for word in words:
-                while(len(word)):                
-                    if len(word) <= MAX_LEN:
-                        shortwords.append(word)
-                        break
-                    shortwords.append(word[0:MAX_LEN -1] + '-')
-                    word = word[MAX_LEN:]
-            shortwords.append('\n')
-    print()
+    for line in text.split('\n'):
+        words = line.split(' ')
+        # Cheap split
+        for word in words:
+            while(len(word)):                
+                if len(word) <= MAX_LEN:
+                    shortwords.append(word)
+                    break
+                shortwords.append(word[0:MAX_LEN -1] + '-')
+                word = word[MAX_LEN:]
+        shortwords.append('\n')
     lines = ['']
     for word in shortwords:
         if word == '\n':
@@ -94,45 +216,368 @@ def send_cues(cues, connection):
             lines[-1] = candidate
         else:
             lines.append(word)
-    one_line = '\n'.join(lines).replace('\n\n','\n')
-    #print('Raw text')
-    #print( one_line)
- 
-    if connection:
-        raw_text = bytes(one_line, "iso-8859-1")
-        connection.sendall(raw_text)
+    return '\n'.join(lines).replace('\n\n','\n')
+
+def format_cues(cues):
+    """Returns the text of the cues, split into lines of at most 32 characters"""
+    return ''.join(format_cue_text(c.text) for c in cues)
+
+# The encoder is sent iso-8859-1 text. Characters outside iso-8859-1 are sent as CEA-608 two byte character codes where there is one
+SPECIAL_CHARACTERS = {'\u2122': b'\x11\x34', '\u266a': b'\x11\x37'} # Trade mark sign and music note (the rest of the special characters are in iso-8859-1)
+# Extended characters replace the character before them; decoders without the extended set show that (standard) character instead
+EXTENDED_CHARACTERS = {'\u2018': b"'\x12\x26", '\u2019': b"'\x12\x29", '\u2014': b'-\x12\x2A', '\u2120': b'S\x12\x2C', '\u2022': b'.\x12\x2D',
+    '\u201c': b'"\x12\x2E', '\u201d': b'"\x12\x2F', '\u2502': b'|\x13\x37', '\u250c': b'+\x13\x3C', '\u2510': b'+\x13\x3D', '\u2514': b'+\x13\x3E', '\u2518': b'+\x13\x3F'}
+TEXT_REPLACEMENTS = {'\u2013': b'-', '\u2026': b'...', '\u201a': b',', '\u201e': b'"', '\u2032': b"'", '\u2033': b'"', '\u20ac': b'EUR'}
+
+def replacement_text(c):
+    """Returns the ascii bytes sent instead of a character that has no CEA-608 code: a replacement, or the character without its accents, or nothing"""
+    code = TEXT_REPLACEMENTS.get(c)
+    if code is None:
+        code = unicodedata.normalize('NFKD', c).encode('ascii', 'ignore')
+        if not code:
+            instrumentation.count('push.unsendable_characters')
+    return code
+
+def cea608_character(c):
+    """Returns the bytes to send for a character that is not in iso-8859-1. Characters without a CEA-608 code are sent as replacement_text"""
+    return SPECIAL_CHARACTERS.get(c) or EXTENDED_CHARACTERS.get(c) or replacement_text(c)
+
+def displayed_text(text):
+    """Returns the text with each character that is not shown as a single character (see replacement_text) replaced by what is shown instead.
+    An extended character (sent as a standard character followed by its code) takes one column, like the special characters"""
+    try:
+        text.encode('iso-8859-1')
+        return text
+    except UnicodeEncodeError:
+        pass
+    return ''.join(c if ord(c) < 256 or c in SPECIAL_CHARACTERS or c in EXTENDED_CHARACTERS else replacement_text(c).decode('ascii') for c in text)
+
+def cea608_errors(error):
+    """Encoding error handler (see codecs.register_error) for characters that are not in iso-8859-1"""
+    if not isinstance(error, UnicodeEncodeError):
+        raise error
+    return b''.join(cea608_character(c) for c in error.object[error.start:error.end]), error.end
+
+codecs.register_error('cea608', cea608_errors)
+
+def encode_caption_text(text):
+    return text.encode('iso-8859-1', 'cea608')
+
+def compile_cue(cue):
+    """Adds the cue's 'frame' - its text as wrapped and encoded for the encoder - so that nothing but writing is left to do when the cue is due"""
+    cue.frame = encode_caption_text(format_cue_text(cue.text))
+    return cue
+
+def cue_frames(cues):
+    """Returns the bytes to send for the cues (compiling any cue that has not been)"""
+    return b''.join(c.frame if c.frame is not None else compile_cue(c).frame for c in cues)
+
+
+class LatenessStats:
+    """How late cues (or sends of cues) were, in seconds after their scheduled time"""
+    def __init__(self, unit='cues'):
+        self.unit = unit
+        self.values = []
+
+    def add(self, seconds):
+        self.values.append(seconds)
+
+    def summary(self):
+        if not self.values:
+            return 'no ' + self.unit
+        values = sorted(self.values)
+        percentile = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+        return '{} {}, mean {:.1f} ms, median {:.1f} ms, 95% {:.1f} ms, max {:.1f} ms late'.format(
+            len(values), self.unit, 1000 * sum(values) / len(values), 1000 * percentile(0.5), 1000 * percentile(0.95), 1000 * values[-1])
+
+
+CONNECT_TIMEOUT_S = 5 # Give up on a connection attempt after this long and try again
+WRITE_TIMEOUT_S = 10 # An encoder that has not accepted a write for this long is treated as disconnected
+RECONNECT_DELAYS_S = (0.5, 1, 2, 4, 8) # Wait between failed connection attempts; the last delay is repeated
+MAX_PENDING = 100 # Most sends queued for one encoder; the oldest are dropped first
+DEFAULT_LATENCY_BUDGET_S = 3.0 # Cues not sent within this many seconds of their start time are dropped rather than shown late
+
+class AsyncEncoder:
+    """A connection to one caption encoder channel, for push_schedule.
+    send() only queues the text; a background task writes it, so a slow or disconnected encoder never holds up the scheduler (or the other encoders).
+    Everything queued while the previous write was in progress is sent as one write. If the connection is lost the task reconnects
+    (re-sending the field and roll-up control codes), and queued cues older than the latency budget are dropped instead of being sent late.
+    Records how late each write was fully sent, how many cues were dropped and how many times the encoder was reconnected"""
+    def __init__(self, host, port, channel, latency_budget=DEFAULT_LATENCY_BUDGET_S):
+        self.host = host
+        self.port = int(port)
+        self.channel = str(channel)
+        self.name = '{}:{} channel {}'.format(host, port, channel)
+        self.latency_budget = latency_budget # None never drops cues
+        self.pending = collections.deque() # (raw_text, due, number of cues)
+        self.wakeup = None
+        self.task = None
+        self.watch_task = None # Notices the encoder closing the current connection
+        self.writer = None
+        self.closing = False
+        self.connections = 0
+        self.failures = 0 # Failed connection attempts since the last connection
+        self.lateness = LatenessStats('sends')
+        self.dropped = 0
+        self.reconnects = 0
+
+    def start(self):
+        """Starts the task that connects and sends the queued text. Must be called from a running event loop"""
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def send(self, raw_text, due, cue_count=1):
+        """Queues the text to be sent; due is the (event loop clock) time it was scheduled for. Returns immediately"""
+        self.pending.append((raw_text, due, cue_count))
+        if len(self.pending) > MAX_PENDING:
+            self.drop(self.pending.popleft()[2])
+        self.wakeup.set()
+
+    async def close(self):
+        """Sends (or drops) whatever is still queued, then disconnects"""
+        self.closing = True
+        if self.task:
+            self.wakeup.set()
+            await self.task
+        if self.watch_task:
+            self.watch_task.cancel()
+            await asyncio.gather(self.watch_task, return_exceptions=True)
+
+    def drop(self, cue_count):
+        self.dropped += cue_count
+        instrumentation.count('push.cues_dropped', cue_count)
+
+    def take_pending(self):
+        """Removes the queued text and returns it as one write, with the due time of the oldest part. Text past the latency budget is dropped"""
+        now = asyncio.get_running_loop().time()
+        parts = []
+        due = None
+        while self.pending:
+            raw_text, part_due, cue_count = self.pending.popleft()
+            if self.latency_budget is not None and now - part_due > self.latency_budget:
+                self.drop(cue_count)
+                continue
+            parts.append(raw_text)
+            if due is None:
+                due = part_due
+        return b''.join(parts), due
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if self.writer is None:
+                    if self.closing and not self.pending:
+                        break
+                    if not await self.connect():
+                        if self.closing:
+                            # Do not keep retrying once the broadcast is over
+                            self.drop(sum(cue_count for _, _, cue_count in self.pending))
+                            self.pending.clear()
+                            break
+                        continue
+                if not self.pending:
+                    if self.closing:
+                        break
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                raw_text, due = self.take_pending()
+                if not raw_text:
+                    continue
+                writer = self.writer
+                try:
+                    writer.write(raw_text)
+                    await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT_S)
+                except (OSError, asyncio.TimeoutError) as e:
+                    # How much of the text reached the encoder is unknown; it is not sent again, so that captions are not repeated
+                    self.disconnect(writer, 'write failed ({})'.format(e or 'timed out'))
+                    continue
+                self.lateness.add(loop.time() - due)
+                instrumentation.count('push.bytes_sent', len(raw_text))
+        finally:
+            self.disconnect(self.writer)
+
+    async def connect(self):
+        """Connects and sends the control codes. Returns False if the attempt failed, after waiting before the next attempt"""
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT_S)
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Writes are already batched
+            writer.write(encoder_setup_codes(self.channel, '' if self.connections else GREETING))
+            await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT_S)
+        except (OSError, asyncio.TimeoutError) as e:
+            delay = RECONNECT_DELAYS_S[min(self.failures, len(RECONNECT_DELAYS_S) - 1)]
+            self.failures += 1
+            instrumentation.count('push.connect_failures')
+            if not self.closing:
+                print('{}: cannot connect ({}), retrying in {} s'.format(self.name, e or 'timed out', delay))
+                await asyncio.sleep(delay)
+            return False
+        if self.connections:
+            self.reconnects += 1
+            instrumentation.count('push.reconnects')
+            print('{}: reconnected'.format(self.name))
+        self.connections += 1
+        self.failures = 0
+        self.writer = writer
+        if self.watch_task:
+            self.watch_task.cancel() # The previous connection's, in case it has not finished yet
+        self.watch_task = asyncio.create_task(self.watch(reader, writer))
+        return True
+
+    async def watch(self, reader, writer):
+        """Reads (and ignores) anything the encoder sends, to notice as soon as it closes the connection"""
+        try:
+            while await reader.read(4096):
+                pass
+        except OSError:
+            pass
+        self.disconnect(writer, 'connection closed by the encoder')
+
+    def disconnect(self, writer, reason=None):
+        if writer is None or writer is not self.writer:
+            return
+        self.writer = None
+        writer.close()
+        if reason and not self.closing:
+            print('{}: {}'.format(self.name, reason))
+        self.wakeup.set()
+
+
+class CueScheduler:
+    """Sends the cues of a CueSchedule (or CueStream), from start_at onwards, to all of the encoders at their start times.
+    speed_factor > 1 plays the captions faster than real time. The scheduler sleeps until the next cue is due, timed by the (monotonic) event loop clock.
+    Each encoder sends in the background (see AsyncEncoder), so a slow or disconnected encoder does not delay the others.
+    seek() jumps to another time while the captions are being sent (only forwards with a CueStream)"""
+    def __init__(self, schedule, encoders, speed_factor=1, start_at=datetime.timedelta()):
+        self.schedule = schedule
+        self.encoders = encoders
+        self.speed_factor = speed_factor
+        self.start_at = start_at
+        self.started = None # Event loop time at which start_at was (or is to be) sent
+        self.lateness = LatenessStats() # How late each cue was taken from the schedule
+        self.wake = None
+
+    def due_time(self, t):
+        return self.started + (t - self.start_at).total_seconds() / self.speed_factor
+
+    def seek(self, t):
+        """Continues the captions from time t (a timedelta), as if the broadcast had started there now. Call from the event loop's thread"""
+        self.start_at = t
+        self.started = asyncio.get_running_loop().time()
+        self.schedule.seek(t)
+        if self.wake is not None:
+            self.wake.set() # The next cue is now a different one
+
+    async def run(self):
+        """Sends the cues until the end of the schedule. Returns the LatenessStats of the scheduler"""
+        loop = asyncio.get_running_loop()
+        for encoder in self.encoders:
+            encoder.start()
+        self.wake = asyncio.Event()
+        self.seek(self.start_at)
+        try:
+            while True:
+                next_start = self.schedule.next_start()
+                if next_start is None:
+                    break
+                delay = self.due_time(next_start) - loop.time()
+                if delay > 0:
+                    self.wake.clear()
+                    try:
+                        await asyncio.wait_for(self.wake.wait(), delay)
+                        continue # seek() was called
+                    except asyncio.TimeoutError:
+                        pass
+                now = loop.time()
+                # The event loop may wake a little early (within its clock resolution) - the next cue is due regardless
+                elapsed = max(next_start, self.start_at + datetime.timedelta(seconds=(now - self.started) * self.speed_factor))
+                cues = self.schedule.due(elapsed)
+                for cue in cues:
+                    self.lateness.add(now - self.due_time(cue.start))
+                    print(cue.start, cue.text.replace('\n', ' / '))
+                raw_text = cue_frames(cues)
+                instrumentation.count('push.cues', len(cues))
+                for encoder in self.encoders:
+                    encoder.send(raw_text, self.due_time(cues[0].start), len(cues))
+        finally:
+            await asyncio.gather(*(encoder.close() for encoder in self.encoders))
+        return self.lateness
+
+
+async def push_schedule(schedule, encoders, speed_factor=1, start_at=datetime.timedelta(), commands=None):
+    """Sends every cue of the schedule to the encoders at its start time (see CueScheduler). Returns the LatenessStats of the scheduler.
+    If commands is given (e.g. sys.stdin) each line read from it is a time (see to_timedelta_arg) to jump to"""
+    scheduler = CueScheduler(schedule, encoders, speed_factor, start_at)
+    if commands is not None:
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=read_seek_commands, args=(commands, loop, scheduler), name='SeekCommands', daemon=True).start()
+    return await scheduler.run()
+
+def read_seek_commands(commands, loop, scheduler):
+    """Reads operator commands (one time per line) and passes them to the scheduler in the event loop"""
+    for line in commands:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            t = to_timedelta_arg(line)
+        except ValueError:
+            print(f"Expected a time to jump to (HH:MM:SS, MM:SS or seconds), got {line!r}", file=sys.stderr)
+            continue
+        print(f"Jumping to {t}")
+        loop.call_soon_threadsafe(scheduler.seek, t)
+
+
+def parse_encoder(spec):
+    """Parses HOST:PORT or HOST:PORT:CHANNEL (channel 1 or 2, default 1)"""
+    parts = spec.split(':')
+    if len(parts) not in (2, 3) or not parts[1].isdigit() or (len(parts) == 3 and parts[2] not in ('1', '2')):
+        raise argparse.ArgumentTypeError('expected HOST:PORT or HOST:PORT:CHANNEL (channel 1 or 2), got ' + spec)
+    return AsyncEncoder(parts[0], parts[1], parts[2] if len(parts) == 3 else '1')
+
+def to_timedelta_arg(t):
+    """Parses a start time given as HH:MM:SS, MM:SS or seconds"""
+    seconds = 0.0
+    for part in t.split(':'):
+        seconds = seconds * 60 + float(part)
+    return datetime.timedelta(seconds=seconds)
     
 def main():
-    vttfilename = 'ex.vtt'
-    dry_run = True
-    speed_factor = 2
-    
-    channel = 1
-    host = None
-    port = None
+    parser = argparse.ArgumentParser(description='Sends the captions of a vtt (or srt) file to caption encoders in real time, as each caption is due')
+    parser.add_argument('vtt_file', nargs='?', default='ex.vtt')
+    parser.add_argument('--encoder', action='append', default=[], type=parse_encoder, metavar='HOST:PORT[:CHANNEL]',
+        help='caption encoder to send to (channel 1 or 2, default 1). May be repeated to drive several encoders or channels. Without an encoder this is a dry run')
+    parser.add_argument('--speed', type=float, default=1, help='speed factor e.g. 2 sends the captions twice as fast as real time (default: 1)')
+    parser.add_argument('--latency-budget', type=float, default=DEFAULT_LATENCY_BUDGET_S, metavar='SECONDS',
+        help='drop cues that cannot be sent to an encoder within this many seconds of their start time, e.g. while reconnecting (default: %(default)s; 0 never drops cues)')
+    parser.add_argument('--start', type=to_timedelta_arg, default=datetime.timedelta(), help='start part way through the captions, at HH:MM:SS')
+    parser.add_argument('--seek-input', action='store_true',
+        help='while sending, read times (HH:MM:SS, MM:SS or seconds) from standard input and jump to each one, forwards or backwards. The whole caption file is read first')
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    if args.latency_budget < 0:
+        parser.error('--latency-budget must not be negative')
+    for encoder in args.encoder:
+        encoder.latency_budget = args.latency_budget or None
 
-    all_cues = read_caption_file(vttfilename)
-    
-    first_cue_at,cues_finish_at = cue_start_end(all_cues)
-    print(f"{len(all_cues)} cues read. First queue at {first_cue_at}, ending at {cues_finish_at}")
+    if not args.encoder:
+        print("Dry run; no encoder specified")
 
-    connection = connect_encoder(host,port, channel)
-    
-    previous_elapsed = datetime.timedelta(seconds = -1)
-    start_clock_time = datetime.datetime.now()
-
-    while(True):
-        elapsed = datetime.datetime.now() - start_clock_time
-        elapsed *= speed_factor
-        if elapsed >= cues_finish_at:
-            break
-            
-        cues = select(all_cues, elapsed, previous_elapsed)
-        previous_elapsed = elapsed
-        if len(cues) > 0:
-            send_cues(cues, connection)
-        time.sleep(1)
-    print("Finished")
+    if args.seek_input:
+        # Jumping back needs all of the cues
+        schedule = CueSchedule(read_caption_file(args.vtt_file))
+    else:
+        # The cues are read as they are needed, so that sending starts straight away even for a day long caption file
+        schedule = CueStream(iter_caption_file(args.vtt_file))
+    lateness = asyncio.run(push_schedule(schedule, args.encoder, args.speed, args.start, sys.stdin if args.seek_input else None))
+    print(f"Finished; {len(schedule) if args.seek_input else schedule.count} cues read")
+    print("Scheduling:", lateness.summary())
+    for encoder in args.encoder:
+        print(f"{encoder.name}: {encoder.lateness.summary()}; {encoder.dropped} cues dropped, {encoder.reconnects} reconnections")
 
 if __name__ == '__main__':
     main()
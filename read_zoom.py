@@ -21,15 +21,30 @@ import os
 import sys
 import re
 import datetime
+import contextlib
+import collections
+import concurrent.futures
+import csv
+import json
+import argparse
+import time
+
+# The caption timestamp formatting is shared with the transcribe-cli tools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcribe-cli"))
+from caption_timestamps import clock_timestamp
+
+
+clock_separator = re.compile(r"[:]+")
 
 
 def to_timedelta(t):
-    remain = ""
-    if " " in t:
-        t, remain = t.split(" ", 1)
-    timept = re.split(r"[:]+", t, 3)
-    h, m, s = list(map(int, timept))
-    return datetime.timedelta(hours=h, minutes=m, seconds=s), remain
+    t, _, remain = t.partition(" ")
+    try:
+        h, m, s = map(int, t.split(":"))
+    except ValueError:
+        # e.g. a doubled colon
+        h, m, s = map(int, clock_separator.split(t, 3))
+    return datetime.timedelta(seconds=h * 3600 + m * 60 + s), remain
 
 # We have to manually specify how long the last caption should be displayed for
 last_caption_duration = datetime.timedelta(seconds=2)
@@ -43,20 +58,44 @@ skip_long_gap_threshold = datetime.timedelta(minutes=5)
 # Long gaps are replaced with this duration
 shortened_gap_duration = datetime.timedelta(seconds=1)
 
+# The settings above, for one conversion (e.g. each file of a bulk conversion can have its own gap settings)
+ZoomSettings = collections.namedtuple(
+    "ZoomSettings",
+    ["last_caption_duration", "min_display_time", "skip_long_gap_threshold", "shortened_gap_duration"],
+)
+
+
+def default_settings():
+    """Returns the current module settings as ZoomSettings"""
+    return ZoomSettings(last_caption_duration, min_display_time, skip_long_gap_threshold, shortened_gap_duration)
+
+
+
+# Output files are written through a buffer of this size
+output_buffer_size = 1 << 16
+
+
+def iter_file_lines(filename):
+    """Reads the text file as utf-8 and yields its lines one at a time, dropping all newline and CR characters"""
+    with open(filename, "r", encoding="utf-8") as f:
+        # Text mode has already turned CRLF (and any lone CR) into a newline
+        for line in f:
+            yield line.rstrip("\n")
 
 
 def read_file_as_lines(filename):
     """Reads the text file as utf-8 and returns an array of lines, dropping all newline and CR characters"""
-    with open(filename, "r", encoding="utf-8") as f:
-        filelines = [line.replace("\r", "").rstrip("\n") for line in f.readlines()]
-    return filelines
+    return list(iter_file_lines(filename))
 
 
-def parse(rawlines, starting_time):
-    """Parses Zoom transcriptions. Lines may start with a timestamp - the current time. The general plan is to build up the current caption line and append it to the list of captions parsed so far. The starting_time allows captions to be offset from the video recording."""
-    captions = []
+def iter_captions(rawlines, starting_time, settings=None, log=print):
+    """Parses Zoom transcriptions, yielding each caption as soon as the start of the next one is read. The lines can be any iterable e.g. iter_file_lines.
+    Lines may start with a timestamp - the current time. The text of the current caption is collected as a list of its lines.
+    The starting_time allows captions to be offset from the video recording; captions before the starting_time are skipped.
+    settings are ZoomSettings (default: the module settings). Each long gap that is shortened is reported by calling log with a message."""
+    settings = settings or default_settings()
     start = None
-    text = None
+    parts = None
 
     for line in rawlines:
         if len(line) == 0:
@@ -67,17 +106,17 @@ def parse(rawlines, starting_time):
                 starting_time = newstart
             newstart -= starting_time
 
-            if text is not None and len(text) > 0:
+            if parts:
                 duration = newstart - start
                 if (
-                    duration >= skip_long_gap_threshold
+                    duration >= settings.skip_long_gap_threshold
                     and newstart.total_seconds() >= 0
                 ):
-                    adjusted_duration = shortened_gap_duration
+                    adjusted_duration = settings.shortened_gap_duration
                     time_shift = duration - adjusted_duration
-                    print(
+                    log(
                         f"Timeshifting by {time_shift} long gap at input {newstart + starting_time}. {duration}-> {adjusted_duration} duration. {newstart} back to {newstart - time_shift} "
-                        + text.replace("\n", " ")[:40]
+                        + " ".join(parts)[:40]
                     )
                     duration = adjusted_duration
                     starting_time += time_shift
@@ -88,69 +127,314 @@ def parse(rawlines, starting_time):
                 # To prevent this we require captions to be displayed for a minimun time
                 # delaying the start of the next caption by the same amount
                 # Future Alternative: Concatenate the caption lines together into a single cue if both are single line
-                if duration < min_display_time:
-                    duration = min_display_time
+                if duration < settings.min_display_time:
+                    duration = settings.min_display_time
 
-                captions.append({"start": start, "end": start + duration, "text": text})
+                if start.total_seconds() >= 0:
+                    yield {"start": start, "end": start + duration, "text": "\n".join(parts)}
             start = newstart
-            text = newtext.strip()
+            newtext = newtext.strip()
+            parts = [newtext] if newtext else []
 
         else:
             assert start is not None
             line = line.strip()
             if len(line) > 0:
-                text += ("\n" if len(text) > 0 else "") + line
-    if text:
-        captions.append(
-            {"start": start, "end": start + last_caption_duration, "text": text}
-        )
+                parts.append(line)
+    if parts and start.total_seconds() >= 0:
+        yield {"start": start, "end": start + settings.last_caption_duration, "text": "\n".join(parts)}
+
+
+def parse(rawlines, starting_time, settings=None, log=print):
+    """Parses Zoom transcriptions and returns the list of captions (see iter_captions)"""
+    return list(iter_captions(rawlines, starting_time, settings, log))
 
-    captions = [c for c in captions if c["start"].total_seconds() >= 0]
-    return captions
+
+def to_ms(t):
+    return (t.days * 86400 + t.seconds) * 1000 + t.microseconds // 1000
 
 
 def toCueTime(t, sep=","):
     """Return a srt or vtt timestamp string e.g. 12:34:56,000 (srt) 12:34:56.000 (vtt)"""
-    s = int(t.seconds)
-    assert s >= 0
-    milli = int(1000 * (t.seconds - s))
-    return f"{s//3600:02}:{s//60%60:02}:{s%60:02}{sep}{milli:03}"
+    return clock_timestamp(to_ms(t), sep)
 
 
-def export(out, captions, output_format="srt"):
-    """Saves the parsed captions in various formats to the given output stream"""
-    if output_format == "srt":
-        sep = ","
-    elif output_format == "vtt":
-        sep = "."
-        print("WEBVTT\nKind: captions\nLanguage: en\n", file=out)
-    else:
-        raise Exception(f"Expected format of vtt or srt, got:{output_format}")
+vtt_header = "WEBVTT\nKind: captions\nLanguage: en\n\n"
+
 
+def export_all(outputs, captions):
+    """Saves the parsed captions in one or more formats in a single pass through the captions. outputs is a dict of format (srt or vtt) -> output stream. Returns the number of captions"""
+    for output_format in outputs:
+        if output_format not in ("srt", "vtt"):
+            raise Exception(f"Expected format of vtt or srt, got:{output_format}")
+    srt, vtt = outputs.get("srt"), outputs.get("vtt")
+    if vtt:
+        vtt.write(vtt_header)
+
+    count = 0
     for idx, cue in enumerate(captions, start=1):
-        start, end = toCueTime(cue["start"], sep), toCueTime(cue["end"], sep)
         text = cue["text"]
+        if "&" in text or "<" in text or ">" in text:
+            text = text.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+        # The cue is formatted once; the vtt timestamps only differ by their millisecond separator (the first two commas)
+        cue_text = f"{toCueTime(cue['start'])} --> {toCueTime(cue['end'])}\n{text}\n\n"
+        if srt:
+            srt.write(f"{idx}\n{cue_text}")
+        if vtt:
+            vtt.write(cue_text.replace(",", ".", 2))
+        count = idx
+    return count
+
+
+def export(out, captions, output_format="srt"):
+    """Saves the parsed captions in various formats to the given output stream"""
+    export_all({output_format: out}, captions)
+
+
+def convert(input_file, output_files, starting_time=None, settings=None, log=print):
+    """Converts a Zoom transcript, reading, parsing and writing one caption at a time. output_files is a dict of format (srt or vtt) -> file name.
+    Returns the number of captions"""
+    captions = iter_captions(iter_file_lines(input_file), starting_time, settings, log)
+    with contextlib.ExitStack() as stack:
+        outputs = {
+            output_format: stack.enter_context(open(output_file, "w", encoding="utf-8", buffering=output_buffer_size))
+            for output_format, output_file in output_files.items()
+        }
+        return export_all(outputs, captions)
+
+
+def output_files_for(input_file):
+    """Returns the srt and vtt file names for a transcript e.g. zoom1.txt -> zoom1.srt and zoom1.vtt"""
+    return {output_format: input_file.rsplit(".", 1)[0] + "." + output_format for output_format in ["srt", "vtt"]}
+
 
-        text = text.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+# Bulk conversion: every transcript in a directory, with optional per-file settings from a manifest, using a pool of worker processes
 
-        if output_format == "srt":
-            print(idx, file=out)
+# Default file names, in the transcript directory
+conversion_record_name = "zoom_conversions.json"
+timeshift_report_name = "timeshift_report.txt"
 
-        print(f"{start} --> {end}", file=out)
-        print(text, file=out)
-        print("", file=out)
+manifest_columns = ["file", "start", "skip_long_gap_threshold", "shortened_gap_duration"]
+
+
+def to_duration(value):
+    """Parses a duration from a manifest - seconds (e.g. 300) or HH:MM:SS"""
+    if isinstance(value, (int, float)):
+        return datetime.timedelta(seconds=value)
+    if ":" in value:
+        return to_timedelta(value.strip())[0]
+    return datetime.timedelta(seconds=float(value))
+
+
+def read_manifest(filename):
+    """Reads a bulk conversion manifest and returns a dict of transcript file (relative to the transcript directory) -> (starting_time or None, ZoomSettings).
+    A .csv manifest has a header row with the columns file, start (HH:MM:SS), skip_long_gap_threshold and shortened_gap_duration (seconds or HH:MM:SS).
+    A .json manifest is a list of objects with the same keys, or an object of file -> object of the other keys.
+    Only file is required; missing or empty values use the default (no starting time, the module's gap settings)."""
+    if filename.lower().endswith(".csv"):
+        with open(filename, "r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+    else:
+        with open(filename, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = [dict(row, file=name) for name, row in rows.items()]
+
+    defaults = default_settings()
+    files = {}
+    for row in rows:
+        unknown = set(row) - set(manifest_columns)
+        if unknown or not row.get("file"):
+            raise ValueError(f"Manifest '{filename}': expected the keys {', '.join(manifest_columns)} (file is required), got {row}")
+        start = row.get("start")
+        if start not in (None, "") and not isinstance(start, str):
+            raise ValueError(f"Manifest '{filename}': start must be a HH:MM:SS time, got {start!r} for {row['file']}")
+        try:
+            starting_time = to_timedelta(start.strip())[0] if start else None
+        except ValueError:
+            raise ValueError(f"Manifest '{filename}': start must be a HH:MM:SS time, got {start!r} for {row['file']}") from None
+        settings = defaults._replace(**{name: to_duration(row[name]) for name in ZoomSettings._fields if row.get(name) not in (None, "")})
+        files[os.path.normpath(row["file"])] = (starting_time, settings)
+    return files
+
+
+def find_transcripts(directory):
+    """Returns the .txt files (relative to the directory) anywhere inside the directory, except the timeshift report"""
+    transcripts = []
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        transcripts.extend(
+            os.path.relpath(os.path.join(root, f), directory)
+            for f in sorted(filenames)
+            if f.endswith(".txt") and f != timeshift_report_name
+        )
+    return transcripts
+
+
+class ConversionRecord:
+    """On-disk record of the transcripts converted by a bulk conversion, so that later conversions can skip transcripts that are already up to date.
+    Each transcript (relative to the transcript directory) has an entry with its output files, settings, number of captions and the long gaps shortened"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(filename):
+            with open(filename, "r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("files", {})
+
+    def update(self, name, entry):
+        self.entries[name] = entry
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        # Write then rename, so a crash never leaves a half written record
+        temp_file = self.filename + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump({"files": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(temp_file, self.filename)
+        self.changed = False
+
+
+def conversion_settings(starting_time, settings):
+    """The starting time and settings of a conversion as a json list, recorded so that a later bulk conversion can tell whether they changed"""
+    return [None if starting_time is None else starting_time.total_seconds()] + [t.total_seconds() for t in settings]
+
+
+def is_up_to_date(input_file, output_files, entry, recorded):
+    """True if the entry recorded by the last bulk conversion shows the output files were made from this transcript with the same settings, and are newer than it.
+    recorded is the outputs and settings that this conversion would record"""
+    if not entry or any(entry.get(key) != value for key, value in recorded.items()):
+        return False
+    if not all(os.path.exists(output_file) for output_file in output_files.values()):
+        return False
+    input_mtime = os.stat(input_file).st_mtime
+    return all(os.stat(output_file).st_mtime >= input_mtime for output_file in output_files.values())
+
+
+def bulk_convert_file(task):
+    """Bulk worker - converts one transcript unless its output is up to date. Returns (status, entry or error message, number of captions)"""
+    directory, name, starting_time, settings, entry, force = task
+    input_file = os.path.join(directory, name)
+    output_files = output_files_for(input_file)
+    # Recorded relative to the directory, so the record still applies however the directory is given (or if it is moved)
+    recorded = {"outputs": output_files_for(name), "settings": conversion_settings(starting_time, settings)}
+    try:
+        if not force and is_up_to_date(input_file, output_files, entry, recorded):
+            return "skipped", entry, 0
+
+        # Write to temporary files first, so an interrupted conversion never leaves partial output that looks up to date
+        temp_files = {output_format: output_file + ".tmp" for output_format, output_file in output_files.items()}
+        timeshifts = []
+        count = convert(input_file, temp_files, starting_time, settings, timeshifts.append)
+        for output_format, output_file in output_files.items():
+            os.replace(temp_files[output_format], output_file)
+
+        entry = dict(recorded, captions=count, timeshifts=timeshifts)
+        return "converted", entry, count
+    except Exception as err:
+        for output_file in output_files.values():
+            if os.path.exists(output_file + ".tmp"):
+                os.remove(output_file + ".tmp")
+        return "failed", f"{type(err).__name__}: {err}", 0
+
+
+def write_timeshift_report(out, transcripts, record):
+    """Writes the long gaps shortened in each transcript, as recorded by the bulk conversion. Returns the number of transcripts with long gaps"""
+    files = 0
+    for name in transcripts:
+        timeshifts = record.entries.get(name, {}).get("timeshifts")
+        if timeshifts:
+            files += 1
+            out.write(f"{name}\n")
+            for message in timeshifts:
+                out.write(f"    {message}\n")
+            out.write("\n")
+    return files
+
+
+def bulk_convert(directory, manifest_file=None, workers=None, force=False, record_file=None, report_file=None):
+    """Converts every transcript in the directory using a pool of worker processes, skipping transcripts whose srt and vtt files are up to date.
+    Returns a dict of counts"""
+    manifest = read_manifest(manifest_file) if manifest_file else {}
+    record = ConversionRecord(record_file or os.path.join(directory, conversion_record_name))
+    transcripts = find_transcripts(directory)
+    found = set(transcripts)
+    for name in manifest:
+        if name not in found:
+            print(f"Manifest file '{name}' not found in '{directory}'", file=sys.stderr)
+
+    defaults = (None, default_settings())
+    tasks = []
+    for name in transcripts:
+        starting_time, settings = manifest.get(name, defaults)
+        tasks.append((directory, name, starting_time, settings, record.entries.get(name), force))
+
+    counts = {"converted": 0, "skipped": 0, "failed": 0, "captions": 0}
+    workers = workers or os.cpu_count() or 1
+    # Transcripts are small, so each worker is sent several at a time
+    chunksize = max(1, min(32, len(tasks) // (workers * 8)))
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        try:
+            for task, (status, result, captions) in zip(tasks, executor.map(bulk_convert_file, tasks, chunksize=chunksize)):
+                counts[status] += 1
+                counts["captions"] += captions
+                if status == "failed":
+                    print(f"{os.path.join(directory, task[1])} failed: {result}", file=sys.stderr)
+                elif status == "converted":
+                    record.update(task[1], result)
+        finally:
+            record.save()
+
+    with open(report_file or os.path.join(directory, timeshift_report_name), "w", encoding="utf-8") as out:
+        counts["timeshifted"] = write_timeshift_report(out, transcripts, record)
+    return counts
+
+
+def bulk_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f"{sys.argv[0]} bulk",
+        description="Converts every Zoom transcript (.txt) in a directory to srt and vtt, using several processes. "
+        "Transcripts whose srt and vtt files are already up to date are skipped. The long gaps shortened in every transcript are collected into one report.",
+    )
+    parser.add_argument("directory", help="directory that is searched (recursively) for .txt transcripts")
+    parser.add_argument("--manifest", help="csv or json file of per-transcript settings: file, start (HH:MM:SS), skip_long_gap_threshold and shortened_gap_duration (seconds or HH:MM:SS)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="convert every transcript, even if its output is up to date")
+    parser.add_argument("--report", help=f"timeshift report file (default: {timeshift_report_name} in the directory)")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if not os.path.isdir(args.directory):
+        parser.error(f"'{args.directory}' is not a directory")
+
+    started = time.monotonic()
+    try:
+        counts = bulk_convert(args.directory, args.manifest, args.workers, args.force, report_file=args.report)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 3
+    elapsed = time.monotonic() - started
+    print(f"{counts['converted']} converted, {counts['skipped']} already up to date, {counts['failed']} failed in {elapsed:.1f} seconds")
+    print(f"{counts['timeshifted']} transcripts had long gaps shortened; see {args.report or os.path.join(args.directory, timeshift_report_name)}")
+    return 2 if counts["failed"] else 0
 
 
 def usage():
     usage = """Example usage: python3 NAME '08:02:33' zoom1.txt
     Will generate an output file zoom1.vtt
-    srt output format is also supported"""
+    srt output format is also supported
+    To convert every transcript in a directory: python3 NAME bulk DIRECTORY [--manifest settings.csv] (see python3 NAME bulk --help)"""
 
     print(usage.replace("NAME", sys.argv[0]))
 
 
 def main():
     """Main entry point"""
+    if len(sys.argv) > 1 and sys.argv[1] == "bulk":
+        return bulk_main(sys.argv[2:])
     if len(sys.argv) not in [2, 3]:
         usage()
         return 1
@@ -179,18 +463,13 @@ def main():
     #    print(f"Skipping '{input_file}'; '{output_file}' already exists")
     #    return 4
 
-    raw_lines = read_file_as_lines(input_file)
-    captions = parse(raw_lines, starting_time)
-
-    for output_format in ["srt", "vtt"]:
-        output_file = input_file.rsplit(".", 1)[0] + "." + output_format
+    output_files = output_files_for(input_file)
+    for output_format, output_file in output_files.items():
         assert output_file != input_file
-
         print(f"Writing {output_format} to '{output_file}'")
-        with open(output_file, "w", encoding="utf-8") as out:
-            export(out, captions, output_format)
+    count = convert(input_file, output_files, starting_time)
 
-    print(f"{len(captions)} captions written")
+    print(f"{count} captions written")
     return 0
 
 
@@ -0,0 +1,35 @@
+# The tools are scripts rather than a package: push_vtt_file and read_zoom at the top level, the rest in transcribe-cli
+import array
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'transcribe-cli'))
+sys.path.insert(0, ROOT)
+
+import pcm_audio
+
+
+def write_speech_wav(filename, parts):
+    """Saves a 16KHz mono wav of (kind, ms) parts: 's' is speech (a loud square wave), anything else near silence"""
+    samples = array.array('h')
+    for kind, ms in parts:
+        n = ms * pcm_audio.SAMPLE_RATE // 1000
+        samples.extend(array.array('h', [3000, -3000] if kind == 's' else [4, -4]) * (n // 2))
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    pcm_audio.write_wav(filename, samples.tobytes())
+
+
+def lecture_parts(minutes, seed=1):
+    """Returns write_speech_wav parts for a lecture-like recording: words with short gaps, pauses and a few long silences"""
+    import random
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < minutes * 60 * 1000:
+        for _ in range(rng.randint(2, 8)):
+            parts += [('s', rng.randint(150, 600)), ('q', rng.choice((80, 200, 400)))]
+        parts.append(('q', rng.choice((600, 1500, 4000, 9000, 30000))))
+        total = sum(ms for _, ms in parts)
+    return parts
@@ -0,0 +1,115 @@
+# push_vtt_file.AsyncEncoder against a local TCP server standing in for the caption encoder
+import asyncio
+
+import push_vtt_file
+from push_vtt_file import AsyncEncoder, GREETING, encoder_setup_codes
+
+
+class FakeEncoder:
+    """Records what is received on each connection. close_after closes a connection once that many bytes have arrived on it"""
+    def __init__(self, close_after=None):
+        self.connections = []
+        self.close_after = close_after
+        self.received = asyncio.Condition()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        data = bytearray()
+        self.connections.append(data)
+        while True:
+            chunk = await reader.read(4096)
+            if not chunk:
+                break
+            data += chunk
+            async with self.received:
+                self.received.notify_all()
+            if self.close_after and len(self.connections) == 1 and len(data) >= self.close_after:
+                break
+        writer.close()
+
+    async def wait_for(self, predicate):
+        async with self.received:
+            await asyncio.wait_for(self.received.wait_for(predicate), 5)
+
+    def stop(self):
+        self.server.close()
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+def test_sends_the_setup_codes_then_the_text():
+    async def main():
+        server = FakeEncoder()
+        encoder = AsyncEncoder('127.0.0.1', await server.start(), 2)
+        encoder.start()
+        now = asyncio.get_running_loop().time()
+        encoder.send(b'HELLO\n', now)
+        encoder.send(b'WORLD\n', now, 2)
+        await encoder.close()
+        await server.wait_for(lambda: server.connections and server.connections[0].endswith(b'WORLD\n'))
+        server.stop()
+        return server, encoder, encoder.watch_task.done()
+    server, encoder, watch_done = run(main())
+    assert bytes(server.connections[0]) == encoder_setup_codes('2', GREETING) + b'HELLO\nWORLD\n'
+    assert encoder.dropped == 0 and encoder.reconnects == 0
+    # The task watching the connection is finished by close(), not left pending
+    assert watch_done
+
+
+def test_reconnects_without_the_greeting_and_keeps_sending():
+    setup = encoder_setup_codes('1', GREETING)
+    async def main():
+        server = FakeEncoder(close_after=len(setup) + len(b'FIRST\n'))
+        encoder = AsyncEncoder('127.0.0.1', await server.start(), 1)
+        encoder.start()
+        loop = asyncio.get_running_loop()
+        encoder.send(b'FIRST\n', loop.time())
+        await server.wait_for(lambda: len(server.connections) == 2)
+        encoder.send(b'SECOND\n', loop.time())
+        await server.wait_for(lambda: server.connections[1].endswith(b'SECOND\n'))
+        await encoder.close()
+        server.stop()
+        return server, encoder
+    server, encoder = run(main())
+    assert bytes(server.connections[0]) == setup + b'FIRST\n'
+    assert bytes(server.connections[1]) == encoder_setup_codes('1') + b'SECOND\n'
+    assert encoder.reconnects == 1
+
+
+def test_drops_cues_past_the_latency_budget():
+    async def main():
+        server = FakeEncoder()
+        encoder = AsyncEncoder('127.0.0.1', await server.start(), 1, latency_budget=1)
+        encoder.start()
+        now = asyncio.get_running_loop().time()
+        encoder.send(b'STALE\n', now - 5, 3)
+        encoder.send(b'FRESH\n', now)
+        await encoder.close()
+        await server.wait_for(lambda: server.connections and server.connections[0].endswith(b'FRESH\n'))
+        server.stop()
+        return server, encoder
+    server, encoder = run(main())
+    assert b'STALE' not in server.connections[0]
+    assert encoder.dropped == 3
+
+
+def test_gives_up_on_an_unreachable_encoder_when_closed(monkeypatch):
+    monkeypatch.setattr(push_vtt_file, 'RECONNECT_DELAYS_S', (0.05,))
+    async def main():
+        server = FakeEncoder()
+        port = await server.start()
+        server.stop()
+        await server.server.wait_closed()
+        encoder = AsyncEncoder('127.0.0.1', port, 1)
+        encoder.start()
+        encoder.send(b'LOST\n', asyncio.get_running_loop().time(), 2)
+        await asyncio.sleep(0.2)
+        await encoder.close()
+        return encoder
+    encoder = run(main())
+    assert encoder.connections == 0 and encoder.dropped == 2
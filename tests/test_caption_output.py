@@ -0,0 +1,54 @@
+# Caption output must not change: tests/data/expected.* were made from tests/data/recognized.json by the original ms_json_to_caption formatter.
+# The recognition results include profanity (in the words and the display text) and a last caption that is longer than MAX_CAPTION_WORDS
+# because its last few words (the end_video_orphan_count words held back until the end) arrive in separate results
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import ms_json_to_caption
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+RECOGNIZED_JSON = os.path.join(DATA, 'recognized.json')
+FORMATS = ('vtt', 'srt', 'txt')
+
+
+def expected(caption_format):
+    with open(os.path.join(DATA, 'expected.' + caption_format), encoding='utf-8') as in_file:
+        return in_file.read()
+
+
+@pytest.mark.parametrize('caption_format', FORMATS)
+def test_process_ms_json_matches_the_original_formatter(caption_format):
+    json_results = ms_json_to_caption.load_json_results(RECOGNIZED_JSON)
+    captioner = ms_json_to_caption.create_captioner('captions.' + caption_format)
+    assert captioner.process_ms_json(json_results) == expected(caption_format)
+
+
+def read_captions(caption_files):
+    texts = []
+    for caption_file in caption_files:
+        with open(caption_file, encoding='utf-8') as in_file:
+            texts.append(in_file.read())
+    return texts
+
+
+def test_live_writer_matches_the_original_formatter_one_result_at_a_time(tmp_path):
+    caption_files = [str(tmp_path / ('captions.' + caption_format)) for caption_format in FORMATS]
+    writer = ms_json_to_caption.LiveCaptionWriter(caption_files)
+    for segment in ms_json_to_caption.iter_json_results(RECOGNIZED_JSON):
+        writer.append(segment)
+    writer.close()
+    assert read_captions(caption_files) == [expected(caption_format) for caption_format in FORMATS]
+
+
+def test_command_line_matches_the_original_formatter(tmp_path):
+    # As json lines, which is how ms_recognize_pcm saves results while recognizing
+    json_lines = str(tmp_path / 'recognized.jsonl')
+    with open(RECOGNIZED_JSON) as in_file, open(json_lines, 'w') as out_file:
+        out_file.writelines(json.dumps(result) + '\n' for result in json.load(in_file))
+    caption_files = [str(tmp_path / ('captions.' + caption_format)) for caption_format in FORMATS]
+    subprocess.run([sys.executable, ms_json_to_caption.__file__, json_lines] + caption_files, check=True, stdout=subprocess.DEVNULL)
+    assert read_captions(caption_files) == [expected(caption_format) for caption_format in FORMATS]
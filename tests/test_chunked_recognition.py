@@ -0,0 +1,92 @@
+# Chunked (--workers) recognition, with the offline local recognizer standing in for the speech service
+import functools
+import threading
+import time
+
+import pytest
+
+import local_recognizer
+import ms_recognize_pcm
+from ms_recognize_pcm import Chunk, TICKS_PER_MS
+from conftest import lecture_parts, write_speech_wav
+
+
+def words(json_results):
+    return [(w['Offset'], w['Duration']) for segment in json_results for w in ms_recognize_pcm.segment_words(segment)]
+
+
+def segment(*word_times_ms):
+    """A recognition result with a word at each (offset, duration) in ms"""
+    word_list = [{'Word': 'w{}'.format(i), 'Offset': offset * TICKS_PER_MS, 'Duration': duration * TICKS_PER_MS} for i, (offset, duration) in enumerate(word_times_ms)]
+    text = ' '.join(w['Word'] for w in word_list)
+    return {'Offset': word_list[0]['Offset'], 'Duration': word_list[-1]['Offset'] + word_list[-1]['Duration'] - word_list[0]['Offset'],
+            'NBest': [{'Display': text, 'Lexical': text, 'Words': word_list}]}
+
+
+@pytest.fixture(scope='module')
+def lecture_wav(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('audio') / 'lecture.wav')
+    write_speech_wav(filename, lecture_parts(5))
+    return filename
+
+
+def test_plan_chunks_covers_the_audio_and_splits_at_quiet_points():
+    frame_ms = ms_recognize_pcm.pcm_audio.FRAME_MS
+    duration_ms = 10 * 60 * 1000
+    levels = [1000] * (duration_ms // frame_ms)
+    quiet_ms = 2 * 60 * 1000 + 5000 # A quiet stretch near the first nominal boundary
+    for frame in range(quiet_ms // frame_ms, (quiet_ms + 1000) // frame_ms):
+        levels[frame] = 0
+    chunks = ms_recognize_pcm.plan_chunks(levels, duration_ms, 5)
+
+    assert len(chunks) >= 5
+    assert chunks[0].start_ms == 0 and chunks[-1].end_ms == duration_ms
+    assert chunks[0].keep_start_ms == float('-inf') and chunks[-1].keep_end_ms == float('inf')
+    assert quiet_ms <= chunks[0].keep_end_ms < quiet_ms + 1000
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert previous.keep_end_ms == chunk.keep_start_ms
+        assert chunk.start_ms < previous.end_ms # Neighbouring chunks overlap
+
+
+def test_rebase_chunk_results_moves_offsets_and_drops_words_of_other_chunks():
+    chunk = Chunk(start_ms=59000, end_ms=121000, keep_start_ms=60000, keep_end_ms=120000)
+    results = [segment((500, 300)), segment((900, 200), (1500, 300)), segment((60500, 300), (61200, 300))]
+    kept = ms_recognize_pcm.rebase_chunk_results(results, chunk)
+
+    assert words(kept) == [(60500 * TICKS_PER_MS, 300 * TICKS_PER_MS), (119500 * TICKS_PER_MS, 300 * TICKS_PER_MS)]
+    assert kept[0]['Offset'] == 60500 * TICKS_PER_MS and kept[0]['NBest'][0]['Display'] == 'w1'
+
+
+def test_merge_chunk_results_drops_words_heard_twice_in_the_overlap():
+    merged = []
+    previous_end = ms_recognize_pcm.merge_chunk_results(merged, [segment((1000, 400), (1500, 400))])
+    assert previous_end == 1900 * TICKS_PER_MS
+    ms_recognize_pcm.merge_chunk_results(merged, [segment((1500, 380), (2000, 300))], previous_end)
+    assert words(merged) == [(1000 * TICKS_PER_MS, 400 * TICKS_PER_MS), (1500 * TICKS_PER_MS, 400 * TICKS_PER_MS), (2000 * TICKS_PER_MS, 300 * TICKS_PER_MS)]
+
+
+def test_chunked_recognition_matches_whole_file(lecture_wav):
+    backend = local_recognizer.LocalBackend()
+    whole = ms_recognize_pcm.recognize_pcm_audio_file_to_ms_json(lecture_wav, job=ms_recognize_pcm.RecognitionJob(backend))
+    job = ms_recognize_pcm.RecognitionJob(backend)
+    recognize = functools.partial(ms_recognize_pcm.recognize_pcm_audio_file_to_ms_json, job=job)
+    chunked = ms_recognize_pcm.recognize_pcm_audio_file_in_chunks(lecture_wav, 3, recognize, job=job)
+    assert len(words(whole)) > 100
+    assert words(chunked) == words(whole)
+
+
+def test_a_failed_chunk_stops_the_others(lecture_wav):
+    job = ms_recognize_pcm.RecognitionJob(local_recognizer.LocalBackend(speed=20)) # Each chunk takes a few seconds
+    started = threading.Event()
+    def recognize(chunk_file):
+        if chunk_file.endswith('00001.wav'):
+            started.wait(5)
+            raise RuntimeError('chunk failed')
+        started.set()
+        return ms_recognize_pcm.recognize_pcm_audio_file_to_ms_json(chunk_file, job=job)
+
+    t = time.monotonic()
+    with pytest.raises(RuntimeError, match='chunk failed'):
+        ms_recognize_pcm.recognize_pcm_audio_file_in_chunks(lecture_wav, 3, recognize, job=job)
+    assert time.monotonic() - t < 2
+    assert not job.recognizers
@@ -0,0 +1,55 @@
+# Reading the recognition json saved by ms_recognize_pcm incrementally (ms_json_to_caption.iter_json_results)
+import json
+import os
+
+import pytest
+
+import ms_json_to_caption
+
+EXAMPLE_JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'transcribe-cli', 'example-data', 'ms_recognized.json')
+
+
+def example_results(count):
+    with open(EXAMPLE_JSON) as in_file:
+        results = json.load(in_file)
+    return (results * (count // len(results) + 1))[:count]
+
+
+def write_text(tmp_path, name, text):
+    filename = str(tmp_path / name)
+    with open(filename, 'w') as out_file:
+        out_file.write(text)
+    return filename
+
+
+@pytest.mark.parametrize('name, separator, start, end', [('results.json', ',\n', '[\n', '\n]\n'), ('results.jsonl', '\n', '', '\n')])
+def test_array_and_json_lines_read_every_result(tmp_path, name, separator, start, end):
+    # Enough results that the file is read in several parts
+    results = example_results(40)
+    filename = write_text(tmp_path, name, start + separator.join(json.dumps(result) for result in results) + end)
+    assert os.path.getsize(filename) > 2 * ms_json_to_caption.JSON_READ_SIZE
+    assert ms_json_to_caption.load_json_results(filename) == results
+
+
+def test_truncated_last_result_is_ignored(tmp_path):
+    results = example_results(40)
+    text = '[\n' + ',\n'.join(json.dumps(result) for result in results)
+    for cut in (30, len(json.dumps(results[-1])) // 2):
+        filename = write_text(tmp_path, 'results.json', text[:-cut])
+        assert ms_json_to_caption.load_json_results(filename) == results[:-1]
+
+
+def test_invalid_result_in_the_middle_is_an_error(tmp_path):
+    texts = [json.dumps(result) for result in example_results(40)]
+    texts[20] = texts[20].replace('": ', '" ', 1)
+    filename = write_text(tmp_path, 'results.jsonl', '\n'.join(texts) + '\n')
+    offset = len('\n'.join(texts[:20])) + 1 + texts[20].index('" ') + 2
+    with pytest.raises(ValueError, match='{}: invalid recognition json at offset {}'.format(filename, offset)):
+        ms_json_to_caption.load_json_results(filename)
+
+
+def test_results_longer_than_the_limit_are_an_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(ms_json_to_caption, 'MAX_JSON_RESULT_SIZE', 1000)
+    filename = write_text(tmp_path, 'results.json', '[{"DisplayText": "' + 'x' * 200000 + '"}]')
+    with pytest.raises(ValueError, match='longer than 1000 characters'):
+        ms_json_to_caption.load_json_results(filename)
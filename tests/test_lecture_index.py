@@ -0,0 +1,55 @@
+# The word index of recorded lectures (lecture_index)
+import json
+
+import pytest
+
+import lecture_index
+from lecture_index import SearchHit
+
+TICKS_PER_MS = 10000
+
+
+@pytest.mark.parametrize('values', [[], [0], [1, 127, 128, 255, 300, 16383, 16384], [2 ** 35 + 5, 0, 2 ** 63]])
+def test_varints_round_trip(values):
+    data = lecture_index.encode_varints(values)
+    assert lecture_index.decode_varints(data) == values
+    assert len(lecture_index.encode_varints([127])) == 1 and len(lecture_index.encode_varints([128])) == 2
+
+
+def test_postings_round_trip_with_decreasing_offsets():
+    # Offsets normally increase with the position, but a negative delta (zigzag encoded) must survive too
+    occurrences = [(0, 0), (3, 1500), (4, 1200), (10, 1200), (11, 0), (500, 3600 * 1000 * 3)]
+    positions, offsets = lecture_index.decode_postings(lecture_index.encode_postings(occurrences))
+    assert list(zip(positions, offsets)) == occurrences
+
+
+def write_recognized(filename, phrases):
+    """Saves recognition json with one result per (start_ms, text), the words 400ms apart"""
+    results = []
+    for start_ms, text in phrases:
+        words = [{'Word': word, 'Offset': (start_ms + 400 * i) * TICKS_PER_MS + 1234, 'Duration': 300 * TICKS_PER_MS} for i, word in enumerate(text.split())]
+        results.append({'RecognitionStatus': 'Success', 'Offset': start_ms * TICKS_PER_MS, 'Duration': 400 * len(words) * TICKS_PER_MS,
+            'NBest': [{'Display': text, 'Words': words}]})
+    with open(filename, 'w') as out_file:
+        json.dump(results, out_file)
+
+
+def test_search_returns_the_seek_position_of_each_match(tmp_path):
+    write_recognized(str(tmp_path / 'lecture01.json'), [(1000, 'today we look at linked lists'), (65000, 'a Linked list, nodes'), (70000, 'are linked')])
+    write_recognized(str(tmp_path / 'lecture02.json'), [(500, 'list linked')])
+    with lecture_index.LectureIndex(str(tmp_path / 'index.db')) as index:
+        assert index.add('lecture01', str(tmp_path / 'lecture01.json'))
+        assert index.add('lecture02', str(tmp_path / 'lecture02.json'))
+        assert not index.add('lecture02', str(tmp_path / 'lecture02.json'))
+
+        assert index.search('linked') == [SearchHit('lecture01', 2600), SearchHit('lecture01', 65400), SearchHit('lecture01', 70400), SearchHit('lecture02', 900)]
+        # A phrase matches consecutive words, across results, ignoring case and punctuation
+        assert index.search('Linked list') == [SearchHit('lecture01', 65400)]
+        assert index.search('nodes are linked') == [SearchHit('lecture01', 66200)]
+        assert index.search('list linked') == [SearchHit('lecture02', 500)]
+        assert index.search('linked', limit=2) == [SearchHit('lecture01', 2600), SearchHit('lecture01', 65400)]
+        assert index.search('trees') == []
+
+        assert index.remove('lecture01')
+        assert index.search('linked') == [SearchHit('lecture02', 900)]
+        assert index.stats() == (1, 2, 2)
@@ -0,0 +1,25 @@
+# Batch recognition (ms_recognize_pcm batch) and its resumable manifest
+import asyncio
+import json
+
+import local_recognizer
+import ms_recognize_pcm
+from conftest import write_speech_wav
+
+
+def test_missing_input_is_recorded_as_failed_and_the_batch_carries_on(tmp_path):
+    inputs = [str(tmp_path / name) for name in ('first.wav', 'missing.wav', 'last.wav')]
+    for filename in (inputs[0], inputs[2]):
+        write_speech_wav(filename, [('q', 500), ('s', 2000), ('q', 500)])
+    audio_files = ms_recognize_pcm.plan_outputs([(filename, '') for filename in inputs], str(tmp_path / 'out'))
+    manifest = ms_recognize_pcm.JobManifest(str(tmp_path / 'manifest.json'))
+
+    failures = asyncio.run(ms_recognize_pcm.recognize_batch(audio_files, manifest, 1, backend=local_recognizer.LocalBackend()))
+
+    assert failures == 1
+    with open(manifest.filename) as in_file:
+        entries = json.load(in_file)['files']
+    assert [entries[filename]['status'] for filename in inputs] == ['done', 'failed', 'done']
+    assert 'size' not in entries[inputs[1]]
+    assert not manifest.is_done(*audio_files[1])
+    assert manifest.is_done(*audio_files[2])
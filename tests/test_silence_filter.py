@@ -0,0 +1,66 @@
+# Removing long silences before recognition (pcm_audio.SilenceFilter) and mapping the results back to the original audio
+import ms_recognize_pcm
+import local_recognizer
+import pcm_audio
+from pcm_audio import TICKS_PER_MS
+from conftest import lecture_parts, write_speech_wav
+
+
+def filtered(filename, **options):
+    silence_filter = pcm_audio.SilenceFilter(filename, **options)
+    with silence_filter:
+        audio = b''.join(silence_filter.blocks())
+    return silence_filter, len(audio) // pcm_audio.BYTES_PER_MS
+
+
+def test_cuts_keep_padding_next_to_speech(tmp_path):
+    filename = str(tmp_path / 'audio.wav')
+    # Leading silence, a short pause (kept), a long silence and trailing silence
+    write_speech_wav(filename, [('q', 5000), ('s', 1000), ('q', 2000), ('s', 500), ('q', 10000), ('s', 300), ('q', 4000)])
+    silence_filter, kept_ms = filtered(filename)
+
+    assert silence_filter.duration_ms == 22800
+    assert kept_ms == 500 + 1000 + 2000 + 500 + 1000 + 300 + 500
+    assert silence_filter.skipped_ms == silence_filter.duration_ms - kept_ms
+    assert silence_filter.cuts == [(0, 4500 * TICKS_PER_MS), (4500 * TICKS_PER_MS, 13500 * TICKS_PER_MS), (5800 * TICKS_PER_MS, 17000 * TICKS_PER_MS)]
+
+    def original_ms(t_ms, end=False):
+        return silence_filter.original_ticks(t_ms * TICKS_PER_MS, end) // TICKS_PER_MS
+    # The start of each burst of speech
+    assert [original_ms(t) for t in (500, 3500, 5000)] == [5000, 8000, 18500]
+    # A time at a cut is after the removed silence, unless it is the end of something
+    assert original_ms(4500) == 18000
+    assert original_ms(4500, end=True) == 9000
+    # The removed silences are 0-4500, 9000-18000 and 19300-22800 in the original audio
+    assert [silence_filter.skipped_ms_from(t) for t in (0, 10000, 18500, 20000, 22800)] == [silence_filter.skipped_ms, 11500, 3500, 2800, 0]
+
+
+def test_filtered_recognition_has_the_offsets_of_the_original_audio(tmp_path):
+    filename = str(tmp_path / 'lecture.wav')
+    write_speech_wav(filename, lecture_parts(5, seed=2))
+    backend = local_recognizer.LocalBackend()
+    whole = ms_recognize_pcm.recognize_pcm_audio_file_to_ms_json(filename, job=ms_recognize_pcm.RecognitionJob(backend))
+    job = ms_recognize_pcm.RecognitionJob(backend, silence_level=pcm_audio.SILENCE_LEVEL)
+    without_silence = ms_recognize_pcm.recognize_pcm_audio_file_to_ms_json(filename, job=job)
+
+    def words(json_results):
+        return [(w['Offset'], w['Duration']) for segment in json_results for w in ms_recognize_pcm.segment_words(segment)]
+    assert len(words(whole)) > 100
+    assert words(without_silence) == words(whole)
+    assert job.skipped_ms > 60 * 1000
+    assert 'Skipped' in job.silence_report()
+
+
+def test_chunked_recognition_counts_the_overlap_between_chunks_once(tmp_path):
+    filename = str(tmp_path / 'lecture.wav')
+    write_speech_wav(filename, lecture_parts(5, seed=3))
+    with pcm_audio.PcmReader(filename) as reader:
+        duration_ms = reader.duration_ms
+    whole_file, _ = filtered(filename)
+    job = ms_recognize_pcm.RecognitionJob(local_recognizer.LocalBackend(), silence_level=pcm_audio.SILENCE_LEVEL)
+    ms_recognize_pcm.recognize_pcm_audio_file_in_chunks(filename, 4, job=job)
+
+    assert job.audio_ms == duration_ms
+    # Each chunk is filtered on its own, so the silence at the chunk boundaries may be cut a little differently
+    assert abs(job.skipped_ms - whole_file.skipped_ms) <= 2 * ms_recognize_pcm.CHUNK_OVERLAP_MS
+    assert job.skipped_ms > 60 * 1000
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# caption_cache
+# Copyright (c) 2019 Lawrence Angrave
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A size bounded on-disk cache of generated captions. Entries are addressed by a hash of the recognition json content,
+# the caption settings and the caption format (see ms_json_to_caption.render_captions), so a cached entry never needs invalidating:
+# different input or settings simply give a different key. When the cache grows beyond its size limit the least recently used entries are removed.
+# Several processes may share one cache directory; each entry is written to a temporary file and renamed into place.
+# Each process re-scans the directory after writing RESCAN_FRACTION of the size limit, so the entries written by the others count towards the limit too
+# (the directory can briefly exceed the limit by that much per process).
+
+import collections
+import hashlib
+import os
+import threading
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024 # Default size limit of a cache directory
+
+RESCAN_FRACTION = 1 / 16 # Fraction of max_bytes a process writes between re-scans of the cache directory
+
+ENTRY_EXTENSION = '.caption'
+
+
+def cache_key(*parts):
+    """Returns the cache key (a hex string) for the given strings e.g. input hash, settings fingerprint and caption format"""
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class CaptionCache:
+    """Caches caption text by key. Recency is the entry file's modification time, so it is kept between runs and shared between processes"""
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.rescan_bytes = max(1, int(max_bytes * RESCAN_FRACTION))
+        self.scan()
+        self.evict() # The size limit may have been reduced
+
+    def scan(self):
+        """Reads the entries (and their recency) from the directory, including the entries written by other processes"""
+        # Least recently used first: key -> size in bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.written_bytes = 0 # Since the scan
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(ENTRY_EXTENSION) and entry.is_file():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue # Evicted by another process
+                found.append((stat.st_mtime, entry.name[:-len(ENTRY_EXTENSION)], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """Returns the cached text, or None if the key is not in the cache"""
+        try:
+            with open(self.path(key), 'r', encoding='utf-8', newline='') as in_file:
+                text = in_file.read()
+            os.utime(self.path(key)) # Most recently used
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+                self.forget(key)
+            return None
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return text
+
+    def put(self, key, text):
+        data = text.encode('utf-8')
+        temp_file = '{}.{}.{}.tmp'.format(self.path(key), os.getpid(), threading.get_ident())
+        with open(temp_file, 'wb') as out_file:
+            out_file.write(data)
+        os.replace(temp_file, self.path(key))
+        with self.lock:
+            self.forget(key)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            self.written_bytes += len(data)
+            if self.written_bytes >= self.rescan_bytes:
+                self.scan()
+            self.evict()
+
+    def forget(self, key):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes"""
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass # Already removed by another process
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# caption_timestamps
+# Copyright (c) 2019 Lawrence Angrave
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Caption timestamp formatting shared by the caption writers (ms_json_to_caption) and the Zoom converter (read_zoom).
+# Times are integer milliseconds and are split with divmod only - no floating point.
+# Each cue usually starts where the previous one ended, so recently formatted times are cached.
+
+import functools
+
+TIMESTAMP_CACHE_SIZE = 256 # Recently formatted times remembered by each format
+
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def vtt_timestamp(t_ms):
+    """Returns a webvtt timestamp e.g. 00:00.000 (times less than 1 hour) or 001:00:00.000 (at least 1 hour). Invalid (None or negative) times are treated as zero"""
+    if t_ms is None or t_ms < 0:
+        t_ms = 0
+    seconds, milli = divmod(int(t_ms), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return '%02d:%02d.%03d' % (minutes, seconds, milli) # Minutes and seconds must be 2 digits. Milliseconds must be 3 digits
+    hours, minutes = divmod(minutes, 60)
+    return '%03d:%02d:%02d.%03d' % (hours, minutes, seconds, milli) # Hours value must never be 2 digits
+
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def srt_timestamp(t_ms):
+    """Returns a srt timestamp e.g. 00:00:00,000. Invalid (None or negative) times are treated as zero"""
+    if t_ms is None or t_ms < 0:
+        t_ms = 0
+    seconds, milli = divmod(int(t_ms), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%02d:%02d:%02d,%03d' % (hours, minutes, seconds, milli)
+
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def clock_timestamp(t_ms, sep=','):
+    """Returns a timestamp with hours, minutes and seconds always present e.g. 12:34:56,000 (srt) or 12:34:56.000 (sep='.', vtt)"""
+    if t_ms is None or t_ms < 0:
+        t_ms = 0
+    seconds, milli = divmod(int(t_ms), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%02d:%02d:%02d%s%03d' % (hours, minutes, seconds, sep, milli)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# instrumentation
+# Copyright (c) 2019 Lawrence Angrave
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Opt-in timers and counters for the recognize -> caption -> push pipeline, to find out where a slow job spends its time
+# (e.g. waiting for speech recognition, parsing json, segmenting captions or writing to the caption encoder).
+# Instrumentation is off unless enable() is called or the CLASSTRANSCRIBE_METRICS environment variable is set to a file name;
+# the metrics are then saved to that file when the program exits - Prometheus text format if the name ends with .prom, otherwise json.
+# When off, each instrumented call costs one extra function call and a flag test.
+
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+METRICS_ENV = 'CLASSTRANSCRIBE_METRICS' # Set to a file name to record metrics for the whole run
+
+PROMETHEUS_PREFIX = 'classtranscribe_'
+
+enabled = False
+
+lock = threading.Lock()
+counters = {} # name -> total
+timers = {} # name -> [count, total seconds, max seconds]
+
+
+def enable(filename=None):
+    """Starts recording metrics. If filename is given the metrics are saved to it when the program exits"""
+    global enabled
+    enabled = True
+    if filename:
+        atexit.register(save_at_exit, filename)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with lock:
+        counters.clear()
+        timers.clear()
+
+
+def count(name, amount=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def observe(name, seconds):
+    """Records one duration (or other measurement in seconds) for the named timer"""
+    if not enabled:
+        return
+    with lock:
+        timer = timers.get(name)
+        if timer is None:
+            timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+
+def clock():
+    """Returns the start time for a later stop(), or None when instrumentation is off"""
+    return time.perf_counter() if enabled else None
+
+
+def stop(name, started):
+    """Records the time since started (from clock()) for the named timer"""
+    if started is not None:
+        observe(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """Decorator that records the duration of every call of the function (including calls that raise an exception)"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """Returns the metrics recorded so far as a json-compatible dict"""
+    with lock:
+        return {'counters': dict(counters),
+                'timers': {name: {'count': c, 'total_seconds': total, 'max_seconds': longest, 'mean_seconds': total / c}
+                           for name, (c, total, longest) in timers.items()}}
+
+
+def take_snapshot():
+    """Returns the metrics recorded so far and starts again from zero (e.g. to send a worker process's metrics to the main process)"""
+    with lock:
+        metrics = {'counters': dict(counters), 'timers': {name: list(timer) for name, timer in timers.items()}}
+        counters.clear()
+        timers.clear()
+    return metrics
+
+
+def merge(metrics):
+    """Adds metrics from take_snapshot (e.g. of a worker process) to the metrics of this process"""
+    with lock:
+        for name, amount in metrics['counters'].items():
+            counters[name] = counters.get(name, 0) + amount
+        for name, (c, total, longest) in metrics['timers'].items():
+            timer = timers.setdefault(name, [0, 0, longest])
+            timer[0] += c
+            timer[1] += total
+            timer[2] = max(timer[2], longest)
+
+
+def prometheus_name(name):
+    return PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def to_prometheus():
+    """Returns the metrics in the Prometheus text exposition format. Timers are summaries (count and sum) plus a max gauge"""
+    metrics = snapshot()
+    lines = []
+    for name, total in sorted(metrics['counters'].items()):
+        metric = prometheus_name(name) + '_total'
+        lines.extend(['# TYPE {} counter'.format(metric), '{} {}'.format(metric, total)])
+    for name, timer in sorted(metrics['timers'].items()):
+        metric = prometheus_name(name) + '_seconds'
+        lines.extend(['# TYPE {} summary'.format(metric),
+                      '{}_count {}'.format(metric, timer['count']),
+                      '{}_sum {!r}'.format(metric, timer['total_seconds']),
+                      '# TYPE {}_max gauge'.format(metric),
+                      '{}_max {!r}'.format(metric, timer['max_seconds'])])
+    return '\n'.join(lines) + '\n'
+
+
+def to_json():
+    return json.dumps(snapshot(), indent=1, sort_keys=True)
+
+
+def save(filename):
+    """Saves the metrics - Prometheus text format if the file name ends with .prom, otherwise json"""
+    text = to_prometheus() if filename.endswith('.prom') else to_json()
+    with open(filename, 'w') as out_file:
+        out_file.write(text)
+
+
+def save_at_exit(filename):
+    # Worker processes (e.g. of a process pool) inherit the setting but must not overwrite the main process's file
+    if multiprocessing.parent_process() is None:
+        save(filename)
+
+
+if os.environ.get(METRICS_ENV):
+    enable(os.environ[METRICS_ENV])
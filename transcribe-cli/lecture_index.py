@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# lecture_index
+# Copyright (c) 2019 Lawrence Angrave
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A searchable index of the words spoken in recorded lectures, built from the recognition json saved by ms_recognize_pcm
+# (the word level NBest[0].Words results that the caption writers read).
+# The index is an sqlite database holding an inverted index: for each term, and each recording it is spoken in, a postings list of
+# the word position and start time (in milliseconds) of every occurrence. Postings are delta encoded varints, so an hour of speech
+# takes a few hundred kilobytes. Recordings can be added (or re-added after recognizing them again) one at a time.
+# Word positions allow phrase queries; a query returns the recording and the time to seek to for every match.
+# Start times are stored in milliseconds, not the recognizer's 100 nanosecond ticks: a search returns millisecond seek positions anyway (ticks truncated
+# to milliseconds, as the captions are), and millisecond deltas are smaller varints - about 3.8 bytes per word instead of 5.7.
+#
+# Example usage: python3 lecture_index.py lectures.db add recognized/
+#                python3 lecture_index.py lectures.db search "linked list"
+
+import argparse
+import collections
+import itertools
+import operator
+import os
+import re
+import sqlite3
+import sys
+
+from caption_timestamps import clock_timestamp
+from ms_json_to_caption import iter_json_results, segment_to_timed_words, ticks_to_ms_array, find_json_files, file_hash
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, hash TEXT NOT NULL, words INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL, occurrences INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS postings (term_id INTEGER NOT NULL, recording_id INTEGER NOT NULL, occurrences INTEGER NOT NULL, data BLOB NOT NULL,
+    PRIMARY KEY (term_id, recording_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_recording ON postings (recording_id);
+'''
+
+TERM_PATTERN = re.compile(r"[\w']+")
+
+# A match: the recording's name and the start time of the first word of the phrase, in milliseconds
+SearchHit = collections.namedtuple('SearchHit', 'recording offset_ms')
+
+
+def normalize_term(word):
+    """Returns the indexed form of a recognized (or query) word: case folded, without punctuation e.g. "Don't," -> "don't". Empty if there are no word characters"""
+    return ''.join(TERM_PATTERN.findall(word.casefold())).strip("'")
+
+
+def query_terms(query):
+    return [term for term in map(normalize_term, query.split()) if term]
+
+
+def encode_varints(values):
+    """Returns the non-negative integers as bytes, 7 bits per byte (LEB128) - small numbers take one byte"""
+    out = bytearray()
+    for value in values:
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data):
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+
+def encode_postings(occurrences):
+    """Returns the postings data for a list of (word position, offset_ms) in position order: the difference from the previous occurrence of each, as varints.
+    Offsets usually increase too, but are zigzag encoded in case they do not"""
+    values = []
+    last_position = 0
+    last_offset = 0
+    for position, offset in occurrences:
+        delta = offset - last_offset
+        values.append(position - last_position)
+        values.append(delta * 2 if delta >= 0 else -delta * 2 - 1)
+        last_position = position
+        last_offset = offset
+    return encode_varints(values)
+
+
+def decode_postings(data):
+    """Returns (positions, offsets) - the lists of word positions and offsets (milliseconds) of the occurrences in postings data"""
+    values = decode_varints(data)
+    positions = list(itertools.accumulate(values[0::2]))
+    offsets = list(itertools.accumulate(value >> 1 if value & 1 == 0 else -((value + 1) >> 1) for value in values[1::2]))
+    return positions, offsets
+
+
+def recording_occurrences(json_file):
+    """Returns (dict of term -> list of (word position, offset_ms), number of words) for a recognition json file"""
+    occurrences = collections.defaultdict(list)
+    position = 0
+    for result in iter_json_results(json_file):
+        words = segment_to_timed_words(result)
+        if not words:
+            continue
+        offsets = ticks_to_ms_array(map(operator.itemgetter('Offset'), words))
+        for word, offset in zip(map(operator.itemgetter('Word'), words), offsets):
+            term = normalize_term(word)
+            if term:
+                occurrences[term].append((position, offset))
+                position += 1
+    return occurrences, position
+
+
+class LectureIndex:
+    """An inverted word index of recordings, stored in an sqlite database file"""
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, name, json_file, force=False):
+        """Indexes the recognition json file as the named recording, replacing any previous version of it.
+        Returns False (and does nothing) if the recording was already indexed from the same json content, unless force is True"""
+        content_hash = file_hash(json_file)
+        row = self.db.execute('SELECT hash FROM recordings WHERE name = ?', (name,)).fetchone()
+        if row and row[0] == content_hash and not force:
+            return False
+        occurrences, words = recording_occurrences(json_file)
+        with self.db:
+            self.remove_postings(name)
+            recording_id = self.db.execute('INSERT INTO recordings (name, hash, words) VALUES (?, ?, ?)', (name, content_hash, words)).lastrowid
+            term_ids = self.term_ids(occurrences)
+            self.db.executemany('INSERT INTO postings (term_id, recording_id, occurrences, data) VALUES (?, ?, ?, ?)',
+                ((term_ids[term], recording_id, len(found), encode_postings(found)) for term, found in occurrences.items()))
+            self.db.executemany('UPDATE terms SET occurrences = occurrences + ? WHERE id = ?',
+                ((len(found), term_ids[term]) for term, found in occurrences.items()))
+        return True
+
+    def remove(self, name):
+        """Removes the named recording from the index. Returns False if it was not indexed"""
+        with self.db:
+            return self.remove_postings(name)
+
+    def remove_postings(self, name):
+        row = self.db.execute('SELECT id FROM recordings WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return False
+        self.db.execute('UPDATE terms SET occurrences = occurrences - (SELECT occurrences FROM postings WHERE term_id = terms.id AND recording_id = ?) '
+            'WHERE id IN (SELECT term_id FROM postings WHERE recording_id = ?)', (row[0], row[0]))
+        self.db.execute('DELETE FROM postings WHERE recording_id = ?', (row[0],))
+        self.db.execute('DELETE FROM recordings WHERE id = ?', (row[0],))
+        return True
+
+    def term_ids(self, terms):
+        """Returns a dict of term -> id, adding any new terms"""
+        self.db.executemany('INSERT OR IGNORE INTO terms (term) VALUES (?)', ((term,) for term in terms))
+        ids = {}
+        terms = list(terms)
+        # Look up in batches; sqlite limits the number of parameters of a statement
+        for start in range(0, len(terms), 500):
+            batch = terms[start:start + 500]
+            ids.update(self.db.execute('SELECT term, id FROM terms WHERE term IN ({})'.format(','.join('?' * len(batch))), batch))
+        return ids
+
+    def search(self, query, limit=None):
+        """Returns the SearchHits of the words (a phrase, if more than one) in recording name and time order"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        found = {}
+        for term in set(terms):
+            row = self.db.execute('SELECT id, occurrences FROM terms WHERE term = ?', (term,)).fetchone()
+            if row is None or row[1] == 0:
+                return []
+            found[term] = row
+        # Only recordings that contain the rarest term can match; the postings of the other terms are read for those recordings only
+        rarest = min(found, key=lambda term: found[term][1])
+        hits = []
+        candidates = self.db.execute('SELECT recordings.name, postings.recording_id, postings.data FROM postings JOIN recordings ON recordings.id = postings.recording_id '
+            'WHERE postings.term_id = ?', (found[rarest][0],)).fetchall()
+        for name, recording_id, data in candidates:
+            postings = {rarest: decode_postings(data)}
+            for term in found:
+                if term not in postings:
+                    row = self.db.execute('SELECT data FROM postings WHERE term_id = ? AND recording_id = ?', (found[term][0], recording_id)).fetchone()
+                    if row is None:
+                        break
+                    postings[term] = decode_postings(row[0])
+            else:
+                hits.extend(SearchHit(name, offset) for offset in phrase_offsets(terms, postings))
+        hits.sort()
+        return hits[:limit] if limit else hits
+
+    def stats(self):
+        """Returns (recordings, words, distinct terms)"""
+        recordings, words = self.db.execute('SELECT COUNT(*), COALESCE(SUM(words), 0) FROM recordings').fetchone()
+        terms = self.db.execute('SELECT COUNT(*) FROM terms WHERE occurrences > 0').fetchone()[0]
+        return recordings, words, terms
+
+
+def phrase_offsets(terms, postings):
+    """Returns the offsets of the first word wherever the terms occur at consecutive positions. postings is a dict of term -> (positions, offsets)"""
+    first_positions, first_offsets = postings[terms[0]]
+    if len(terms) == 1:
+        return first_offsets
+    following = [(i, set(postings[term][0])) for i, term in enumerate(terms[1:], start=1)]
+    return [offset for position, offset in zip(first_positions, first_offsets)
+            if all(position + i in positions for i, positions in following)]
+
+
+def recording_name(json_file):
+    """The name of a recording: the path of its json file (as given, or as found inside a given directory) without the extension, with / separators"""
+    return os.path.normpath(os.path.splitext(json_file)[0]).replace(os.sep, '/')
+
+
+def add_main(index, args):
+    names = {}
+    for json_file, _ in find_json_files(args.inputs):
+        name = recording_name(json_file)
+        if name in names and os.path.abspath(names[name]) != os.path.abspath(json_file):
+            sys.exit('{} and {} would both be indexed as {}; nothing was indexed'.format(names[name], json_file, name))
+        names[name] = json_file
+
+    added = skipped = 0
+    for name, json_file in names.items():
+        if index.add(name, json_file, args.force):
+            added += 1
+        else:
+            skipped += 1
+    recordings, words, terms = index.stats()
+    print('{} recordings indexed, {} already up to date. The index has {} recordings, {} words, {} distinct terms'.format(added, skipped, recordings, words, terms))
+
+
+def search_main(index, args):
+    hits = index.search(args.query, args.limit)
+    for hit in hits:
+        print('{}\t{}\t{}'.format(hit.recording, clock_timestamp(hit.offset_ms, '.'), hit.offset_ms))
+    if not hits:
+        print('No matches', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds and searches an index of the words spoken in recordings, from the json speech recognition results saved by ms_recognize_pcm')
+    parser.add_argument('index_file', help='index database file (created if it does not exist)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='add (or update) recordings')
+    add.add_argument('inputs', nargs='+', help='json files and/or directories that are searched (recursively) for .json and .jsonl files. '
+        'Each recording is named after the path of its file, without the extension e.g. recognized/cs225/lecture01')
+    add.add_argument('--force', action='store_true', help='index the recordings again even if their json is unchanged')
+    search = commands.add_parser('search', help='find a word or phrase. Prints the recording, time and time in milliseconds of each match')
+    search.add_argument('query')
+    search.add_argument('--limit', type=int, help='show at most this many matches')
+    remove = commands.add_parser('remove', help='remove recordings from the index')
+    remove.add_argument('names', nargs='+')
+    args = parser.parse_args()
+
+    with LectureIndex(args.index_file) as index:
+        if args.command == 'add':
+            add_main(index, args)
+        elif args.command == 'search':
+            search_main(index, args)
+        else:
+            for name in args.names:
+                if not index.remove(name):
+                    print('{} is not in the index'.format(name), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# local_recognizer
+# Copyright (c) 2019 Lawrence Angrave
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# An offline stand-in for the Microsoft speech recognizer, for load testing and benchmarking the pipeline without an API key or network.
+# It does not understand speech! Words are placed at the loud parts of the audio and are chosen from a fixed vocabulary,
+# so the same audio always produces the same json. The json has the same shape as the MS detailed (NBest / Words) results.
+# The recognizer objects mimic the part of the azure.cognitiveservices.speech SpeechRecognizer API used by ms_recognize_pcm
+
+import json
+import threading
+import time
+
+import pcm_audio
+from pcm_audio import TICKS_PER_MS
+
+SPEECH_LEVEL = 400 # Frames with a mean absolute amplitude above this are treated as speech
+MIN_WORD_MS = 50 # Shorter sounds (e.g. clicks) are ignored
+MIN_WORD_GAP_MS = 60 # A quieter stretch at least this long separates two words
+SEGMENT_GAP_MS = 600 # A pause at least this long ends the current segment (utterance)
+MAX_SEGMENT_WORDS = 40 # Very long utterances are split
+
+VOCABULARY = ('the', 'a', 'of', 'and', 'to', 'in', 'is', 'that', 'we', 'this', 'so', 'it', 'for', 'you', 'are', 'on',
+    'with', 'have', 'can', 'OK', 'now', 'data', 'value', 'function', 'example', 'question', 'lecture', 'problem', 'memory',
+    'students', 'algorithm', 'university', 'important', 'information', 'performance', 'Illinois')
+
+
+class EventSignal:
+    """Minimal version of the SDK EventSignal - connected callbacks are called with each event"""
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self, callback):
+        self.callbacks.append(callback)
+
+    def signal(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+
+class RecognitionResult:
+    def __init__(self, json_text):
+        self.json = json_text
+
+    def __repr__(self):
+        return 'RecognitionResult(json={})'.format(self.json)
+
+
+class CancellationDetails:
+    def __init__(self, error_details):
+        self.error_details = error_details
+
+
+class RecognitionEvent:
+    """Stands in for both the SDK SpeechRecognitionEventArgs and SpeechRecognitionCanceledEventArgs"""
+    def __init__(self, result=None, error_details=''):
+        self.result = result
+        self.cancellation_details = CancellationDetails(error_details)
+
+    def __repr__(self):
+        return 'RecognitionEvent(result={})'.format(self.result)
+
+
+class LocalBackend:
+    """Creates LocalRecognizers. speed is a multiple of real time (e.g. 10 means one hour of audio is recognized in six minutes); 0 means as fast as possible"""
+    name = 'local'
+
+    def __init__(self, speed=0, speech_level=SPEECH_LEVEL):
+        self.speed = speed
+        self.speech_level = speech_level
+
+    def create_recognizer(self, audio):
+        """audio is a PCM file name, or a decoder with blocks() and close() e.g. pcm_audio.FfmpegDecoder"""
+        if hasattr(audio, 'blocks'):
+            return LocalRecognizer(audio, self.speed, self.speech_level)
+        # Opening the file now means a missing file fails immediately, like the SDK
+        return LocalRecognizer(pcm_audio.PcmReader(audio), self.speed, self.speech_level)
+
+
+class LocalRecognizer:
+    def __init__(self, reader, speed, speech_level):
+        self.reader = reader
+        self.speed = speed
+        self.speech_level = speech_level
+        self.recognized = EventSignal()
+        self.session_stopped = EventSignal()
+        self.canceled = EventSignal()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start_continuous_recognition(self):
+        self.thread = threading.Thread(target=self.run, name='LocalRecognizer', daemon=True)
+        self.thread.start()
+
+    def stop_continuous_recognition(self):
+        # May be called from a callback i.e. on the recognition thread itself, so just ask it to stop
+        self.stopping.set()
+
+    def run(self):
+        started = time.monotonic()
+        try:
+            levels = pcm_audio.iter_frame_levels(self.reader.blocks())
+            for words in group_segments(find_words(levels, self.speech_level)):
+                if self.speed:
+                    # Results are not available until the audio has been 'heard'
+                    self.stopping.wait(started + words[-1][1] / 1000 / self.speed - time.monotonic())
+                if self.stopping.is_set():
+                    break
+                self.recognized.signal(RecognitionEvent(RecognitionResult(json.dumps(segment_to_ms_json(words)))))
+        except Exception as err:
+            self.canceled.signal(RecognitionEvent(error_details=str(err)))
+            return
+        finally:
+            self.reader.close()
+        # Like the SDK, the end of the audio is reported as a cancellation without error details
+        self.canceled.signal(RecognitionEvent())
+        self.session_stopped.signal(RecognitionEvent())
+
+
+def find_words(levels, speech_level=SPEECH_LEVEL, frame_ms=pcm_audio.FRAME_MS):
+    """Yields (start_ms, end_ms) of each word i.e. loud run of frames in the iterable of frame levels"""
+    min_gap = max(1, MIN_WORD_GAP_MS // frame_ms)
+    start = None
+    end = None
+    for frame, level in enumerate(levels):
+        if level > speech_level:
+            if start is None:
+                start = frame
+            end = frame + 1
+        elif start is not None and frame + 1 - end >= min_gap:
+            if (end - start) * frame_ms >= MIN_WORD_MS:
+                yield start * frame_ms, end * frame_ms
+            start = None
+    if start is not None and (end - start) * frame_ms >= MIN_WORD_MS:
+        yield start * frame_ms, end * frame_ms
+
+
+def group_segments(words):
+    """Yields lists of consecutive words, split at long pauses"""
+    segment = []
+    for word in words:
+        if segment and (word[0] - segment[-1][1] >= SEGMENT_GAP_MS or len(segment) >= MAX_SEGMENT_WORDS):
+            yield segment
+            segment = []
+        segment.append(word)
+    if segment:
+        yield segment
+
+
+def segment_to_ms_json(words):
+    """Returns the MS-cognitive-services detailed json for one segment of (start_ms, end_ms) words"""
+    timed_words = []
+    for start, end in words:
+        text = VOCABULARY[(start // pcm_audio.FRAME_MS * 31 + end - start) % len(VOCABULARY)]
+        timed_words.append({'Duration': (end - start) * TICKS_PER_MS, 'Offset': start * TICKS_PER_MS, 'Word': text})
+
+    lexical = ' '.join(w['Word'] for w in timed_words)
+    display = lexical[0].upper() + lexical[1:] + '.'
+    offset = words[0][0] * TICKS_PER_MS
+    return {'Duration': words[-1][1] * TICKS_PER_MS - offset,
+            'NBest': [{'Confidence': 1.0, 'Display': display, 'ITN': lexical, 'Lexical': lexical.lower(), 'MaskedITN': lexical, 'Words': timed_words}],
+            'Offset': offset,
+            'RecognitionStatus': 'Success'}
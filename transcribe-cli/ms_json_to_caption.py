@@ -23,6 +23,20 @@ import os
 import json
 import sys
 import re
+import collections
+import array
+import itertools
+import operator
+import argparse
+import threading
+import hashlib
+import time
+import concurrent.futures
+import io
+
+import caption_cache
+import instrumentation
+from caption_timestamps import vtt_timestamp, srt_timestamp
 
 # https://www.w3.org/TR/webvtt1/
 
@@ -63,113 +77,320 @@ ACKNOWLEDGEMENT_DURATION_MS = 3500
 ACKNOWLEDGEMENT_TEXT1 = 'Automated Transcriptions by ClassTranscribe,'
 ACKNOWLEDGEMENT_TEXT2= 'A University of Illinois Digital Accessibility Project'
 
+# The values above, as one object that can be passed to the segmenter and writers (e.g. to try different settings without changing this file)
+CaptionParameters = collections.namedtuple('CaptionParameters', 'max_lines_per_caption fudge_start_gap_ms notable_silence_ms max_caption_duration_ms '
+    'max_interword_gap_ms max_caption_words max_caption_char_length_per_line end_video_orphan_count acknowledgement_pre_delay_ms '
+    'acknowledgement_duration_ms acknowledgement_text1 acknowledgement_text2')
+
+def default_caption_parameters():
+    """Returns the CaptionParameters given by the module constants (read when called, so changes to the constants are used)"""
+    return CaptionParameters(MAX_LINES_PER_CAPTION, FUDGE_START_GAP_MS, NOTABLE_SILENCE_MS, MAX_CAPTION_DURATION_MS, MAX_INTERWORD_GAP_MS,
+        MAX_CAPTION_WORDS, MAX_CAPTION_CHAR_LENGTH_PER_LINE, END_VIDEO_ORPHAN_COUNT, ACKNOWLEDGEMENT_PRE_DELAY_MS, ACKNOWLEDGEMENT_DURATION_MS,
+        ACKNOWLEDGEMENT_TEXT1, ACKNOWLEDGEMENT_TEXT2)
+
+CAPTION_FORMAT_VERSION = 1 # Increase when a code change alters the captions for the same json and parameters, so cached and batch captions are regenerated
+
 PROFANITY_LIST = [ 'homo','gay','slut','damn','ass','poop','cock','lol','crap','sex','noob','nazi','neo-nazi','fuck','fucked',
 'bitch','pussy','penis','vagina','whore','shit','nigger','nigga','cocksucker','assrape','motherfucker',
-'wanker','cunt','faggot','fags','asshole','fuck']
+'wanker','cunt','faggot','fags','asshole']
 #Based on https://en.wikipedia.org/wiki/User:ClueBot/Source#Score_list
 
 
+PROFANITY_LIST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profanity') # Optional extra word lists, one file per language e.g. profanity/en.txt
+
+MASK_CACHE_SIZE = 100000 # Distinct words remembered by a ProfanityMasker
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+class ProfanityMasker:
+    """Replaces listed words with '*' characters. Built once from a word list; each lookup is a set membership test and results are cached per distinct word,
+    so the cost does not grow with the length of the list. Matching is case insensitive and whole words only.
+    If alternation is True, mask_text uses a single compiled regular expression of the listed words, which also masks listed phrases that contain non-word characters (e.g. 'neo-nazi')"""
+    def __init__(self, words=PROFANITY_LIST, alternation=False):
+        self.words = frozenset(word.lower() for word in words if word)
+        self.cache = {}
+        self.pattern = None
+        if alternation and self.words:
+            # Longest first, so that a longer listed word is preferred to its prefix
+            alternatives = '|'.join(sorted(map(re.escape, self.words), key=len, reverse=True))
+            self.pattern = re.compile(r'(?<!\w)(?:' + alternatives + r')(?!\w)', re.IGNORECASE)
+
+    @classmethod
+    def from_files(cls, filenames, include_default=True, alternation=False):
+        words = list(PROFANITY_LIST) if include_default else []
+        for filename in filenames:
+            words.extend(load_word_list(filename))
+        return cls(words, alternation)
+
+    @classmethod
+    def for_language(cls, language_tag, extra_files=(), directory=PROFANITY_LIST_DIR, alternation=False):
+        """Returns a masker for the default list plus <directory>/<language_tag>.txt (if that file exists) and any extra word list files"""
+        filename = os.path.join(directory, language_tag + '.txt')
+        filenames = ([filename] if os.path.exists(filename) else []) + list(extra_files)
+        return cls.from_files(filenames, alternation=alternation)
+
+    def mask_word(self, word):
+        try:
+            return self.cache[word]
+        except KeyError:
+            pass
+        masked = word
+        if word and word.lower() in self.words:
+            masked = '*' * (len(word))
+        if len(self.cache) >= MASK_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[word] = masked
+        return masked
+
+    def mask_text(self, text):
+        """Masks the listed words in a line of text, keeping the original spacing and punctuation"""
+        if self.pattern:
+            return self.pattern.sub(lambda match: '*' * len(match.group()), text)
+        return WORD_PATTERN.sub(lambda match: self.mask_word(match.group()), text)
+
+
+def load_word_list(filename):
+    """Returns the words in a word list file - one word per line. Blank lines and lines starting with # are ignored"""
+    with open(filename, 'r', encoding='utf-8') as in_file:
+        return [line.strip() for line in in_file if line.strip() and not line.lstrip().startswith('#')]
+
+
+default_masker = ProfanityMasker()
+
 def mask_profanity(word):
-    if not word or (word.lower() not in PROFANITY_LIST): 
-        return word
-    return '*' * (len(word))
+    return default_masker.mask_word(word)
 
-class BaseCaptionWriter:
-    language_tag='en'
-    
-    def __init__(self):
-        self.reset()
-    
-    def reset(self):
-        self.caption_counter = 0
-        self.lines = []
+def ticks_to_ms_array(ticks):
+    """Returns an array of millisecond times, truncated, for the iterable of tick times. A tick represents one hundred nanoseconds"""
+    ticks = list(ticks)
+    try:
+        # Ticks are integers in practice and then floor division is the same as int(tick/1e4)
+        return array.array('q', map(operator.floordiv, ticks, itertools.repeat(10000)))
+    except TypeError:
+        return array.array('q', map(int, map(operator.truediv, ticks, itertools.repeat(1e4))))
 
-    def segment_to_timed_words(self, json_segment):
-        """Returns an array of word entries [ {"Duration":4900000, "Offset":8700000,"Word":"OK"}... """
-        return json_segment["NBest"][0]['Words']
-    
-    def process_ms_json(self,json_results):
-        """Returns a string - the json results converted into a webvtt or srt caption resource.
-        language_tag must be a valid BCP47 language tag e.g. 'en' (English) 'de' (German) 'es' (Spanish). See https://tools.ietf.org/html/bcp47
-        """
-        timed_words = []
-        for segment in json_results:
-            timed_words.extend( self.segment_to_timed_words(segment))
-            
-        return self.process_timed_words(timed_words)
-        
-    def process_timed_words(self,timed_words):   
-        self.reset()      
-        self.emit_header()
+class TimedWords:
+    """Columnar form of a run of timed words, for fast segmentation: arrays of offsets, durations and end times in milliseconds,
+    word lengths, and the (interned, profanity masked) words themselves"""
+    __slots__ = ('offsets', 'durations', 'ends', 'lengths', 'words')
 
-        caption = None
-        caption_start = 0
-        caption_end = 0
-        caption_line_length = 0 # Current line of caption (captions can have multiple lines)
-        caption_line = 1
-        num_words = len(timed_words)
-    
-        for ith, entry in enumerate(timed_words):
-            try:
-                # A tick represents one hundred nanoseconds, so convert to milliseconds
-                # Mask profanity 
-                duration, offset, word = int(entry['Duration']/1e4), int(entry['Offset']/1e4), mask_profanity(entry['Word']) # milliseconds
-            except RuntimeError as re:
-                print(re)
-                # Ignore bad / missing word data
-                continue
-            
-            is_last_few_words = (ith >= num_words - END_VIDEO_ORPHAN_COUNT)
-          
-            gap = offset - caption_end 
-            new_caption_end = offset + duration
+    def __init__(self, entries=(), masker=None):
+        """entries are word entries e.g. [ {"Duration":4900000, "Offset":8700000,"Word":"OK"}... ]"""
+        if not isinstance(entries, (list, tuple)):
+            entries = list(entries)
+        self.offsets = ticks_to_ms_array(map(operator.itemgetter('Offset'), entries))
+        self.durations = ticks_to_ms_array(map(operator.itemgetter('Duration'), entries))
+        self.ends = array.array('q', map(operator.add, self.offsets, self.durations))
+        # Mask profanity once per distinct word; repeated words then share one (interned) string
+        raw_words = list(map(operator.itemgetter('Word'), entries))
+        mask_word = (masker or default_masker).mask_word
+        masked = {word: mask_word(word) for word in set(raw_words)}
+        self.words = list(map(masked.__getitem__, raw_words))
+        self.lengths = array.array('l', map(len, self.words))
+
+    def __len__(self):
+        return len(self.words)
+
+    def extend(self, other):
+        for name in self.__slots__:
+            getattr(self, name).extend(getattr(other, name))
+
+    def remove_first(self, count):
+        for name in self.__slots__:
+            del getattr(self, name)[:count]
+
+
+class CaptionSegmenter:
+    """Groups timed words into captions, calling emit(start_ms, end_ms, content) as soon as each caption is complete.
+    Words may be added in any size groups (e.g. one recognition result at a time).
+    The most recent end_video_orphan_count words are held back until more words arrive or finish() is called, because the last few words of the video may extend the final caption.
+    parameters are the CaptionParameters to use (default: the module constants)"""
+    def __init__(self, emit, masker=None, parameters=None):
+        self.emit = emit
+        self.masker = masker or default_masker
+        self.parameters = parameters or default_caption_parameters()
+        self.pending = TimedWords()
+        self.caption = None
+        self.caption_start = 0
+        self.caption_end = 0
+        self.caption_line_length = 0 # Current line of caption (captions can have multiple lines)
+        self.caption_line = 1
+
+    def add_word(self, entry):
+        """entry is a word entry e.g. {"Duration":4900000, "Offset":8700000,"Word":"OK"}"""
+        self.add_timed_words(TimedWords((entry,), self.masker))
+
+    def add_words(self, entries):
+        self.add_timed_words(TimedWords(entries, self.masker))
+
+    def add_timed_words(self, timed_words):
+        pending = self.pending
+        pending.extend(timed_words)
+        ready = len(pending) - self.parameters.end_video_orphan_count
+        if ready > 0:
+            self.process(pending, ready, ready)
+            pending.remove_first(ready)
+
+    def process(self, timed_words, count, last_few_start):
+        """Segments the first count words of timed_words. Words from last_few_start onwards are the last few words of the video"""
+        offsets, ends, lengths, words = timed_words.offsets, timed_words.ends, timed_words.lengths, timed_words.words
+        # The gap before each word; every word (once processed) becomes the end of the current caption
+        gaps = array.array('q', map(operator.sub, offsets[:count], itertools.chain((self.caption_end,), ends[:count - 1])))
+
+        emit = self.emit
+        p = self.parameters
+        max_caption_duration_ms, max_interword_gap_ms, max_lines_per_caption = p.max_caption_duration_ms, p.max_interword_gap_ms, p.max_lines_per_caption
+        max_caption_words, max_line_length = p.max_caption_words, p.max_caption_char_length_per_line
+        caption, caption_start, caption_end = self.caption, self.caption_start, self.caption_end
+        caption_line_length, caption_line = self.caption_line_length, self.caption_line
+
+        for i in range(count):
+            gap = gaps[i]
+            offset = offsets[i]
+            new_caption_end = ends[i]
+            length = lengths[i]
         
             # Can we just append the word to an existing caption line?
-            if caption and (new_caption_end - caption_start <= MAX_CAPTION_DURATION_MS) and \
-               (gap <= MAX_INTERWORD_GAP_MS) and \
-               (caption_line_length + len(word) < MAX_CAPTION_CHAR_LENGTH_PER_LINE or caption_line < MAX_LINES_PER_CAPTION) and \
-               (len(caption) < MAX_CAPTION_WORDS or is_last_few_words): 
-                   if caption_line_length + len(word) > MAX_CAPTION_CHAR_LENGTH_PER_LINE:
+            if caption and (new_caption_end - caption_start <= max_caption_duration_ms) and \
+               (gap <= max_interword_gap_ms) and \
+               (caption_line_length + length < max_line_length or caption_line < max_lines_per_caption) and \
+               (len(caption) < max_caption_words or i >= last_few_start): 
+                   if caption_line_length + length > max_line_length:
                        caption.append('\n')
-                       caption_line_length = len(word)
+                       caption_line_length = length
                        caption_line += 1
                    else:
-                       caption_line_length += len(word) + 1
-                   caption.append(word)
+                       caption_line_length += length + 1
+                   caption.append(words[i])
                    caption_end = new_caption_end
                    continue
 
             # If we get to here then we WILL be starting a new caption, but first check for a long gap and also emit current caption if it exists
             # Have we jumped forward in time? Emit a caption about the long gap in non-transcribed speech
-            if gap > NOTABLE_SILENCE_MS:
-                 self.emit(caption_end, offset,'[ Silence / Inaudible ]')  
+            if gap > p.notable_silence_ms:
+                 emit(caption_end, offset,'[ Silence / Inaudible ]')  
                  caption_end = offset           
      
             if caption:
                 # Emit current caption (with original end time)
-                self.emit(caption_start, caption_end, ' '.join(caption))
+                emit(caption_start, caption_end, ' '.join(caption))
 
-            caption = [ word ]
-            caption_line_length = len(word)
+            caption = [ words[i] ]
+            caption_line_length = length
             caption_line = 1
          
             caption_start = offset
-            if offset - caption_end < FUDGE_START_GAP_MS:
+            if offset - caption_end < p.fudge_start_gap_ms:
                 caption_start = caption_end
             
             caption_end = new_caption_end
 
+        self.caption, self.caption_start, self.caption_end = caption, caption_start, caption_end
+        self.caption_line_length, self.caption_line = caption_line_length, caption_line
+
+    def finish(self):
+        """Emits the remaining captions and the acknowledgement"""
+        self.process(self.pending, len(self.pending), 0)
+        self.pending = TimedWords()
+
         # Clean up, we might still be building a caption after processing all of the words
-        if caption:
-             self.emit(caption_start, caption_end, ' '.join(caption))
+        if self.caption:
+             self.emit(self.caption_start, self.caption_end, ' '.join(self.caption))
+             self.caption = None
          
         # Add acknowledgement if there were captions generated
-        if caption_end > 0:
-            caption_start = caption_end + ACKNOWLEDGEMENT_PRE_DELAY_MS
-            caption_end = caption_start + ACKNOWLEDGEMENT_DURATION_MS
-            self.emit(caption_start, caption_end,'[ ' + ACKNOWLEDGEMENT_TEXT1 + '\n' + ACKNOWLEDGEMENT_TEXT2+ ' ]' ) 
-     
-        return '\n'.join(self.lines)
+        if self.caption_end > 0:
+            p = self.parameters
+            caption_start = self.caption_end + p.acknowledgement_pre_delay_ms
+            caption_end = caption_start + p.acknowledgement_duration_ms
+            self.emit(caption_start, caption_end,'[ ' + p.acknowledgement_text1 + '\n' + p.acknowledgement_text2+ ' ]' ) 
+
+
+# A caption: start and end times in milliseconds and the (possibly two line) text.
+# Segmentation produces cues once; every caption format is rendered from the same cues
+Cue = collections.namedtuple('Cue', 'start_ms end_ms text')
+
+def segment_to_timed_words(json_segment):
+    """Returns an array of word entries [ {"Duration":4900000, "Offset":8700000,"Word":"OK"}... (empty if nothing was recognized)"""
+    nbest = json_segment.get("NBest")
+    return nbest[0]['Words'] if nbest else []
+
+def segment_timed_words(timed_words, masker=None, parameters=None):
+    """Returns the list of Cues for an iterable of word entries (or a TimedWords)"""
+    cues = []
+    segmenter = CaptionSegmenter(lambda start, end, content: cues.append(Cue(start, end, content)), masker, parameters)
+    segmenter.add_timed_words(timed_words if isinstance(timed_words, TimedWords) else TimedWords(timed_words, masker))
+    segmenter.finish()
+    return cues
+
+def segment_ms_json(json_results, masker=None, parameters=None):
+    """Returns the list of Cues for the MS recognition json results"""
+    return segment_timed_words((entry for segment in json_results for entry in segment_to_timed_words(segment)), masker, parameters)
+
+
+class OutputBuffer:
+    """Writers write each line of output, ending with a newline, to one in-memory text stream (self.write)"""
+    def reset_output(self):
+        self.out = io.StringIO()
+        self.write = self.out.write
+
+    def getvalue(self):
+        """Returns all of the output - the lines joined by newlines, without a final newline"""
+        return self.out.getvalue()[:-1]
+
+    def take_output(self):
+        """Returns the output written since the last call (each line ends with a newline) and discards it from the buffer"""
+        text = self.out.getvalue()
+        if text:
+            self.out.seek(0)
+            self.out.truncate()
+        return text
+
+
+class BaseCaptionWriter(OutputBuffer):
+    language_tag='en'
+    masker = None # ProfanityMasker to use instead of the default
+    parameters = None # CaptionParameters to use instead of the module constants
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.caption_counter = 0
+        self.reset_output()
+
+    def segment_to_timed_words(self, json_segment):
+        """Returns an array of word entries [ {"Duration":4900000, "Offset":8700000,"Word":"OK"}... """
+        return segment_to_timed_words(json_segment)
+    
+    @instrumentation.timed('caption.process_ms_json')
+    def process_ms_json(self,json_results):
+        """Returns a string - the json results converted into a webvtt or srt caption resource.
+        language_tag must be a valid BCP47 language tag e.g. 'en' (English) 'de' (German) 'es' (Spanish). See https://tools.ietf.org/html/bcp47
+        """
+        return self.render_cues(segment_timed_words((entry for segment in json_results for entry in self.segment_to_timed_words(segment)), self.masker, self.parameters))
+        
+    @instrumentation.timed('caption.process_timed_words')
+    def process_timed_words(self,timed_words):   
+        return self.render_cues(segment_timed_words(timed_words, self.masker, self.parameters))
+
+    def render_cues(self, cues):
+        """Returns a string - the cues (see segment_ms_json) in this caption format"""
+        self.begin()
+        for cue in cues:
+            self.emit(*cue)
+        self.finish()
+        return self.getvalue()
+
+    # Incremental interface: begin(), emit() for each cue, then finish(). Output accumulates in the output buffer (see OutputBuffer)
+
+    def begin(self):
+        self.reset()      
+        self.emit_header()
+
+    def finish(self):
+        pass
             
 
 class VTTCaptionWriter(BaseCaptionWriter):
@@ -177,36 +398,23 @@ class VTTCaptionWriter(BaseCaptionWriter):
         pass
     
     def emit_header(self):
-        self.lines.extend(['WEBVTT','Kind: Subtitles','Language: ' + self.language_tag])
-        self.emit_note(ACKNOWLEDGEMENT_TEXT1 + ' ' + ACKNOWLEDGEMENT_TEXT2)        
+        self.write('WEBVTT\nKind: Subtitles\nLanguage: ' + self.language_tag + '\n')
+        p = self.parameters or default_caption_parameters()
+        self.emit_note(p.acknowledgement_text1 + ' ' + p.acknowledgement_text2)        
    
     def to_timestamp(self,t_ms): 
         """Converts a millisecond time into a webvtt timestamp as a string e.g. 00:00.000 (times less than 1 hour) or 001:00:00.000 (at least 1 hour). Invalid (None or negative) are treated as a zero time value."""
-        if t_ms is None or t_ms < 0:
-            t_ms = 0
-        
-        t = int(t_ms/1000)
-    
-        hours = int(t / 3600)
-        minutes = int(t / 60) % 60
-        seconds = t % 60
-        milli = int(t_ms) % 1000
-    
-        result = '{0:02d}:{1:02d}.{2:03d}'.format(minutes,seconds,milli)
-        if hours == 0:
-            return result # 09:59.000  # Minutes and seconds must be 2 digits. Milliseconds must be 3 digits
-        else:
-            return '{0:03d}:'.format(hours) + result # Hours value must never be 2 digits
+        return vtt_timestamp(t_ms)
     
     def write_start_end(self,start_ms, end_ms):
         """Creates a webvtt start-end time string e.g. 00:00.000 --> 00:01.000"""
-        return '{0} --> {1}'.format(self.to_timestamp(start_ms), self.to_timestamp(end_ms))
+        return vtt_timestamp(start_ms) + ' --> ' + vtt_timestamp(end_ms)
     
     def emit(self,start,end,content):
-         self.lines.extend([ self.write_start_end(start, end), content.replace('\n ','\n'), ''])
+         self.write(self.write_start_end(start, end) + '\n' + content.replace('\n ','\n') + '\n\n')
         
     def emit_note(self,content):
-         self.lines.extend(['NOTE ' + content,''])
+         self.write('NOTE ' + content + '\n\n')
     
        
 class SrtCaptionWriter(BaseCaptionWriter):
@@ -218,88 +426,469 @@ class SrtCaptionWriter(BaseCaptionWriter):
         
     def emit(self,start,end,content):
         self.caption_counter =  self.caption_counter + 1
-        self.lines.extend([str(self.caption_counter) , self.write_start_end(start, end), content.replace('\n ','\n'), ''])
+        self.write(str(self.caption_counter) + '\n' + self.write_start_end(start, end) + '\n' + content.replace('\n ','\n') + '\n\n')
         
     def emit_note(self,content):
         pass
 
     def to_timestamp(self,t_ms):
         """Converts a millisecond time into a srt timestamp as a string e.g. 00:00:00,000"""
-        if t_ms is None or t_ms < 0:
-            t_ms = 0
-        
-        t = int(t_ms/1000)
-    
-        hours = int(t / 3600)
-        minutes = int(t / 60) % 60
-        seconds = t % 60
-        milli = int(t_ms) % 1000
-    
-        return '{0:02d}:{1:02d}:{2:02d},{3:03d}'.format(hours, minutes,seconds,milli)
+        return srt_timestamp(t_ms)
     
     def write_start_end(self,start_ms, end_ms):
         """Returns a srt start-end time string e.g. 00:00,000 --> 00:01,000"""
-        return '{0} --> {1}'.format( self.to_timestamp(start_ms), self.to_timestamp(end_ms))
+        return srt_timestamp(start_ms) + ' --> ' + srt_timestamp(end_ms)
+
+class PlainTextWriter(OutputBuffer):
+    def __init__(self, masker=None, parameters=None):
+        self.masker = masker or default_masker
+        self.parameters = parameters
+        self.begin()
 
-class PlainTextWriter:
+    @instrumentation.timed('caption.transcript_process_ms_json')
     def process_ms_json(self,json_results):
         """Extracts a simple text transcript using the Display property of the MS recognition json"""
-        lines = []
-        if not json_results:
-            return '[ No speech found to transcribe ]'
-        
+        self.begin()
         for segment in json_results:
-            if segment['NBest']:
-                try:
-                    rawtext = segment['NBest'][0]['Display']
-                    # Mask Profanity
-                    word_array = re.split('(\W)', rawtext) # Keep delimiters e.g. periods, colons etc as their own entries in the array
-                    # Put humpty *** dumpty together again, including original delimiters.
-                    text = ''.join( [mask_profanity(w) for w in word_array ])
-                except RuntimeError as err:
-                    print(err)
-                    text = '[ ???? ]'
-            else:
-                text = '[ Inaudible ]'
-            
-            
-            lines.append(text)                 
-        lines.extend(['','','# ' + ACKNOWLEDGEMENT_TEXT1,'# ' + ACKNOWLEDGEMENT_TEXT2])
-        return '\n'.join(lines)
+            self.add_segment(segment)
+        self.finish()
+        return self.getvalue()
 
-def main():
-    if len(sys.argv) <3 :
-        print ("Usage: {} input_json_file output[.txt | .srt | .vtt] [more_output_files]".format(sys.argv[0]) )
-        print('Output will be plain transcription text, srt captions, or webvtt captions format depending on file extension (.txt .srt or .vtt)')
-        sys.exit(1)
+    def begin(self):
+        self.reset_output()
+        self.segment_count = 0
+
+    def add_segment(self, segment):
+        self.segment_count += 1
+        if segment['NBest']:
+            try:
+                rawtext = segment['NBest'][0]['Display']
+                # Mask Profanity, keeping delimiters e.g. periods, colons etc
+                text = self.masker.mask_text(rawtext)
+            except RuntimeError as err:
+                print(err)
+                text = '[ ???? ]'
+        else:
+            text = '[ Inaudible ]'
         
-    json_file = sys.argv[1]
-    
-    with open(json_file, 'r') as in_file:
-        json_text = in_file.read()
-    
-    json_results = json.loads(json_text)
-     
-    language_tag = 'en'
-    
-    for caption_file in sys.argv[2:]:
-        caption_type = os.path.splitext(caption_file)[1][1:]     
         
-        captioner = None
-        if( caption_type == 'txt'):
-            captioner = PlainTextWriter()
-        elif( caption_type == 'vtt'):
-            captioner = VTTCaptionWriter()
-        elif( caption_type == 'srt'):
-            captioner = SrtCaptionWriter()
+        self.write(text + '\n')
+
+    def finish(self):
+        if not self.segment_count:
+            self.write('[ No speech found to transcribe ]\n')
+            return
+        p = self.parameters or default_caption_parameters()
+        self.write('\n\n# ' + p.acknowledgement_text1 + '\n# ' + p.acknowledgement_text2 + '\n')
+
+
+def create_captioner(caption_file, masker=None, parameters=None):
+    """Returns a new writer for the caption file format given by the file extension (.txt .vtt or .srt)"""
+    caption_type = os.path.splitext(caption_file)[1][1:]     
+    if( caption_type == 'txt'):
+        return PlainTextWriter(masker, parameters)
+    elif( caption_type == 'vtt'):
+        captioner = VTTCaptionWriter()
+    elif( caption_type == 'srt'):
+        captioner = SrtCaptionWriter()
+    else:
+        raise ValueError('Unrecognized caption format:\''+caption_type+'\'. Only txt, vtt or srt captions are supported')
+    captioner.masker = masker
+    captioner.parameters = parameters
+    return captioner
+
+
+class LiveCaptionWriter:
+    """Writes one or more caption files (.txt .vtt or .srt) in a single pass, one recognition result at a time, either while recognition is still running
+    (e.g. as recognizer.recognized events arrive) or streamed from a saved json file. Words are segmented into cues once and every caption format renders the same cues.
+    Each caption is written to the outputs, and flushed, as soon as it is complete. When closed each output is identical to process_ms_json of all the results.
+    outs may be text streams (e.g. socket files) to use instead of opening the caption files. All outputs share the same ProfanityMasker.
+    writers may be existing writer instances (one per caption file) to reuse instead of creating new ones"""
+    def __init__(self, caption_files, outs=None, flush=True, masker=None, writers=None, parameters=None):
+        self.writers = writers or [create_captioner(caption_file, masker, parameters) for caption_file in caption_files]
+        self.outs = outs or [open(caption_file, 'w', encoding='utf-8') for caption_file in caption_files]
+        self.flush = flush
+        self.any_written = [False] * len(self.writers)
+        self.caption_writers = [w for w in self.writers if isinstance(w, BaseCaptionWriter)]
+        self.text_writers = [w for w in self.writers if not isinstance(w, BaseCaptionWriter)]
+        self.segmenter = CaptionSegmenter(self.emit, masker, parameters)
+        self.lock = threading.Lock()
+        for writer in self.writers:
+            writer.begin()
+        self.write_new_lines()
+
+    def emit(self, start, end, content):
+        for writer in self.caption_writers:
+            writer.emit(start, end, content)
+
+    @instrumentation.timed('caption.live_append')
+    def append(self, json_segment):
+        with self.lock:
+            for writer in self.text_writers:
+                writer.add_segment(json_segment)
+            if self.caption_writers:
+                self.segmenter.add_words(segment_to_timed_words(json_segment))
+            self.write_new_lines()
+
+    def write_new_lines(self):
+        for i, writer in enumerate(self.writers):
+            # The writers only append, so written output need not be kept
+            text = writer.take_output()
+            if text:
+                out = self.outs[i]
+                # Like process_ms_json, no newline after the last line; it is written before the next line instead
+                out.write(('\n' if self.any_written[i] else '') + text[:-1])
+                if self.flush:
+                    out.flush()
+                self.any_written[i] = True
+
+    def close(self):
+        with self.lock:
+            self.segmenter.finish()
+            for writer in self.writers:
+                writer.finish()
+            self.write_new_lines()
+        for out in self.outs:
+            out.close()
+
+
+JSON_READ_SIZE = 64 * 1024 # Recognition json is read and parsed incrementally, this many characters at a time
+
+MAX_JSON_RESULT_SIZE = 16 * 1024 * 1024 # No single recognition result is anywhere near this long; a longer one means the file is not recognition json
+
+JSON_SEPARATORS = re.compile(r'[\s,\[\]]*') # Whitespace and json array punctuation between results
+
+JSON_TRUNCATION_MARGIN = 5 # A decode error this close to the end of the text read so far may just be a result cut short (e.g. 'tru' of true)
+
+def is_truncated_json(error, text):
+    """True if the JSONDecodeError could be caused by the text stopping part way through a result, rather than by invalid json"""
+    return error.msg.startswith('Unterminated string') or error.pos >= len(text) - JSON_TRUNCATION_MARGIN
+
+def iter_json_results(json_file):
+    """Yields the recognition results saved by ms_recognize_pcm one at a time - from either a json array or json lines (one result per line).
+    The file is read incrementally so memory use does not depend on the length of the recording.
+    An incomplete last result (e.g. the recognizer was stopped while writing it) is ignored; invalid json anywhere else raises ValueError with the file and offset"""
+    decoder = json.JSONDecoder()
+    with open(json_file, 'r') as in_file:
+        buffer = ''
+        buffer_start = 0 # Offset in the file (in characters) of the start of buffer
+        position = 0
+        at_eof = False
+        while True:
+            position = JSON_SEPARATORS.match(buffer, position).end()
+            if position == len(buffer):
+                if at_eof:
+                    return
+                buffer_start += len(buffer)
+                buffer = in_file.read(JSON_READ_SIZE)
+                position = 0
+                at_eof = not buffer
+                continue
+            try:
+                result, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as err:
+                if not is_truncated_json(err, buffer):
+                    raise ValueError('{}: invalid recognition json at offset {}: {}'.format(json_file, buffer_start + err.pos, err.msg)) from None
+                if at_eof:
+                    # The recognizer may have been stopped part way through writing the last result
+                    print('Ignoring incomplete last result in {}'.format(json_file))
+                    return
+                if len(buffer) - position > MAX_JSON_RESULT_SIZE:
+                    raise ValueError('{}: recognition result at offset {} is longer than {} characters'.format(json_file, buffer_start + position, MAX_JSON_RESULT_SIZE))
+                # The result continues in the next part of the file. The results already read are dropped from the buffer
+                more = in_file.read(JSON_READ_SIZE)
+                at_eof = not more
+                buffer_start += position
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            instrumentation.count('caption.json_results')
+            yield result
+
+@instrumentation.timed('caption.load_json')
+def load_json_results(json_file):
+    """Returns the array of recognition results saved by ms_recognize_pcm - either a json array or json lines (one result per line)"""
+    return list(iter_json_results(json_file))
+
+JSON_EXTENSIONS = ('.json', '.jsonl') # Files found in a batch input directory
+
+CAPTION_MANIFEST = 'captions_manifest.json' # Default manifest name for batch captioning
+
+MANIFEST_SAVE_INTERVAL_S = 5 # A batch manifest is saved at least this often (and at the end)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def caption_settings_fingerprint(masker=None, parameters=None):
+    """Returns a short hash of the settings that change the captions - so a batch or cache can tell when previously generated captions are out of date"""
+    settings = [CAPTION_FORMAT_VERSION, list(parameters or default_caption_parameters()), sorted((masker or default_masker).words)]
+    return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()[:16]
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def find_json_files(paths):
+    """Returns a list of (json_file, subdirectory) - the given files plus the recognition json files anywhere inside any given directories.
+    subdirectory is the location of the file relative to the given directory ('' for files given directly)"""
+    json_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                subdirectory = os.path.relpath(root, path)
+                json_files.extend((os.path.join(root, f), '' if subdirectory == '.' else subdirectory) for f in sorted(filenames)
+                    if f.lower().endswith(JSON_EXTENSIONS) and not f.endswith('manifest.json'))
         else:
-            print('Unrecognized caption format:\''+kind+'\'. Only txt, vtt or srt captions are supported')
+            json_files.append((path, ''))
+    return json_files
+
+
+class CaptionManifest:
+    """On-disk record of the captions generated by a batch, so that later batches can skip captions that are already up to date.
+    Each json file has an entry with its output files, the caption settings fingerprint and the json file's size, modification time and content hash"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(filename):
+            with open(filename, 'r') as in_file:
+                self.entries = json.load(in_file).get('files', {})
+
+    def update(self, json_file, entry):
+        self.entries[json_file] = entry
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        # Write then rename, so a crash never leaves a half written manifest
+        temp_file = self.filename + '.tmp'
+        with open(temp_file, 'w') as out_file:
+            json.dump({'files': self.entries}, out_file, indent=1, sort_keys=True)
+        os.replace(temp_file, self.filename)
+        self.changed = False
+
+
+# Each batch worker process keeps one masker and one set of writers, reused for every file it captions
+batch_worker = None
+
+def init_batch_worker(formats, language, profanity_lists):
+    global batch_worker
+    masker = ProfanityMasker.for_language(language, profanity_lists)
+    batch_worker = {'masker': masker, 'settings': caption_settings_fingerprint(masker),
+        'writers': [create_captioner('captions.' + caption_format, masker) for caption_format in formats]}
+
+def is_up_to_date(json_file, caption_files, entry, settings, check):
+    """True if the entry recorded by the last batch shows the caption files were made from this json file with the current settings.
+    check is 'mtime' (the caption files are newer than the json file) or 'hash' (the json file content is unchanged)"""
+    if not entry or entry.get('settings') != settings or entry.get('outputs') != caption_files:
+        return False
+    if not all(os.path.exists(caption_file) for caption_file in caption_files):
+        return False
+    if check == 'hash':
+        return entry.get('hash') == file_hash(json_file)
+    json_mtime = os.stat(json_file).st_mtime
+    return all(os.stat(caption_file).st_mtime >= json_mtime for caption_file in caption_files)
+
+def caption_batch_file(task):
+    """Batch worker - captions one json file unless its captions are up to date. Returns (status, entry or error message, word count, metrics)"""
+    result = caption_batch_file_unmetered(task)
+    # The worker's instrumentation metrics (if enabled) are added to the main process's
+    return result + (instrumentation.take_snapshot() if instrumentation.enabled else None,)
+
+def caption_batch_file_unmetered(task):
+    json_file, caption_files, entry, check, force = task
+    settings = batch_worker['settings']
+    try:
+        if not force and is_up_to_date(json_file, caption_files, entry, settings, check):
+            return 'skipped', entry, 0
+
+        # Write to temporary files first, so an interrupted batch never leaves partial captions that look up to date
+        temp_files = [caption_file + '.tmp' for caption_file in caption_files]
+        for caption_file in caption_files:
+            os.makedirs(os.path.dirname(caption_file) or '.', exist_ok=True)
+        writer = LiveCaptionWriter(temp_files, flush=False, masker=batch_worker['masker'], writers=batch_worker['writers'])
+        words = 0
+        try:
+            for segment in iter_json_results(json_file):
+                words += len(segment_to_timed_words(segment))
+                writer.append(segment)
+        finally:
+            writer.close()
+        for temp_file, caption_file in zip(temp_files, caption_files):
+            os.replace(temp_file, caption_file)
+
+        stat = os.stat(json_file)
+        entry = {'outputs': caption_files, 'settings': settings, 'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': file_hash(json_file)}
+        return 'captioned', entry, words
+    except Exception as err:
+        for caption_file in caption_files:
+            if os.path.exists(caption_file + '.tmp'):
+                os.remove(caption_file + '.tmp')
+        return 'failed', '{}: {}'.format(type(err).__name__, err), 0
+
+def plan_captions(json_files, formats, output_dir=None):
+    """Returns a list of (json_file, caption_files) for the (json_file, subdirectory) list from find_json_files, with one caption file per format.
+    The captions are saved next to the json file, or under output_dir with the same directory layout.
+    Raises ValueError if two json files would be captioned to the same files (e.g. lecture.json and lecture.jsonl)"""
+    outputs = {}
+    planned = []
+    for json_file, subdirectory in json_files:
+        directory = os.path.join(output_dir, subdirectory) if output_dir else os.path.dirname(json_file)
+        name = os.path.splitext(os.path.basename(json_file))[0]
+        caption_files = [os.path.join(directory, name + '.' + caption_format) for caption_format in formats]
+        key = os.path.normcase(os.path.abspath(caption_files[0]))
+        if key in outputs:
+            if os.path.abspath(outputs[key]) == os.path.abspath(json_file):
+                continue # The same file was given twice
+            raise ValueError('{} and {} would both be captioned as {}'.format(outputs[key], json_file, caption_files[0]))
+        outputs[key] = json_file
+        planned.append((json_file, caption_files))
+    return planned
+
+def caption_batch(json_files, manifest, workers, check='mtime', force=False, formats=('vtt', 'srt', 'txt'), language='en', profanity_lists=()):
+    """Captions the (json_file, caption_files) list from plan_captions, using a pool of worker processes. Returns a dict of counts"""
+    tasks = [(json_file, caption_files, manifest.entries.get(json_file), check, force) for json_file, caption_files in json_files]
+
+    counts = {'captioned': 0, 'skipped': 0, 'failed': 0, 'words': 0}
+    last_save = time.monotonic()
+    # Small files are common, so each worker is sent several files at a time
+    chunksize = max(1, min(32, len(tasks) // (workers * 8)))
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_batch_worker, initargs=(formats, language, list(profanity_lists))) as executor:
+        try:
+            for task, (status, result, words, metrics) in zip(tasks, executor.map(caption_batch_file, tasks, chunksize=chunksize)):
+                if metrics:
+                    instrumentation.merge(metrics)
+                counts[status] += 1
+                counts['words'] += words
+                if status == 'failed':
+                    print('{} failed: {}'.format(task[0], result), file=sys.stderr)
+                elif status == 'captioned':
+                    manifest.update(task[0], result)
+                if time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL_S:
+                    manifest.save()
+                    last_save = time.monotonic()
+        finally:
+            manifest.save()
+    return counts
+
+def render_captions(json_file, formats, masker=None, parameters=None, cache=None):
+    """Returns a dict of caption format ('vtt' 'srt' or 'txt') -> caption text for the recognition json file.
+    If cache is a CaptionCache, captions previously made from the same json content with the same settings are returned from the cache, and new captions are added to it"""
+    keys = {}
+    texts = {}
+    if cache:
+        input_hash = file_hash(json_file)
+        settings = caption_settings_fingerprint(masker, parameters)
+        for caption_format in formats:
+            keys[caption_format] = caption_cache.cache_key(input_hash, settings, caption_format)
+            text = cache.get(keys[caption_format])
+            if text is not None:
+                texts[caption_format] = text
+
+    missing = [caption_format for caption_format in formats if caption_format not in texts]
+    if missing:
+        json_results = load_json_results(json_file)
+        writers = [create_captioner('captions.' + caption_format, masker, parameters) for caption_format in missing]
+        cues = None
+        for caption_format, writer in zip(missing, writers):
+            if isinstance(writer, BaseCaptionWriter):
+                # Segment once for all of the caption formats
+                if cues is None:
+                    cues = segment_ms_json(json_results, masker, parameters)
+                texts[caption_format] = writer.render_cues(cues)
+            else:
+                texts[caption_format] = writer.process_ms_json(json_results)
+            if cache:
+                cache.put(keys[caption_format], texts[caption_format])
+    return texts
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='{} batch'.format(sys.argv[0]), description='Generates captions for many recognition json files (e.g. an archive, after changing the caption settings), using several processes. '
+        'Captions that are already up to date with the json file and the current settings are skipped.')
+    parser.add_argument('inputs', nargs='+', help='json files and/or directories that are searched (recursively) for .json and .jsonl files')
+    parser.add_argument('--formats', nargs='+', choices=['vtt', 'srt', 'txt'], default=['vtt', 'srt', 'txt'], help='caption formats to generate (default: all three)')
+    parser.add_argument('--output-dir', help='directory for the captions, keeping the layout of the input directories (default: next to each json file)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--check', choices=['mtime', 'hash'], default='mtime', help='how to decide whether a json file changed since its captions were made: modification times (default) or content hash')
+    parser.add_argument('--force', action='store_true', help='regenerate all captions, even if they are up to date')
+    parser.add_argument('--manifest', help='batch manifest file (default: {} in the output directory or current directory)'.format(CAPTION_MANIFEST))
+    parser.add_argument('--profanity-list', action='append', default=[], metavar='FILE', help='additional words to mask, one per line. May be repeated')
+    parser.add_argument('--language', default='en', help='also mask the words listed in profanity/LANGUAGE.txt, if it exists (default: en)')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    manifest = CaptionManifest(args.manifest or os.path.join(args.output_dir or '.', CAPTION_MANIFEST))
+    try:
+        json_files = plan_captions(find_json_files(args.inputs), args.formats, args.output_dir)
+    except ValueError as err:
+        parser.error('{}. Caption them separately (or with different --output-dir)'.format(err))
+    print('{} json files'.format(len(json_files)))
+
+    started = time.monotonic()
+    counts = caption_batch(json_files, manifest, args.workers, args.check, args.force, args.formats, args.language, args.profanity_list)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print('{} captioned, {} already up to date, {} failed in {:.1f} seconds'.format(counts['captioned'], counts['skipped'], counts['failed'], elapsed))
+    print('{:.1f} files/s, {:.0f} words/s'.format(len(json_files) / elapsed, counts['words'] / elapsed))
+    if counts['failed']:
+        sys.exit(2)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        return batch_main(sys.argv[2:])
+    parser = argparse.ArgumentParser(description='Converts the json speech recognition results saved by ms_recognize_pcm into captions. '
+        'Output will be plain transcription text, srt captions, or webvtt captions format depending on file extension (.txt .srt or .vtt)')
+    parser.add_argument('json_file', help='input json file (.json or .jsonl)')
+    parser.add_argument('caption_files', nargs='+', metavar='output', help='output file[s] (.txt .srt or .vtt)')
+    parser.add_argument('--profanity-list', action='append', default=[], metavar='FILE', help='additional words to mask, one per line. May be repeated')
+    parser.add_argument('--language', default='en', help='also mask the words listed in profanity/LANGUAGE.txt, if it exists (default: en)')
+    parser.add_argument('--cache-dir', help='reuse captions previously made from the same json and settings, from this cache directory (and add new captions to it)')
+    parser.add_argument('--cache-size', type=int, default=caption_cache.DEFAULT_MAX_BYTES // (1024 * 1024), help='cache size limit in megabytes; the least recently used captions are removed (default: %(default)s)')
+    args = parser.parse_args()
+
+    masker = ProfanityMasker.for_language(args.language, args.profanity_list)
+    if args.cache_dir:
+        formats = [os.path.splitext(caption_file)[1][1:] for caption_file in args.caption_files]
+        unknown = [caption_format for caption_format in formats if caption_format not in ('vtt', 'srt', 'txt')]
+        if unknown:
+            print('Unrecognized caption format:\''+unknown[0]+'\'. Only txt, vtt or srt captions are supported')
             sys.exit(1)
-    
-        captions = captioner.process_ms_json(json_results)
-    
-        with open(caption_file, 'w', encoding='utf-8') as out_file:
-            out_file.write(captions)
+        cache = caption_cache.CaptionCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        texts = render_captions(args.json_file, formats, masker, cache=cache)
+        for caption_file, caption_format in zip(args.caption_files, formats):
+            with open(caption_file, 'w', encoding='utf-8') as out_file:
+                out_file.write(texts[caption_format])
+        sys.exit(0)
+
+    try:
+        writers = [create_captioner(caption_file, masker) for caption_file in args.caption_files]
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+
+    # Stream the results through the segmentation into all of the caption files in one pass, so that memory use stays flat for long recordings.
+    # The captions are written to temporary files and renamed when complete, so a bad json file does not overwrite existing captions
+    temp_files = [caption_file + '.tmp' for caption_file in args.caption_files]
+    outs = [open(temp_file, 'w', encoding='utf-8') for temp_file in temp_files]
+    writer = LiveCaptionWriter(args.caption_files, outs=outs, flush=False, masker=masker, writers=writers)
+    try:
+        for segment in iter_json_results(args.json_file):
+            writer.append(segment)
+        writer.close()
+    except (OSError, ValueError) as err:
+        for out, temp_file in zip(outs, temp_files):
+            out.close()
+            os.remove(temp_file)
+        print(err)
+        sys.exit(1)
+    for temp_file, caption_file in zip(temp_files, args.caption_files):
+        os.replace(temp_file, caption_file)
     sys.exit(0)
    
 
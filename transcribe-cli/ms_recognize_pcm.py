@@ -35,72 +35,247 @@
 # https://docs.microsoft.com/en-us/azure/cognitive-services/speech-service/batch-transcription#supported-formats
 
 
-import azure.cognitiveservices.speech as speechsdk
 import os
 import sys
 import atexit
-import time
 import json
+import time
+import argparse
+import asyncio
+import functools
+import tempfile
+import collections
+import concurrent.futures
+import threading
+import weakref
+
+import pcm_audio
+from pcm_audio import TICKS_PER_MS
+import local_recognizer
+import ms_json_to_caption
+import instrumentation
+
+speechsdk = None # azure.cognitiveservices.speech is imported when the Azure backend is first used
+
+# Parallel (--workers) recognition splits the audio into chunks at quiet points and recognizes the chunks concurrently
+MIN_CHUNK_MS = 60 * 1000 # Very short chunks lose recognition context
+MAX_CHUNK_MS = 10 * 60 * 1000 # Long recordings are split into more chunks than workers, so a failure or slow chunk costs less
+CHUNK_SEARCH_MS = 15 * 1000 # Look this far either side of the nominal chunk boundary for the quietest point to split
+CHUNK_OVERLAP_MS = 2000 # Neighbouring chunks share this much audio so that words near a boundary are still heard in full
+QUIET_WINDOW_MS = 300 # Length of the quiet run that we look for at a boundary
+
+AUDIO_EXTENSIONS = ('.wav', '.pcm') # Files found in a batch input directory
+MEDIA_EXTENSIONS = ('.mp4', '.m4a', '.mov', '.mkv', '.webm', '.mp3', '.aac', '.flac', '.ogg') # ... also found, and decoded by ffmpeg as they are recognized
+
+FLUSH_INTERVAL_S = 5 # Recognition results are streamed to the output file at least this often
+FLUSH_BYTES = 64 * 1024 # ... or sooner if this much json is waiting to be written
 
+# Times are in milliseconds. Words are kept only if they start inside [keep_start_ms, keep_end_ms)
+Chunk = collections.namedtuple('Chunk', 'start_ms end_ms keep_start_ms keep_end_ms')
 
-recognizers = []
+
+# Every RecognitionJob that is still alive, so that running recognitions can be stopped at exit
+jobs = weakref.WeakSet()
 
 def shutdown_recognizers():
-    global recognizers
-    while len(recognizers)>0:
-        recognizer = recognizers.pop()
-        try:
-            # dont waste resources with any long running transcriptions
-            recognizer.stop_continuous_recognition()
-        except Error as ignored:
-              print(ignored)
+    for job in list(jobs):
+        job.shutdown()
 
 atexit.register(shutdown_recognizers)
 
-def recognize_pcm_audio_file_to_ms_json(input_pcm_file):
-    """Performs speech recognition and returns MS-cognitive-services specific json array """
-    global recognizers
-    
+
+def create_speech_config():
+    """Returns a SpeechConfig for word level recognition using the speech_key and service_region"""
+    global speechsdk
+    if speechsdk is None:
+        import azure.cognitiveservices.speech as speechsdk
     # <SpeechContinuousRecognitionWithFile>
     speech_config = speechsdk.SpeechConfig(subscription=speech_key, region=service_region)
     
     speech_config.request_word_level_timestamps()
     #https://docs.microsoft.com/en-us/python/api/azure-cognitiveservices-speech/azure.cognitiveservices.speech.profanityoption?view=azure-python
     speech_config.set_profanity(speechsdk.ProfanityOption.Masked)
-    
-    audio_config = speechsdk.audio.AudioConfig(filename=input_pcm_file)
+    return speech_config
+
+
+# A recognizer backend has a create_recognizer(audio) method. audio is a 16KHz mono PCM file name, or a decoder (see pcm_audio.open_audio) whose blocks() yields the PCM audio.
+# The returned recognizer must behave like the SDK SpeechRecognizer: recognized, session_stopped and canceled signals to connect callbacks to,
+# and start_continuous_recognition() / stop_continuous_recognition(). See local_recognizer.LocalRecognizer
+
+class AzureBackend:
+    """Recognition by Microsoft Cognitive Services, using the azure-cognitiveservices-speech SDK"""
+    name = 'azure'
+
+    def __init__(self):
+        self.speech_config = create_speech_config()
+
+    def create_recognizer(self, audio):
+        if not hasattr(audio, 'blocks'):
+            audio_config = speechsdk.audio.AudioConfig(filename=audio)
+            return speechsdk.SpeechRecognizer(speech_config=self.speech_config, audio_config=audio_config)
+        # Decoded audio is written into a push stream as it is decoded; recognition starts with the first block
+        stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=pcm_audio.SAMPLE_RATE, bits_per_sample=pcm_audio.SAMPLE_WIDTH * 8, channels=1)
+        stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+        recognizer = speechsdk.SpeechRecognizer(speech_config=self.speech_config, audio_config=speechsdk.audio.AudioConfig(stream=stream))
+        threading.Thread(target=push_audio, args=(audio, stream), name='PushAudio', daemon=True).start()
+        return recognizer
+
+
+def push_audio(audio, stream):
+    """Writes the blocks of the decoder into the SDK push stream, then closes the stream (the end of the audio) and the decoder"""
+    try:
+        for block in audio.blocks():
+            stream.write(block)
+    except Exception as err:
+        # Reported when the session stops (see start_recognition)
+        audio.error = audio.error or str(err)
+    finally:
+        stream.close()
+        audio.close()
+
+
+def create_backend(name, local_speed=0):
+    """Returns the recognizer backend called name ('azure' or 'local')"""
+    if name == 'local':
+        return local_recognizer.LocalBackend(speed=local_speed)
+    if name == 'azure':
+        return AzureBackend()
+    raise ValueError('Unknown recognizer backend: {}'.format(name))
+
+
+class RecognitionJob:
+    """A group of recognitions that share one recognizer backend (and so one SpeechConfig). Keeps track of the running recognizers (safely from any thread) so they can all be stopped.
+    If silence_level is set, long silences quieter than this are removed before recognition (see pcm_audio.SilenceFilter); the results still use the times of the original audio"""
+    def __init__(self, backend=None, silence_level=None):
+        self.backend = backend or AzureBackend()
+        self.silence_level = silence_level
+        self.recognizers = {} # recognizer -> the future of its result
+        self.lock = threading.Lock()
+        self.closed = False # After shutdown() no more recognitions can start
+        self.audio_ms = 0 # Of the recognitions that used the silence filter
+        self.skipped_ms = 0
+        jobs.add(self)
+
+    def add(self, recognizer, future=None):
+        with self.lock:
+            if self.closed:
+                # e.g. a chunk that a worker thread picked up just as another chunk failed
+                raise RuntimeError('The recognition job has been shut down')
+            self.recognizers[recognizer] = future
+
+    def remove(self, recognizer):
+        """Forgets the recognizer. Returns True if it was still running i.e. the caller is responsible for stopping it"""
+        with self.lock:
+            return self.recognizers.pop(recognizer, False) is not False
+
+    def add_skipped_silence(self, silence_filter, counted_from_ms=0):
+        """Adds the audio read by the silence filter, and the silence it removed, from counted_from_ms onwards to the totals"""
+        audio_ms = max(0, silence_filter.duration_ms - counted_from_ms)
+        skipped_ms = silence_filter.skipped_ms_from(counted_from_ms) if counted_from_ms else silence_filter.skipped_ms
+        with self.lock:
+            self.audio_ms += audio_ms
+            self.skipped_ms += skipped_ms
+        instrumentation.count('recognize.filtered_audio_ms', audio_ms)
+        instrumentation.count('recognize.skipped_silence_ms', skipped_ms)
 
-    recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+    def silence_report(self):
+        """Returns a summary of the audio hours that were not sent for recognition"""
+        with self.lock:
+            audio_hours, skipped_hours = self.audio_ms / 3600000, self.skipped_ms / 3600000
+        return 'Skipped {:.2f} of {:.2f} audio hours as silence ({:.0%}); {:.2f} hours recognized'.format(
+            skipped_hours, audio_hours, skipped_hours / audio_hours if audio_hours else 0, audio_hours - skipped_hours)
+
+    def shutdown(self):
+        """Stops every running recognition and refuses new ones. Their futures are cancelled, so that anyone waiting for a result stops waiting"""
+        with self.lock:
+            self.closed = True
+            running, self.recognizers = self.recognizers, {}
+        for recognizer, future in running.items():
+            try:
+                # dont waste resources with any long running transcriptions
+                recognizer.stop_continuous_recognition()
+            except Exception as ignored:
+                print(ignored)
+            if future is not None:
+                future.cancel()
+
+
+def start_recognition(input_pcm_file, job=None, json_results=None, counted_from_ms=0):
+    """Starts continuous speech recognition of the file. Returns a concurrent.futures.Future that completes with the MS-cognitive-services specific json array (or the recognition error) when the session stops.
+    A file (or URL, or binary stream) that is not 16KHz mono PCM is decoded by ffmpeg while it is recognized (see pcm_audio.open_audio).
+    Each recognized segment is appended to json_results as soon as it arrives; this can be a list (the default) or a JsonResultWriter to stream the results to disk.
+    Only the audio from counted_from_ms onwards is added to the job's silence totals (e.g. a chunk that overlaps the previous chunk)"""
+    job = job or RecognitionJob()
+    
+    audio = pcm_audio.open_audio(input_pcm_file)
+    silence_filter = None
+    if job.silence_level is not None:
+        audio = silence_filter = pcm_audio.SilenceFilter(audio, job.silence_level)
+    try:
+        recognizer = job.backend.create_recognizer(audio)
+    except BaseException:
+        if audio is not input_pcm_file:
+            audio.close()
+        raise
 
     # For an empty file throws RuntimeError: Exception with an error code: 0x9 (SPXERR_UNEXPECTED_EOF)
     # For a missing file RuntimeError: Exception with an error code: 0x8 (SPXERR_FILE_OPEN_FAILED)
     # RuntimeError: Exception with an error code: 0x8 (SPXERR_FILE_OPEN_FAILED)
     # Garbage text file: RuntimeError: Exception with an error code: 0xa (SPXERR_INVALID_HEADER)
     
-    recognizers.append(recognizer)
-    
-    done = False
-    json_results = []
-    error_messages = []
+    future = concurrent.futures.Future()
+    try:
+        job.add(recognizer, future)
+    except RuntimeError:
+        if audio is not input_pcm_file:
+            audio.close()
+        raise
+    # So that a caller that gives up waiting can stop the recognition
+    future.recognizer = recognizer
+    future.job = job
+    if hasattr(audio, 'close'):
+        # Stops the decoder if the recognition ends early, e.g. on a timeout
+        future.add_done_callback(lambda _: audio.close())
+    if json_results is None:
+        json_results = []
+    session_started = time.monotonic()
+    instrumentation.count('recognize.sessions')
     
     def stop_cb(event):
-        if recognizer in recognizers:
-            recognizers.remove(recognizer)
+        if job.remove(recognizer):
+            instrumentation.observe('recognize.session', time.monotonic() - session_started)
             recognizer.stop_continuous_recognition()
+            if silence_filter is not None:
+                # Before the result is set, so that a waiting caller sees the totals
+                job.add_skipped_silence(silence_filter, counted_from_ms)
+            if not future.set_running_or_notify_cancel():
+                return # The caller has already given up (see stop_recognition)
              # SDK docs claims error_details can be None. In practice it is an empty string for EOF cancel event, so using as a boolean treats both of these as false
-            if event.cancellation_details.error_details:
-                nonlocal error_messages
-                error_messages.append( event.cancellation_details.error_details )
-            # Do this last
-            nonlocal done
-            done = True
- 
+            # A decoder that failed (e.g. ffmpeg could not read the input) just ends the audio stream, so its error is checked here
+            error_details = event.cancellation_details.error_details or getattr(audio, 'error', None)
+            if error_details:
+                # truncated 1000byte PCM file - "RuntimeError: Exception with an error code: 0x9 (SPXERR_UNEXPECTED_EOF)
+                # Bad API key - "WebSocket Upgrade failed with an authentication error (401). Please check for correct subscription key (or authorization token) and region name.
+                future.set_exception(RuntimeError(error_details))
+            else:
+                future.set_result(json_results)
+
     def recognized_cb(event):
-        nonlocal json_results
+        started = instrumentation.clock()
         print(event)
         # event.result.json is actually a string, so we parse it here to check for validity
         
-        json_results.append( json.loads(event.result.json) )
+        segment = json.loads(event.result.json)
+        # How long after the start of recognition each result arrives, minus the time into the (recognized) audio that the result ends:
+        # a growing lag means recognition is slower than real time
+        audio_end_s = (segment.get('Offset', 0) + segment.get('Duration', 0)) / TICKS_PER_MS / 1000
+        if silence_filter is not None:
+            restore_silence_offsets(segment, silence_filter)
+        json_results.append( segment )
+        if started is not None:
+            instrumentation.stop('recognize.recognized_cb', started)
+            instrumentation.count('recognize.results')
+            instrumentation.observe('recognize.result_lag', time.monotonic() - session_started - audio_end_s)
 
     recognizer.recognized.connect(recognized_cb) # Here are the words!
 
@@ -109,34 +284,464 @@ def recognize_pcm_audio_file_to_ms_json(input_pcm_file):
     recognizer.canceled.connect(stop_cb)
 
     recognizer.start_continuous_recognition()
-    while not done:
-        time.sleep(.5)
-
-    if error_messages: 
-        raise RuntimeError( ','.join(error_messages))
-# truncated 1000byte PCM file - "RuntimeError: Exception with an error code: 0x9 (SPXERR_UNEXPECTED_EOF)
-# Bad API key - "WebSocket Upgrade failed with an authentication error (401). Please check for correct subscription key (or authorization token) and region name.
-            
+    return future
+
+
+def stop_recognition(future):
+    """Abandons a recognition started by start_recognition"""
+    if future.job.remove(future.recognizer):
+        future.recognizer.stop_continuous_recognition()
+    future.cancel()
+
+
+@instrumentation.timed('recognize.file')
+def recognize_pcm_audio_file_to_ms_json(input_pcm_file, timeout=None, job=None, json_results=None, counted_from_ms=0):
+    """Performs speech recognition and returns MS-cognitive-services specific json array (see start_recognition for json_results and counted_from_ms). Raises TimeoutError if recognition takes longer than timeout seconds.
+    The input can also be any media file, URL or binary stream that ffmpeg can decode; it is decoded as it is recognized, without an intermediate audio file"""
+    future = start_recognition(input_pcm_file, job, json_results, counted_from_ms)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        stop_recognition(future)
+        raise TimeoutError('Recognition of {} did not complete within {} seconds'.format(input_pcm_file, timeout))
+
+
+async def recognize_async(input_pcm_file, timeout=None, job=None, json_results=None):
+    """Awaitable version of recognize_pcm_audio_file_to_ms_json. Many recognitions can be awaited concurrently without a waiting thread per file"""
+    future = start_recognition(input_pcm_file, job, json_results)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        stop_recognition(future)
+        raise TimeoutError('Recognition of {} did not complete within {} seconds'.format(input_pcm_file, timeout))
+
+def plan_chunks(levels, duration_ms, workers):
+    """Returns a list of overlapping Chunks covering the audio, split at the quietest point near each nominal boundary.
+    levels are the audio frame levels from pcm_audio.frame_levels"""
+    frame_ms = pcm_audio.FRAME_MS
+    chunk_ms = min(MAX_CHUNK_MS, max(MIN_CHUNK_MS, -(-duration_ms // max(1, workers))))
+
+    cuts = [0]
+    while duration_ms - cuts[-1] > chunk_ms + CHUNK_SEARCH_MS:
+        target = cuts[-1] + chunk_ms
+        frame = pcm_audio.quietest_frame(levels, (target - CHUNK_SEARCH_MS) // frame_ms, (target + CHUNK_SEARCH_MS) // frame_ms, QUIET_WINDOW_MS // frame_ms)
+        cuts.append(frame * frame_ms)
+    cuts.append(duration_ms)
+
+    half_overlap = CHUNK_OVERLAP_MS // 2
+    chunks = []
+    for i in range(len(cuts) - 1):
+        keep_start = cuts[i] if i > 0 else float('-inf')
+        keep_end = cuts[i + 1] if i + 2 < len(cuts) else float('inf')
+        chunks.append(Chunk(max(0, cuts[i] - half_overlap), min(duration_ms, cuts[i + 1] + half_overlap), keep_start, keep_end))
+    return chunks
+
+
+def rebase_chunk_results(json_results, chunk):
+    """Converts the chunk-relative segment and word offsets to absolute ticks and drops the words (and segments) that belong to a neighbouring chunk"""
+    base = chunk.start_ms * TICKS_PER_MS
+    keep_start, keep_end = chunk.keep_start_ms * TICKS_PER_MS, chunk.keep_end_ms * TICKS_PER_MS
+    kept = []
+    for segment in json_results:
+        segment['Offset'] += base
+        for alternative in segment.get('NBest') or []:
+            for word in alternative.get('Words') or []:
+                word['Offset'] += base
+
+        words = segment_words(segment)
+        if words:
+            owned = [w for w in words if keep_start <= w['Offset'] < keep_end]
+            if not owned:
+                continue
+            if len(owned) < len(words):
+                trim_segment(segment, owned)
+        elif not keep_start <= segment['Offset'] < keep_end:
+            continue
+        kept.append(segment)
+    return kept
+
+
+def restore_silence_offsets(segment, silence_filter):
+    """Converts the segment and word offsets from times in the audio without silences (see pcm_audio.SilenceFilter) back to times in the original audio.
+    Word durations are unchanged; a segment that spans a removed silence is lengthened to include it"""
+    offset = segment.get('Offset', 0)
+    end = silence_filter.original_ticks(offset + segment.get('Duration', 0), end=True)
+    segment['Offset'] = silence_filter.original_ticks(offset)
+    if 'Duration' in segment:
+        segment['Duration'] = end - segment['Offset']
+    for alternative in segment.get('NBest') or []:
+        for word in alternative.get('Words') or []:
+            word['Offset'] = silence_filter.original_ticks(word['Offset'])
+
+
+def merge_chunk_results(json_results, chunk_results, previous_end=None):
+    """Appends the (rebased) segments of the next chunk to json_results, dropping leading words that repeat words already heard at the end of the previous chunk.
+    previous_end is the end (in ticks) of the last word of the previous chunk. Returns the end of the last word appended"""
+    check_duplicates = previous_end is not None
+    for segment in chunk_results:
+        words = segment_words(segment)
+        if check_duplicates and words:
+            # A word that starts before the previous word has finished was recognized twice in the overlap
+            duplicates = 0
+            while duplicates < len(words) and words[duplicates]['Offset'] < previous_end:
+                duplicates += 1
+            if duplicates == len(words):
+                continue
+            if duplicates:
+                trim_segment(segment, words[duplicates:])
+            check_duplicates = False
+        json_results.append(segment)
+        words = segment_words(segment)
+        if words:
+            previous_end = words[-1]['Offset'] + words[-1]['Duration']
+    return previous_end
+
+
+def segment_words(segment):
+    """Returns the word timings of the best recognition alternative, or an empty list"""
+    nbest = segment.get('NBest')
+    return nbest[0].get('Words') or [] if nbest else []
+
+
+def trim_segment(segment, words):
+    """Replaces the words of the segment with a subset of them, keeping the segment timing and text consistent"""
+    best = segment['NBest'][0]
+    best['Words'] = words
+    text = ' '.join(w['Word'] for w in words)
+    for key in ('Display', 'ITN', 'Lexical', 'MaskedITN'):
+        if key in best:
+            best[key] = text
+    segment['NBest'] = [best] # Other alternatives no longer describe the same audio
+    segment['Offset'] = words[0]['Offset']
+    segment['Duration'] = words[-1]['Offset'] + words[-1]['Duration'] - words[0]['Offset']
+
+
+def recognize_pcm_audio_file_in_chunks(input_pcm_file, workers, recognize=None, json_results=None, job=None):
+    """Splits the audio into overlapping chunks, recognizes up to workers chunks concurrently and returns the merged MS-cognitive-services specific json array.
+    recognize(chunk_wav_file) returns the json array for one chunk (defaults to recognize_pcm_audio_file_to_ms_json with job, or a new RecognitionJob).
+    Each chunk is recognized as soon as its audio has been written. If any chunk fails the recognitions of job are stopped, rather than paying for the rest.
+    The merged segments are appended to json_results (a list by default, or a JsonResultWriter) as each chunk in turn completes"""
+    default_recognize = recognize is None
+    if default_recognize:
+        job = job or RecognitionJob()
+        recognize = functools.partial(recognize_pcm_audio_file_to_ms_json, job=job)
+    if json_results is None:
+        json_results = []
+
+    with pcm_audio.PcmReader(input_pcm_file) as reader, tempfile.TemporaryDirectory(prefix='ms_recognize_') as temp_dir:
+        levels = pcm_audio.frame_levels(reader.blocks())
+        chunks = plan_chunks(levels, reader.duration_ms, workers)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        futures = []
+        try:
+            for i, chunk in enumerate(chunks):
+                chunk_file = os.path.join(temp_dir, 'chunk{:05d}.wav'.format(i))
+                pcm_audio.write_wav(chunk_file, reader.read(chunk.start_ms, chunk.end_ms))
+                if default_recognize and i > 0:
+                    # The start of the chunk is also the end of the previous chunk, whose audio is already counted in the silence totals
+                    futures.append(executor.submit(recognize, chunk_file, counted_from_ms=chunks[i - 1].end_ms - chunk.start_ms))
+                else:
+                    futures.append(executor.submit(recognize, chunk_file))
+
+            # Results are merged in chunk order as they complete, but a failure of any chunk is raised as soon as it happens
+            merged = 0
+            previous_end = None
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                while merged < len(futures) and futures[merged].done():
+                    previous_end = merge_chunk_results(json_results, rebase_chunk_results(futures[merged].result(), chunks[merged]), previous_end)
+                    merged += 1
+        except BaseException:
+            if job is not None:
+                job.shutdown()
+            executor.shutdown(cancel_futures=True)
+            raise
+        executor.shutdown()
     return json_results
 
+
 def save_json(json_results, filename):
     with open(filename, 'w') as out_file:
         json.dump(json_results, out_file)
 
 
-def main():   
-    if len(sys.argv) != 3:
-        print ("Usage: {} input_mono_16KHz_pcm_file output_json_file".format(sys.argv[0]) )
-        sys.exit(1)
-    if not speech_key:
+class JsonResultWriter:
+    """Streams recognition results to disk as they arrive, so memory use stays flat and a crash loses at most the last few seconds.
+    Files ending in .jsonl are written as json lines (one segment per line); otherwise a json array is written that is valid after every flush.
+    Pending results are written once flush_interval seconds have passed since the last write or flush_bytes are waiting. Safe to append from any thread"""
+    def __init__(self, filename, flush_interval=FLUSH_INTERVAL_S, flush_bytes=FLUSH_BYTES):
+        self.filename = filename
+        self.json_lines = filename.endswith('.jsonl')
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.count = 0
+        self.last_flush = time.monotonic()
+        self.file = open(filename, 'w')
+        if not self.json_lines:
+            self.file.write('[')
+            self.end_position = self.file.tell() # The closing ] is overwritten by the next results
+            self.file.write(']')
+            self.file.flush()
+
+    def append(self, segment):
+        text = json.dumps(segment)
+        with self.lock:
+            self.pending.append(text)
+            self.pending_bytes += len(text)
+            if self.pending_bytes >= self.flush_bytes or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.write_pending()
+
+    def __len__(self):
+        return self.count + len(self.pending)
+
+    def flush(self):
+        with self.lock:
+            self.write_pending()
+
+    def write_pending(self):
+        if self.pending:
+            if self.json_lines:
+                self.file.write('\n'.join(self.pending) + '\n')
+            else:
+                self.file.seek(self.end_position)
+                self.file.write((',\n' if self.count else '') + ',\n'.join(self.pending))
+                self.end_position = self.file.tell()
+                self.file.write(']')
+            self.count += len(self.pending)
+            self.pending = []
+            self.pending_bytes = 0
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResultSinks:
+    """Passes each recognition result on to several destinations e.g. a JsonResultWriter and LiveCaptionWriters"""
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def append(self, segment):
+        for sink in self.sinks:
+            sink.append(segment)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JobManifest:
+    """On-disk record of a batch run so that an interrupted run can resume without re-transcribing finished files.
+    Each input file has an entry with its status ('running', 'done' or 'failed'), output file and the input size and modification time when it was recognized"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as in_file:
+                self.entries = json.load(in_file).get('files', {})
+
+    def is_done(self, input_file, output_file):
+        """True if the input file (unchanged since) was already recognized into output_file"""
+        entry = self.entries.get(input_file)
+        if not entry or entry.get('status') != 'done' or entry.get('output') != output_file or not os.path.exists(output_file):
+            return False
+        try:
+            stat = os.stat(input_file)
+        except OSError:
+            return False
+        return entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime
+
+    def update(self, input_file, output_file, status, error=None):
+        entry = {'status': status, 'output': output_file}
+        try:
+            stat = os.stat(input_file)
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+        except OSError:
+            pass # e.g. the input was deleted (or never existed); recorded without its size, so it is never taken to be done
+        if error:
+            entry['error'] = error
+        with self.lock:
+            self.entries[input_file] = entry
+            self.save()
+
+    def save(self):
+        # Write then rename, so a crash never leaves a half written manifest
+        temp_file = self.filename + '.tmp'
+        with open(temp_file, 'w') as out_file:
+            json.dump({'files': self.entries}, out_file, indent=1, sort_keys=True)
+        os.replace(temp_file, self.filename)
+
+
+def find_audio_files(paths):
+    """Returns a list of (audio_file, subdirectory) - the given files plus the audio (.wav .pcm) and media (e.g. .mp4) files anywhere inside any given directories.
+    subdirectory is the location of the file relative to the given directory ('' for files given directly)"""
+    audio_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                subdirectory = os.path.relpath(root, path)
+                audio_files.extend((os.path.join(root, f), '' if subdirectory == '.' else subdirectory) for f in sorted(filenames)
+                    if f.lower().endswith(AUDIO_EXTENSIONS + MEDIA_EXTENSIONS))
+        else:
+            audio_files.append((path, ''))
+    return audio_files
+
+
+def plan_outputs(audio_files, output_dir=None):
+    """Returns a list of (audio_file, output_file) for the (audio_file, subdirectory) list from find_audio_files.
+    The json is saved next to the audio file, or under output_dir with the same directory layout.
+    Raises ValueError if two audio files would be saved to the same json file (e.g. lecture.mov and lecture.wav)"""
+    outputs = {}
+    planned = []
+    for audio_file, subdirectory in audio_files:
+        directory = os.path.join(output_dir, subdirectory) if output_dir else os.path.dirname(audio_file)
+        output_file = os.path.join(directory, os.path.splitext(os.path.basename(audio_file))[0] + '.json')
+        key = os.path.normcase(os.path.abspath(output_file))
+        if key in outputs:
+            if os.path.abspath(outputs[key]) == os.path.abspath(audio_file):
+                continue # The same file was given twice
+            raise ValueError('{} and {} would both be saved as {}'.format(outputs[key], audio_file, output_file))
+        outputs[key] = audio_file
+        planned.append((audio_file, output_file))
+    return planned
+
+
+async def recognize_batch(audio_files, manifest, concurrency, timeout=None, backend=None, silence_level=None):
+    """Recognizes the (audio_file, output_file) list from plan_outputs, at most concurrency at a time. Files the manifest records as done are skipped. Returns the number of failures"""
+    job = RecognitionJob(backend, silence_level)
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def recognize_one(audio_file, output_file):
+        nonlocal failures
+        if manifest.is_done(audio_file, output_file):
+            print('Skipping {} (already recognized)'.format(audio_file))
+            return
+        async with semaphore:
+            try:
+                os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+                manifest.update(audio_file, output_file, 'running')
+                with JsonResultWriter(output_file) as json_results:
+                    await recognize_async(audio_file, timeout, job, json_results)
+            except Exception as err:
+                failures += 1
+                print('{} failed: {}'.format(audio_file, err), file=sys.stderr)
+                manifest.update(audio_file, output_file, 'failed', str(err))
+                return
+            manifest.update(audio_file, output_file, 'done')
+
+    try:
+        await asyncio.gather(*[recognize_one(audio_file, output_file) for audio_file, output_file in audio_files])
+    finally:
+        job.shutdown()
+    if silence_level is not None:
+        print(job.silence_report())
+    return failures
+
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='{} batch'.format(sys.argv[0]), description='Speech recognition of many audio (or video) files, sharing one connection configuration. Progress is recorded in a manifest so an interrupted batch can be resumed. '
+        'Files that are not 16KHz mono PCM are decoded by ffmpeg as they are recognized.')
+    parser.add_argument('inputs', nargs='+', help='audio or video files and/or directories of .wav .pcm and media (e.g. .mp4 .mp3) files')
+    parser.add_argument('--output-dir', help='directory for the json results (default: next to each audio file)')
+    parser.add_argument('--concurrency', type=int, default=4, help='maximum number of recognitions at the same time')
+    parser.add_argument('--manifest', help='job manifest file (default: ms_recognize_manifest.json in the output directory or current directory)')
+    parser.add_argument('--timeout', type=float, default=None, help='give up on a file if its recognition takes longer than TIMEOUT seconds')
+    add_backend_arguments(parser)
+    add_silence_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    backend = backend_from_args(args)
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    manifest = JobManifest(args.manifest or os.path.join(args.output_dir or '.', 'ms_recognize_manifest.json'))
+    try:
+        audio_files = plan_outputs(find_audio_files(args.inputs), args.output_dir)
+    except ValueError as err:
+        parser.error('{}. Recognize them separately (or with different --output-dir)'.format(err))
+    print('{} audio files'.format(len(audio_files)))
+
+    failures = asyncio.run(recognize_batch(audio_files, manifest, args.concurrency, args.timeout, backend, silence_level_from_args(args)))
+    if failures:
+        print('{} of {} files failed. Run the same command again to retry them'.format(failures, len(audio_files)))
+        sys.exit(2)
+
+
+def add_backend_arguments(parser):
+    parser.add_argument('--backend', choices=['azure', 'local'], default='azure', help='speech recognizer to use. The local recognizer is an offline stand-in for load testing; it does not recognize real words')
+    parser.add_argument('--local-speed', type=float, default=0, help='speed of the local recognizer as a multiple of real time (default: as fast as possible)')
+
+
+def add_silence_arguments(parser):
+    parser.add_argument('--skip-silence', action='store_true', help='do not send silences longer than {:g} seconds for recognition; the results still use the times of the original audio'.format(pcm_audio.MIN_SKIPPED_SILENCE_MS / 1000))
+    parser.add_argument('--silence-level', type=int, default=pcm_audio.SILENCE_LEVEL, help='with --skip-silence, audio with a mean absolute (16 bit) sample value at or below this is silence (default: %(default)s)')
+
+
+def silence_level_from_args(args):
+    return args.silence_level if args.skip_silence else None
+
+
+def backend_from_args(args):
+    if args.backend == 'azure' and not speech_key:
         print('Please set speech_key environment variable to your cognitive-services-key (and also azure_region if not westus)')
         sys.exit(1)
+    return create_backend(args.backend, args.local_speed)
+
+
+def main():   
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        return batch_main(sys.argv[2:])
+    parser = argparse.ArgumentParser(description='Speech recognition of an audio (or video) file using Microsoft Cognitive Services. The results are saved as json.')
+    parser.add_argument('pcm_file', metavar='audio_file', help='input audio: a mono 16KHz pcm file, or any media file or URL that ffmpeg can decode (decoded while it is recognized); - reads the media from standard input')
+    parser.add_argument('json_file', help='output json file (.json) or json lines file (.jsonl). Results are written as they are recognized')
+    parser.add_argument('--workers', type=int, default=1, help='split the audio into chunks at quiet points and recognize up to WORKERS chunks in parallel')
+    parser.add_argument('--timeout', type=float, default=None, help='give up if recognition (of each chunk) takes longer than TIMEOUT seconds')
+    parser.add_argument('--live-captions', action='append', default=[], metavar='CAPTION_FILE', help='also write captions (.vtt .srt or .txt) while recognition is running; each caption is written as soon as it is complete. May be repeated')
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL_S, help='write recognized results to the output file at least every FLUSH_INTERVAL seconds')
+    add_backend_arguments(parser)
+    add_silence_arguments(parser)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers > 1 and not pcm_audio.is_pcm_file(args.pcm_file):
+        parser.error('--workers needs a 16KHz mono PCM file (the audio is split into chunks); decode other media with ffmpeg first')
+    job = RecognitionJob(backend_from_args(args), silence_level_from_args(args))
     
-    pcm_file = sys.argv[1]
-    json_file = sys.argv[2]
-    
-    json_results = recognize_pcm_audio_file_to_ms_json(pcm_file)
-    save_json(json_results, json_file)
+    recognize = functools.partial(recognize_pcm_audio_file_to_ms_json, timeout=args.timeout, job=job)
+    sinks = [JsonResultWriter(args.json_file, flush_interval=args.flush_interval)]
+    if args.live_captions:
+        sinks.append(ms_json_to_caption.LiveCaptionWriter(args.live_captions))
+    with ResultSinks(sinks) as json_results:
+        if args.workers > 1:
+            recognize_pcm_audio_file_in_chunks(args.pcm_file, args.workers, recognize, json_results, job)
+        else:
+            recognize(args.pcm_file, json_results=json_results)
+    if args.skip_silence:
+        print(job.silence_report())
     
 speech_key = os.environ.get('speech_key','')
 service_region = os.environ.get('azure_region','westus') # e.g. westus
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# pcm_audio
+# Copyright (c) 2019 Lawrence Angrave
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Small helpers to read and measure 16KHz mono 16 bit PCM audio - the format expected by speech recognition.
+# Both wav files and raw (headerless) s16le files are supported e.g. the output of
+# ffmpeg -i video-source.mp4 -acodec pcm_s16le -f s16le -ac 1 -ar 16000 audio-output.wav
+# Other media (e.g. mp4 video) can be decoded on the fly by an ffmpeg process instead (see FfmpegDecoder), without an intermediate audio file.
+# Long silences can be removed before recognition (see SilenceFilter), so that they are not paid for.
+
+import array
+import bisect
+import errno
+import itertools
+import os
+import struct
+import subprocess
+import sys
+import threading
+import wave
+
+SAMPLE_RATE = 16000 # Samples per second
+SAMPLE_WIDTH = 2 # Bytes per sample (signed 16 bit, little endian)
+BYTES_PER_MS = SAMPLE_RATE * SAMPLE_WIDTH // 1000
+
+TICKS_PER_MS = 10000 # MS cognitive services times are in ticks of one hundred nanoseconds
+
+FRAME_MS = 10 # Audio levels are measured over frames of this duration
+
+LEVEL_SAMPLE_STEP = 2 # Only every nth sample is used to estimate the level of a frame; plenty for speech/silence decisions
+
+FFMPEG = os.environ.get('FFMPEG', 'ffmpeg') # The ffmpeg program used to decode other media
+
+DECODE_BLOCK_MS = 100 # Decoded audio is passed on in blocks of this duration
+
+PCM_EXTENSIONS = ('.wav', '.pcm') # Files with these extensions are read directly if they are 16KHz mono 16 bit PCM
+
+SILENCE_LEVEL = 200 # SilenceFilter treats frames with a mean absolute amplitude at or below this as silence
+MIN_SKIPPED_SILENCE_MS = 3000 # Only silences at least this long are removed
+SILENCE_PADDING_MS = 500 # ... and this much of the silence is kept next to the speech, so quiet word edges are not clipped and the recognizer still hears a pause
+
+
+class PcmReader:
+    """Random access to the samples of a 16KHz mono 16 bit PCM wav or raw s16le file. Times are in milliseconds."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.data_start, self.data_size = find_pcm_data(self.file)
+        self.duration_ms = self.data_size // BYTES_PER_MS
+
+    def read(self, start_ms, end_ms):
+        """Returns the raw PCM bytes between the two times"""
+        start_ms = max(0, start_ms)
+        end_ms = min(self.duration_ms, end_ms)
+        if end_ms <= start_ms:
+            return b''
+        self.file.seek(self.data_start + start_ms * BYTES_PER_MS)
+        return self.file.read((end_ms - start_ms) * BYTES_PER_MS)
+
+    def blocks(self, block_ms=1000):
+        """Yields the audio as consecutive blocks of raw PCM bytes"""
+        for start_ms in range(0, self.duration_ms, block_ms):
+            yield self.read(start_ms, start_ms + block_ms)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def find_pcm_data(f):
+    """Returns (offset, size) of the PCM samples in an open binary file. Wav headers are checked for 16KHz mono 16 bit audio; files without a RIFF header are assumed to be raw s16le."""
+    f.seek(0, 2)
+    file_size = f.tell()
+    f.seek(0)
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return 0, file_size - file_size % SAMPLE_WIDTH
+
+    fmt = None
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError('{}: wav file has no data chunk'.format(getattr(f, 'name', 'audio')))
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', f.read(16))
+            f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+        elif chunk_id == b'data':
+            break
+        else:
+            f.seek(chunk_size + (chunk_size & 1), 1) # Chunks are word aligned
+
+    if fmt:
+        audio_format, channels, rate, _, _, bits = fmt
+        if audio_format != 1 or channels != 1 or rate != SAMPLE_RATE or bits != SAMPLE_WIDTH * 8:
+            raise ValueError('{}: expected 16KHz mono 16 bit PCM audio, found {} channel(s) at {}Hz {} bit'.format(getattr(f, 'name', 'audio'), channels, rate, bits))
+
+    offset = f.tell()
+    # Streamed wav files may have a zero or oversized data length
+    size = min(chunk_size, file_size - offset) if chunk_size else file_size - offset
+    return offset, size - size % SAMPLE_WIDTH
+
+
+def iter_frame_levels(blocks, frame_ms=FRAME_MS):
+    """Yields the mean absolute amplitude of each frame_ms frame of the raw PCM byte blocks. A trailing partial frame is ignored."""
+    frame_bytes = frame_ms * BYTES_PER_MS
+    frame_samples = frame_bytes // SAMPLE_WIDTH
+    step = LEVEL_SAMPLE_STEP
+    count = len(range(0, frame_samples, step))
+    pending = b''
+    for block in blocks:
+        if pending:
+            block = pending + block
+        usable = len(block) - len(block) % frame_bytes
+        pending = block[usable:]
+        samples = array.array('h', block[:usable])
+        if sys.byteorder != 'little':
+            samples.byteswap()
+        for start in range(0, usable // SAMPLE_WIDTH, frame_samples):
+            yield sum(map(abs, samples[start:start + frame_samples:step])) // count
+
+
+def frame_levels(blocks, frame_ms=FRAME_MS):
+    """Returns an array of frame levels (see iter_frame_levels)"""
+    return array.array('l', iter_frame_levels(blocks, frame_ms))
+
+
+def quietest_frame(levels, start, end, window):
+    """Returns the index of the frame in levels[start:end] at the centre of the quietest run of window frames"""
+    start = max(0, start)
+    end = min(len(levels), end)
+    if end - start <= window:
+        return (start + end) // 2
+    totals = list(itertools.accumulate(levels[start:end], initial=0))
+    best = min(range(len(totals) - window), key=lambda i: totals[i + window] - totals[i])
+    return start + best + window // 2
+
+
+def write_wav(filename, pcm_bytes):
+    """Saves raw PCM bytes as a 16KHz mono 16 bit wav file"""
+    with wave.open(filename, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(SAMPLE_WIDTH)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes(pcm_bytes)
+
+
+class FfmpegDecoder:
+    """Decodes any media ffmpeg can read - a file name, URL, '-' (standard input) or an open binary file - into 16KHz mono 16 bit PCM, using an ffmpeg process.
+    blocks() yields the audio in fixed size blocks as soon as they are decoded, so that recognition can start while decoding is still running.
+    If ffmpeg fails, blocks() raises RuntimeError and error is set to ffmpeg's error message"""
+    def __init__(self, source, block_ms=DECODE_BLOCK_MS, ffmpeg=FFMPEG):
+        self.source = source
+        self.block_bytes = block_ms * BYTES_PER_MS
+        self.error = None
+        self.name = source if isinstance(source, str) else getattr(source, 'name', 'stream')
+        from_stream = not isinstance(source, str) or source == '-'
+        if from_stream and not isinstance(source, str):
+            try:
+                source.fileno()
+                stdin = source
+            except (AttributeError, OSError, ValueError):
+                stdin = subprocess.PIPE # e.g. an in-memory stream, copied to ffmpeg by a thread
+        else:
+            stdin = None if from_stream else subprocess.DEVNULL
+        command = [ffmpeg, '-hide_banner', '-nostats', '-loglevel', 'error', '-i', 'pipe:0' if from_stream else source,
+            '-vn', '-acodec', 'pcm_s16le', '-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE), 'pipe:1']
+        try:
+            self.process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError('{} not found; ffmpeg is needed to decode {}'.format(ffmpeg, self.name))
+        self.messages = []
+        # ffmpeg's messages are collected by a thread so that a full stderr pipe can never stall decoding
+        self.stderr_thread = threading.Thread(target=lambda: self.messages.extend(self.process.stderr), daemon=True)
+        self.stderr_thread.start()
+        if stdin is subprocess.PIPE:
+            threading.Thread(target=self.copy_input, daemon=True).start()
+
+    def copy_input(self):
+        try:
+            for data in iter(lambda: self.source.read(64 * 1024), b''):
+                self.process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            pass # ffmpeg stopped reading e.g. it was closed
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def blocks(self):
+        """Yields the decoded audio as blocks of raw PCM bytes. All but the last block are block_ms long"""
+        stdout = self.process.stdout
+        while True:
+            block = stdout.read(self.block_bytes)
+            if not block:
+                break
+            yield block[:len(block) - len(block) % SAMPLE_WIDTH]
+        if self.process.wait() != 0:
+            self.stderr_thread.join(1)
+            message = b''.join(self.messages).decode('utf-8', 'replace').strip()
+            self.error = 'ffmpeg could not decode {} (exit status {}): {}'.format(self.name, self.process.returncode, message)
+            raise RuntimeError(self.error)
+
+    def close(self):
+        """Stops ffmpeg if it is still running"""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_pcm_file(filename):
+    """True if the file can be read directly by a PcmReader: a .wav or .pcm file that is 16KHz mono 16 bit PCM (a raw .pcm file is assumed to be)"""
+    if not isinstance(filename, str) or not filename.lower().endswith(PCM_EXTENSIONS) or not os.path.isfile(filename):
+        return False
+    try:
+        with open(filename, 'rb') as f:
+            find_pcm_data(f)
+    except ValueError:
+        return False
+    return True
+
+
+def open_audio(source, block_ms=DECODE_BLOCK_MS):
+    """Returns the source itself if it is a 16KHz mono PCM file (or already a decoder), otherwise an FfmpegDecoder that decodes it"""
+    if hasattr(source, 'blocks') or is_pcm_file(source):
+        return source
+    if isinstance(source, str) and source != '-' and '://' not in source and not os.path.exists(source):
+        # Rather than an ffmpeg error (or ffmpeg not found) for a mistyped file name
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), source)
+    return FfmpegDecoder(source, block_ms)
+
+
+class SilenceFilter:
+    """An energy based voice activity filter. blocks() yields the PCM audio of a PcmReader, FfmpegDecoder or PCM file name with the long silences removed.
+    original_ticks() maps a time in the filtered audio back to the time in the original audio"""
+    def __init__(self, audio, silence_level=SILENCE_LEVEL, min_silence_ms=MIN_SKIPPED_SILENCE_MS, padding_ms=SILENCE_PADDING_MS):
+        if min_silence_ms <= 2 * padding_ms:
+            raise ValueError('min_silence_ms must be longer than both paddings')
+        self.audio = PcmReader(audio) if isinstance(audio, str) else audio
+        self.name = getattr(self.audio, 'name', getattr(self.audio, 'filename', 'audio'))
+        self.silence_level = silence_level
+        self.min_silence_frames = min_silence_ms // FRAME_MS
+        self.padding_frames = padding_ms // FRAME_MS
+        self.error = None
+        self.duration_ms = 0 # Of the audio read so far
+        self.skipped_ms = 0
+        # (filtered ticks, ticks removed before that time) for each removed silence, in order.
+        # Appended while the audio is read, so results can be mapped back as soon as they are recognized
+        self.cuts = []
+
+    def blocks(self):
+        """Yields the audio as raw PCM bytes, without the long silences"""
+        frame_bytes = FRAME_MS * BYTES_PER_MS
+        frame_samples = frame_bytes // SAMPLE_WIDTH
+        step = LEVEL_SAMPLE_STEP
+        count = len(range(0, frame_samples, step))
+        silence_level, padding, min_silence = self.silence_level, self.padding_frames, self.min_silence_frames
+        kept_frames = 0 # Frames passed on by earlier blocks
+        silent_frames = 0 # Length of the current silence
+        head = 0 # Frames at the start of the current silence that are always kept (none before the first speech)
+        held = [] # Later frames of the current silence; kept unless the silence becomes long enough to remove
+        removing = False # The silence is long enough to remove; held is then just the last frames, kept before the next speech
+        pending = b''
+        for block in self.audio.blocks():
+            if pending:
+                block = pending + block
+            usable = len(block) - len(block) % frame_bytes
+            pending = block[usable:]
+            samples = array.array('h', block[:usable])
+            if sys.byteorder != 'little':
+                samples.byteswap()
+            kept = []
+            for start in range(0, usable // SAMPLE_WIDTH, frame_samples):
+                frame = block[start * SAMPLE_WIDTH:(start + frame_samples) * SAMPLE_WIDTH]
+                if sum(map(abs, samples[start:start + frame_samples:step])) // count > silence_level:
+                    if silent_frames:
+                        if removing:
+                            self.remove(kept_frames + len(kept), silent_frames - head - len(held))
+                            removing = False
+                        kept.extend(held)
+                        held = []
+                        silent_frames = 0
+                        head = padding
+                    kept.append(frame)
+                    continue
+                silent_frames += 1
+                if silent_frames <= head:
+                    kept.append(frame) # The end of the speech
+                    continue
+                held.append(frame)
+                if removing:
+                    del held[0]
+                elif silent_frames >= min_silence:
+                    removing = True
+                    del held[:-padding]
+            kept_frames += len(kept)
+            self.duration_ms += usable // BYTES_PER_MS
+            if kept:
+                yield b''.join(kept)
+        if removing:
+            # Silence at the end of the audio is removed up to the padding after the last speech
+            self.remove(kept_frames, silent_frames - head)
+        elif held:
+            yield b''.join(held)
+        if pending:
+            self.duration_ms += len(pending) // BYTES_PER_MS
+            yield pending
+
+    def remove(self, kept_frames, removed_frames):
+        """Records that removed_frames of silence were dropped after kept_frames of the filtered audio"""
+        self.skipped_ms += removed_frames * FRAME_MS
+        self.cuts.append((kept_frames * FRAME_MS * TICKS_PER_MS, self.skipped_ms * TICKS_PER_MS))
+
+    def skipped_ms_from(self, start_ms):
+        """Returns how much of the original audio from start_ms onwards was removed"""
+        skipped = 0
+        removed_before = 0
+        for filtered_ticks, removed_ticks in self.cuts:
+            # The silence removed at this cut starts at filtered_ticks + removed_before in the original audio
+            silence_start, silence_end = (filtered_ticks + removed_before) // TICKS_PER_MS, (filtered_ticks + removed_ticks) // TICKS_PER_MS
+            skipped += max(0, silence_end - max(silence_start, start_ms))
+            removed_before = removed_ticks
+        return skipped
+
+    def original_ticks(self, ticks, end=False):
+        """Returns the time in the original audio of a time (in ticks) in the filtered audio.
+        A time exactly at a removed silence is after the silence, unless end is true (e.g. the end of a word)"""
+        cuts = self.cuts
+        i = bisect.bisect_left(cuts, (ticks,)) if end else bisect.bisect_right(cuts, (ticks, float('inf')))
+        return ticks + cuts[i - 1][1] if i else ticks
+
+    def close(self):
+        self.audio.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()